@@ -12,6 +12,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import ROOT as R
 from math import fabs
+from hough_tools import HoughIndex, findPeaks, peakHits, makeAccumulator
 
 # Hit positions
 xHits=[]
@@ -25,30 +26,50 @@ detR=[65.115, 115.11, 165.11]
 # Each event has only one track. For the purpose of this tutorial, one can read more than one track. 
 def readHits(infile, nTrks):
 
-  xHits=[]
-  yHits=[]
-  layerId=[]
-
-  tf=R.TFile.Open(infile, "READ")
-  tr=tf.Get("tree1")
-  nevents=tr.GetEntries()
-
-  itrk=0
-  for i in range(nevents):
-    tr.GetEntry(i)
-    x = tr.posX
-    y = tr.posY
-    l = tr.layerID
-    # the first 3 hits
-    for j in range(3):
-      xHits.append(x[j])     
-      yHits.append(y[j])     
-      layerId.append(l[j])     
-
-    itrk+=1
-    if itrk >= nTrks: break
-  
-  return [xHits, yHits, layerId]
+  [xHits, yHits, layerId, event] = readHitColumns(infile, 0, nTrks)
+  return [xHits.tolist(), yHits.tolist(), layerId.tolist()]
+
+# The first 3 hits of the entries of the TTree file as scalar columns of an RDataFrame
+# (defined once, and compiled at the first read)
+# returns [df, columns]: the dataframe and the names of its hit columns
+def hitDataFrame(infile):
+
+  df = R.RDataFrame("tree1", infile)
+  columns = []
+  for j in range(3):
+    for name, branch in [("x", "posX"), ("y", "posY"), ("l", "layerID")]:
+      df = df.Define("%s%d" % (name, j), "%s[%d]" % (branch, j))
+      columns.append("%s%d" % (name, j))
+  return [df, columns]
+
+# Read the hits of the entries first to last-1 (None: all) of the TTree file, column by column into numpy arrays
+# (RDataFrame AsNumpy on the entry range, without a Python loop over the entries).
+# The entry range needs the single-thread event loop (no implicit multi-threading).
+# hits: the dataframe of hitDataFrame, to read several ranges (None: a new one)
+# returns [xHits, yHits, layerId, event]: the first 3 hits of each entry, and the entry number of each hit
+def readHitColumns(infile, first=0, last=None, hits=None):
+
+  [df, columns] = hitDataFrame(infile) if hits is None else hits
+  data = df.Range(first, 0 if last is None else last).AsNumpy(columns)
+
+  # (entry, hit) order
+  xHits = np.stack([data["x%d" % j] for j in range(3)], axis=1).ravel().astype(float)
+  yHits = np.stack([data["y%d" % j] for j in range(3)], axis=1).ravel().astype(float)
+  layerId = np.stack([data["l%d" % j] for j in range(3)], axis=1).ravel().astype(int)
+  event = first + np.repeat(np.arange(len(xHits)//3), 3)
+  return [xHits, yHits, layerId, event]
+
+# Iterate over the hits of the TTree file by chunks of chunkSize entries, up to nTrks entries (None: all)
+# Each chunk is read on its own (readHitColumns), from the same dataframe.
+# yields [xHits, yHits, layerId, event] of each chunk, see readHitColumns
+def iterHits(infile, chunkSize=10000, nTrks=None):
+
+  hits = hitDataFrame(infile)
+  nevents = hits[0].Count().GetValue()
+  if nTrks is not None: nevents = min(nevents, nTrks)
+
+  for first in range(0, nevents, chunkSize):
+    yield readHitColumns(infile, first, min(first+chunkSize, nevents), hits)
 
 # Conformal mapping
 def conformal(xHits, yHits):
@@ -66,6 +87,16 @@ def conformal(xHits, yHits):
 
   return [cxHits, cyHits]
 
+# Conformal mapping of a batch of events at once: hits with the event number of each hit
+# returns [cxHits, cyHits, event] (numpy arrays), the hits at the origin are dropped
+def conformalBatch(xHits, yHits, event):
+
+  x, y, event = np.asarray(xHits, dtype=float), np.asarray(yHits, dtype=float), np.asarray(event, dtype=np.int64)
+  r2 = x*x + y*y
+  good = r2 > 0
+  if not good.all(): print("Error! ", int((~good).sum()), " wrong hits")
+  return [2*x[good]/r2[good], 2*y[good]/r2[good], event[good]]
+
 # Generate randome noise hits
 def addNoise(nNoise):
 
@@ -84,56 +115,97 @@ def addNoise(nNoise):
 
     return [xNoise, yNoise, lNoise]
 
+# Generate nNoise random noise hits in each of nEvents events at once
+# returns [xNoise, yNoise, lNoise, event] (numpy arrays)
+def addNoiseBatch(nEvents, nNoise):
+
+  event = np.repeat(np.arange(nEvents), nNoise)
+  theta = np.random.rand(len(event))
+  lNoise = (np.random.rand(len(event))*100%3).astype(int)
+  r = np.asarray(detR)[lNoise]
+  return [r*np.cos(theta), r*np.sin(theta), lNoise, event]
+
 # Hough transform
-def houghLine(xHits, yHits):
-    ''' Basic Hough line transform that builds the accumulator array
+def houghLine(xHits, yHits, nRBins=200, thetas=None, rRange=None, event=None, nEvents=None, returnIndex=False, backend=None):
+    ''' Hough line transform that builds the accumulator array, in a single vectorized pass
     Input : xHits, yHits are x and y coodinates of all points
-    Output : accumulator : the accumulator of hough space
-             thetas : values of theta (-90 : 90)
-             rs : values of radius (-max distance : max distance)
+            nRBins : number of radius bins
+            thetas : values of theta (None: -90 : 90 degrees, in steps of 1 degree)
+            rRange : radius range (rmin, rmax) of the bins, "radius" for (-max hit radius, max hit radius)
+                     (any line through a hit is within this distance of the origin),
+                     or None for the range of the radius values of the hits
+            event : event number of each hit, to transform a batch of events at once (None: one event)
+            nEvents : number of events in the batch (None: largest event number + 1)
+            returnIndex : also return the bin-to-hit index
+            backend : None for a numpy array accumulator, or the accumulator backend "dense", "sparse" or "auto"
+                      (see makeAccumulator)
+    Output : accumulator : the accumulator of hough space, shape (nRBins, len(thetas)),
+                           or (nEvents, nRBins, len(thetas)) for a batch (with a backend, the accumulator object)
+             thetas : values of theta
+             rs : lower edge of the radius bins, shape (nRBins,), or (nEvents, nRBins) for a batch
+                  (the range is set per event)
+             index : (with returnIndex) the HoughIndex of the votes, with the flat bin numbers of the accumulator
+                     and the hit numbers in the order of xHits, yHits
     Reference: https://sbme-tutorials.github.io/2018/cv/notes/5_week5.html
     '''
 
-    # Get image dimensions
-    # y for rows and x for columns 
-    Ny = len(yHits)
-    Nx = len(xHits)
-
-    # Binning
-    Maxdist = 100
+    x = np.asarray(xHits, dtype=float)
+    y = np.asarray(yHits, dtype=float)
+    batch = event is not None
+    if batch:
+      event = np.asarray(event, dtype=np.int64)
+      if nEvents is None: nEvents = int(event.max())+1 if len(event)>0 else 0
+    else:
+      event = np.zeros(len(x), dtype=np.int64)
+      nEvents = 1
 
     # Theta in range from -90 to 90 degrees
-    thetas = np.deg2rad(np.arange(-90, 90))
-    # Range of radius
-    rs = np.linspace(-Maxdist, Maxdist, 2*Maxdist)
-    rmin, rmax = 1e6, -1e6
-    # Loop all points of the image
-    for x, y in zip(xHits, yHits):
-        # Map edge pixel to hough space
-        for k in range(len(thetas)):
-           # Calculate space parameter
-           r = x*np.cos(thetas[k]) + y * np.sin(thetas[k])
-           if r > rmax: rmax=r
-           if r < rmin: rmin=r
-    rstep = (rmax-rmin)/(Maxdist*2)
-
-    accumulator = np.zeros((2 * Maxdist, len(thetas)))
-
-    # Loop all points of the image
-    for x, y in zip(xHits, yHits):
-        # Map edge pixel to hough space
-        for k in range(len(thetas)):
-           # Calculate space parameter
-           r = x*np.cos(thetas[k]) + y * np.sin(thetas[k])
-
-           # Update the accumulator
-           # N.B: r has value -max to max
-           # map r to its idx 0 : 2*max
-           #accumulator[int((r-rmin)/rstep) + Maxdist,k] += 1
-           rind = int((r-rmin)/rstep)
-           if rind < Maxdist*2:
-             accumulator[rind,k] += 1
-
+    if thetas is None: thetas = np.deg2rad(np.arange(-90, 90))
+    nThetas = len(thetas)
+
+    # Calculate space parameter, for all hits (rows) and thetas (columns) at once
+    r = x[:,np.newaxis]*np.cos(thetas) + y[:,np.newaxis]*np.sin(thetas)
+
+    # Range of radius of each event
+    if rRange is None:
+      rmin, rmax = np.full(nEvents, np.inf), np.full(nEvents, -np.inf)
+      if len(r)>0:
+        np.minimum.at(rmin, event, r.min(axis=1))
+        np.maximum.at(rmax, event, r.max(axis=1))
+    elif isinstance(rRange, str) and rRange == "radius":
+      rmax = np.full(nEvents, -np.inf)
+      np.maximum.at(rmax, event, np.hypot(x, y))
+      rmin = -rmax
+    else:
+      rmin, rmax = np.full(nEvents, float(rRange[0])), np.full(nEvents, float(rRange[1]))
+    # events without hits
+    empty = np.logical_not(np.isfinite(rmin) & np.isfinite(rmax))
+    rmin[empty], rmax[empty] = 0., 0.
+    rstep = (rmax-rmin)/nRBins
+    rstep[rstep <= 0.] = 1.
+
+    # Update the accumulator: map r to its idx 0 : nRBins, then count the votes of each (event, r, theta) bin
+    # N.B: the largest r of an event is the upper edge of the last bin, it is not counted
+    rind = np.floor((r - rmin[event][:,np.newaxis])/rstep[event][:,np.newaxis]).astype(np.int64)
+    inside = (rind >= 0) & (rind < nRBins)
+    bins = ((event[:,np.newaxis]*nRBins + rind)*nThetas + np.arange(nThetas))[inside]
+    rs = rmin[:,np.newaxis] + rstep[:,np.newaxis]*np.arange(nRBins)
+    # the hit number of each vote
+    hits = np.repeat(np.arange(len(x)), nThetas)[inside.ravel()]
+    if backend is not None:
+      accumulator = makeAccumulator((nEvents, nRBins, nThetas) if batch else (nRBins, nThetas), len(bins), backend)
+      accumulator.fill(bins, hits)
+      if not batch: return accumulator, thetas, rs[0]
+      return accumulator, thetas, rs
+    if returnIndex:
+      # the votes sorted by bin
+      index = HoughIndex(bins, hits, nEvents*nRBins*nThetas)
+      accumulator = index.counts.reshape(nEvents, nRBins, nThetas).astype(float)
+      if not batch: return accumulator[0], thetas, rs[0], index
+      return accumulator, thetas, rs, index
+    accumulator = np.bincount(bins, minlength=nEvents*nRBins*nThetas).reshape(nEvents, nRBins, nThetas).astype(float)
+
+    if not batch: return accumulator[0], thetas, rs[0]
     return accumulator, thetas, rs
 
 # Read hits
@@ -195,15 +267,64 @@ plt.scatter(cxHits, cyHits)
 
 # Do Hough Transform
 # ==========
-accumulator, thetas, rhos = houghLine(cxHits, cyHits)
+accumulator, thetas, rhos, index = houghLine(cxHits, cyHits, returnIndex=True)
+
+# Track candidates: the peaks with a vote from each of the 3 layers, and the hits voting for them
+# ==========
+irs, ithetas, votes = findPeaks(accumulator, 3)
+for ir, itheta, nvote, hits in zip(irs, ithetas, votes, peakHits(index, irs, ithetas, len(thetas))):
+  print("Track candidate rho=", rhos[ir], " theta=", np.rad2deg(thetas[itheta]), " votes ", nvote,
+        " hits ", hits.tolist(), " noise hits ", int((hits >= len(xHitsSig)).sum()))
+
+# Fine binning (0.01 degree, 20000 radius bins): a dense accumulator would have 360 million bins,
+# the automatic backend only stores the bins with votes
+fine, fineThetas, fineRhos = houghLine(cxHits, cyHits, nRBins=20000, thetas=np.deg2rad(np.arange(-90, 90, 0.01)), backend="auto")
+fineIrs, fineIthetas, fineVotes = fine.peaks(3)
+print("Fine binning: ", type(fine).__name__, " memory ", fine.memory()/1e6, " MB (dense: ", 8e-6*np.prod(fine.shape), " MB), ",
+      len(fineVotes), " peaks with 3 votes")
 
 plt.subplot(1,3,3)
 plt.title('Hough Space')
 plt.xlabel(r'$\theta$')
 plt.ylabel(r'$\rho$')
 plt.imshow(accumulator)
+plt.scatter(ithetas, irs, marker='x', color='red')
 #plt.set_cmap('gray')
 
 plt.savefig('demo_hough_transform_circles_1.png')
 plt.show()
 
+# Batch of events
+# ==========
+# Each track is an event with its own noise hits: the hits of all the events are transformed at once into
+# an (event, rho, theta) accumulator, and the best peak of each event is found at once
+nBatch=100
+[xBatch, yBatch, lBatch, eventBatch] = readHitColumns(infile, 0, nBatch)
+nBatch = len(xBatch)//3
+[xNoise, yNoise, lNoise, eventNoise] = addNoiseBatch(nBatch, nNoise)
+# the hits of each event: the signal hits, then the noise hits
+order = np.argsort(np.concatenate([eventBatch, eventNoise]), kind='stable')
+xBatch, yBatch = np.concatenate([xBatch, xNoise])[order], np.concatenate([yBatch, yNoise])[order]
+noiseBatch = (np.arange(len(order)) >= len(eventBatch))[order]
+eventBatch = np.concatenate([eventBatch, eventNoise])[order]
+noiseBatch = noiseBatch[(xBatch != 0) | (yBatch != 0)]
+[cxBatch, cyBatch, eventBatch] = conformalBatch(xBatch, yBatch, eventBatch)
+
+batchAcc, batchThetas, batchRhos, batchIndex = houghLine(cxBatch, cyBatch, event=eventBatch, nEvents=nBatch, returnIndex=True)
+ievents, irs, ithetas, votes = findPeaks(batchAcc, 3, maxPeaks=1)
+batchHits = peakHits(batchIndex, irs, ithetas, len(batchThetas), ievents, batchAcc.shape[1])
+nClean = sum(int(not noiseBatch[hits].any()) for hits in batchHits)
+print("Batch of ", nBatch, " events: ", len(ievents), " events with a track candidate, ", nClean, " without noise hits")
+
+# Streaming over the file
+# ==========
+# The entries are read by chunks into numpy arrays, and each chunk is transformed as a batch of events
+nFound, nRead = 0, 0
+for [xChunk, yChunk, lChunk, eventChunk] in iterHits(infile, chunkSize=1000):
+  # event numbers within the chunk
+  nChunk = len(xChunk)//3
+  [cxChunk, cyChunk, eventChunk] = conformalBatch(xChunk, yChunk, eventChunk-eventChunk[0])
+  chunkAcc, chunkThetas, chunkRhos = houghLine(cxChunk, cyChunk, event=eventChunk, nEvents=nChunk)
+  nFound += len(findPeaks(chunkAcc, 3, maxPeaks=1)[0])
+  nRead += nChunk
+print("All the file: ", nRead, " events, ", nFound, " events with a track candidate")
@@ -10,13 +10,19 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
+from hough_tools import HoughIndex, findPeaks, peakHits, houghAdaptive, makeAccumulator
 
-def houghLine(image):
+def houghLine(image, returnIndex=False, backend=None):
     ''' Basic Hough line transform that builds the accumulator array
     Input : image : edge image (canny)
-    Output : accumulator : the accumulator of hough space
+            returnIndex : also return the bin-to-hit index
+            backend : None for a numpy array accumulator, or the accumulator backend "dense", "sparse" or "auto"
+                      (see makeAccumulator)
+    Output : accumulator : the accumulator of hough space (with a backend, the accumulator object)
              thetas : values of theta (-90 : 90)
              rs : values of radius (-max distance : max distance)
+             index : (with returnIndex) the HoughIndex of the votes, where hit k is the k-th edge pixel
+                     of np.nonzero(image > 0)
     Reference: https://sbme-tutorials.github.io/2018/cv/notes/5_week5.html
     '''
 
@@ -34,26 +40,51 @@ def houghLine(image):
     # Range of radius
     rs = np.linspace(-Maxdist, Maxdist, 2*Maxdist)
 
-    accumulator = np.zeros((2 * Maxdist, len(thetas)))
-
-    # Loop all points of the image
-    for y in range(Ny):
-      for x in range(Nx):
-         # Check if it is an edge pixel
-         #  NB: y -> rows , x -> columns
-         if image[y,x] > 0:
-           # Map edge pixel to hough space
-           for k in range(len(thetas)):
-              # Calculate space parameter
-              r = x*np.cos(thetas[k]) + y * np.sin(thetas[k])
-
-              # Update the accumulator
-              # N.B: r has value -max to max
-              # map r to its idx 0 : 2*max
-              accumulator[int(r) + Maxdist,k] += 1
+    # Trig tables, evaluated theta by theta like np.cos(thetas[k]) for a single pixel,
+    # so that r (and its truncation to a bin) is bit for bit the same as pixel by pixel
+    cosTable = np.array([np.cos(theta) for theta in thetas])
+    sinTable = np.array([np.sin(theta) for theta in thetas])
+
+    # Edge pixels, all at once
+    #  NB: y -> rows , x -> columns
+    y, x = np.nonzero(image > 0)
+
+    # Map all edge pixels to hough space: r for each pixel (rows) and theta (columns)
+    r = x[:,np.newaxis]*cosTable + y[:,np.newaxis]*sinTable
+
+    # Update the accumulator
+    # N.B: r has value -max to max
+    # map r to its idx 0 : 2*max (int() truncates towards 0), then count the votes of each (r, theta) bin
+    ir = r.astype(np.int64) + Maxdist
+    bins = ir*len(thetas) + np.arange(len(thetas))
+    if backend is not None:
+      accumulator = makeAccumulator((2*Maxdist, len(thetas)), bins.size, backend)
+      accumulator.fill(bins, np.repeat(np.arange(len(x)), len(thetas)))
+      return accumulator, thetas, rs
+    if returnIndex:
+      # the votes sorted by bin, with the hit (edge pixel) number of each vote
+      index = HoughIndex(bins, np.repeat(np.arange(len(x)), len(thetas)), 2*Maxdist*len(thetas))
+      accumulator = index.counts.reshape(2*Maxdist, len(thetas)).astype(float)
+      return accumulator, thetas, rs, index
+    accumulator = np.bincount(bins.ravel(), minlength=2*Maxdist*len(thetas)).reshape(2*Maxdist, len(thetas)).astype(float)
 
     return accumulator, thetas, rs
 
+def houghLineAdaptive(image, threshold, nLevels=6):
+    ''' Coarse-to-fine Hough line transform: the (r, theta) cells with at least threshold votes are refined
+    nLevels times (in 2x2 sub-cells), starting from 16 x 18 cells (10 degrees), without a dense fine accumulator
+    Input : image : edge image (canny)
+            threshold : minimum number of votes of a cell
+            nLevels : number of refinements (the finest cells are 10/2**nLevels degrees wide)
+    Output : rs, thetas : centers of the finest cells with at least threshold votes, by decreasing votes
+             votes : their votes (edge pixels whose curve crosses the cell)
+             hits : the edge pixels voting for each cell, numbered as in np.nonzero(image > 0)
+    '''
+    Ny, Nx = image.shape
+    Maxdist = int(np.round(np.sqrt(Nx**2 + Ny ** 2)))
+    y, x = np.nonzero(image > 0)
+    return houghAdaptive(x, y, threshold, (-Maxdist, Maxdist), nR=16, nTheta=18, nLevels=nLevels)
+
 # Input image
 image = np.zeros((150,150))
 # Add points, start with one point
@@ -84,7 +115,13 @@ plt.show()
 image[50, 100] = 1
 image[100, 50] = 1
 # Do Hough Transform
-accumulator, thetas, rhos = houghLine(image)
+accumulator, thetas, rhos, index = houghLine(image, returnIndex=True)
+
+# Find the peaks (at least 3 votes, local maximum in 3x3 bins) and the pixels voting for them
+irs, ithetas, votes = findPeaks(accumulator, 3)
+yEdge, xEdge = np.nonzero(image > 0)
+for ir, itheta, nvote, hits in zip(irs, ithetas, votes, peakHits(index, irs, ithetas, len(thetas))):
+  print("Line rho=", rhos[ir], " theta=", np.rad2deg(thetas[itheta]), " votes ", nvote, " pixels (x,y) ", list(zip(xEdge[hits].tolist(), yEdge[hits].tolist())))
 # Plotting
 plt.figure('Hough Transform', figsize=(8,8))
 plt.tight_layout()
@@ -100,9 +137,16 @@ plt.title('Hough Space')
 plt.xlabel(r'$\theta$')
 plt.ylabel(r'$\rho$')
 plt.imshow(accumulator)
+plt.scatter(ithetas, irs, marker='x', color='red')
 #plt.set_cmap('gray')
 
 plt.savefig('demo_hough_transform_lines_2.png')
 plt.show()
 
+# Adaptive transform: the same line at 10/2**6 = 0.16 degree precision,
+# without the dense accumulator of the equivalent 1024 x 1152 fine grid
+rs, thetas, votes, hits = houghLineAdaptive(image, 3)
+print("Adaptive: ", len(votes), " cells with 3 votes, best line rho=", rs[0], " theta=", np.rad2deg(thetas[0]),
+      " pixels (x,y) ", list(zip(xEdge[hits[0]].tolist(), yEdge[hits[0]].tolist())))
+
 plt.close()
@@ -0,0 +1,286 @@
+## \file
+## \ingroup tutorial_pyroot
+## Hough transform tools: peak finding and hit back-association
+##
+## \macro_code
+
+import numpy as np
+
+# Bin-to-hit index of a Hough accumulator
+# =================
+# The votes of the accumulation (flat bin number and hit number of each vote) are sorted by bin once,
+# in a compressed sparse row layout: the hits voting in bin b are hits[start[b]:start[b+1]].
+# The number of votes per bin is the accumulator itself, so the index comes with the accumulation
+# and the hits of a peak are found without another pass over the hits.
+class HoughIndex:
+
+  def __init__(self, bins, hits, nBins):
+    bins = np.asarray(bins, dtype=np.int64).ravel()
+    hits = np.asarray(hits, dtype=np.int64).ravel()
+    order = np.argsort(bins, kind='stable')
+    self.hits = hits[order]
+    self.counts = np.bincount(bins, minlength=nBins)
+    self.start = np.zeros(nBins+1, dtype=np.int64)
+    np.cumsum(self.counts, out=self.start[1:])
+
+  # hit numbers (in increasing order) of the votes in the flat bin b
+  def hitsOf(self, b):
+    return self.hits[self.start[b]:self.start[b+1]]
+
+# Peak finding
+# =================
+# The peaks are the bins with at least threshold votes which are the maximum of their (2*size+1)x(2*size+1)
+# neighbourhood in (rho, theta) (non-maximum suppression). Of equal neighbouring maxima (a plateau),
+# the first bin in row-major order is the peak. The whole accumulator is compared at once with each shifted neighbour.
+# A batch of events, i.e. an (event, rho, theta) accumulator, is searched at once, event by event
+# (the neighbourhoods do not extend across events).
+# returns [irs, ithetas, votes]: the bin numbers and the votes of the peaks, by decreasing votes
+# (at most maxPeaks peaks, None for all), or [ievents, irs, ithetas, votes] for a batch,
+# by event, then by decreasing votes (at most maxPeaks peaks per event)
+def findPeaks(accumulator, threshold, size=1, maxPeaks=None):
+
+  acc = np.asarray(accumulator, dtype=float)
+  nr, nt = acc.shape[-2:]
+  padded = np.pad(acc, (acc.ndim-2)*[(0, 0)] + 2*[(size, size)], constant_values=-np.inf)
+  peak = acc >= threshold
+  for dr in range(-size, size+1):
+    for dt in range(-size, size+1):
+      if dr==0 and dt==0: continue
+      neighbour = padded[..., size+dr:size+dr+nr, size+dt:size+dt+nt]
+      # the neighbours before this bin (in row-major order) must be strictly lower
+      if (dr, dt) < (0, 0): peak &= acc > neighbour
+      else: peak &= acc >= neighbour
+
+  peaks = list(np.nonzero(peak))
+  return sortPeaks(peaks, acc[tuple(peaks)], maxPeaks)
+
+# Order the peaks [ievents (batch only), irs, ithetas] with their votes, by event and by decreasing votes,
+# keeping at most maxPeaks peaks per event
+# returns [ievents (batch only), irs, ithetas, votes]
+def sortPeaks(peaks, votes, maxPeaks):
+  batch = len(peaks) > 2
+  order = np.lexsort((-votes, peaks[0])) if batch else np.argsort(-votes, kind='stable')
+  peaks, votes = [p[order] for p in peaks], votes[order]
+  if maxPeaks is not None:
+    # rank of each peak within its event
+    event = peaks[0] if batch else np.zeros(len(votes), dtype=np.int64)
+    keep = np.arange(len(votes)) - np.searchsorted(event, event, side='left') < maxPeaks
+    peaks, votes = [p[keep] for p in peaks], votes[keep]
+  return peaks + [votes]
+
+# The hits of each peak (irs, ithetas) from the bin-to-hit index of an accumulator with nThetas theta bins,
+# for a batch with the events ievents of the peaks and nRBins radius bins
+# returns the list of the hit numbers of each peak
+def peakHits(index, irs, ithetas, nThetas, ievents=None, nRBins=0):
+  bins = np.asarray(irs, dtype=np.int64)*nThetas + ithetas
+  if ievents is not None: bins += np.asarray(ievents, dtype=np.int64)*(nRBins*nThetas)
+  return [index.hitsOf(b) for b in bins]
+
+# Accumulator backends
+# =================
+# An accumulator holds the votes in a Hough space of a given shape, e.g. (nR, nTheta), with the same interface
+# for all backends:
+# * fill(bins, hits): adds the votes, given by the flat bin number and the hit number of each vote
+# * votes(bins): the number of votes in the flat bins
+# * hitsOf(b): the hit numbers of the votes in the flat bin b (see HoughIndex)
+# * peaks(threshold, size, maxPeaks): the peaks, see findPeaks
+# * array(): the dense array of the votes
+# * memory(): the size of its arrays in bytes
+# The dense backend stores the votes of every bin. The sparse backend only stores the bins with votes
+# (sorted flat bin numbers and their votes, i.e. COO format), so its memory grows with the number of votes,
+# not with the size of the grid, and a very fine binning costs nothing for the empty bins.
+
+# Dense accumulator: the votes of all bins, and the bin-to-hit index (HoughIndex) built when the hits are queried
+class DenseAccumulator:
+
+  def __init__(self, shape):
+    self.shape = tuple(shape)
+    self.counts = np.zeros(int(np.prod(self.shape)), dtype=np.int64)
+    self.pending = []
+    self.index = None
+
+  def fill(self, bins, hits):
+    bins = np.asarray(bins, dtype=np.int64).ravel()
+    self.counts += np.bincount(bins, minlength=len(self.counts))
+    self.pending.append([bins, np.asarray(hits, dtype=np.int64).ravel()])
+    self.index = None
+
+  def votes(self, bins):
+    return self.counts[bins]
+
+  def hitsOf(self, b):
+    if self.index is None:
+      self.index = HoughIndex(np.concatenate([p[0] for p in self.pending]), np.concatenate([p[1] for p in self.pending]), len(self.counts))
+    return self.index.hitsOf(b)
+
+  def peaks(self, threshold, size=1, maxPeaks=None):
+    return findPeaks(self.array(), threshold, size, maxPeaks)
+
+  def array(self):
+    return self.counts.reshape(self.shape).astype(float)
+
+  def memory(self):
+    nbytes = self.counts.nbytes + sum(p[0].nbytes + p[1].nbytes for p in self.pending)
+    if self.index is not None: nbytes += self.index.hits.nbytes + self.index.counts.nbytes + self.index.start.nbytes
+    return nbytes
+
+# Sparse accumulator: the flat bin numbers with votes (sorted), their votes and the hits of the votes, bin by bin.
+# The filled votes are collected and sorted in once, when they are first needed, so many fills cost a single sort.
+class SparseAccumulator:
+
+  def __init__(self, shape):
+    self.shape = tuple(shape)
+    self.bins = np.zeros(0, dtype=np.int64)
+    self.counts = np.zeros(0, dtype=np.int64)
+    self.hits = np.zeros(0, dtype=np.int64)
+    self.start = np.zeros(1, dtype=np.int64)
+    self.pending = []
+
+  # the votes are only collected here, they are sorted into the stored ones when they are first needed (merge)
+  def fill(self, bins, hits):
+    self.pending.append([np.asarray(bins, dtype=np.int64).ravel(), np.asarray(hits, dtype=np.int64).ravel()])
+
+  # merge the collected votes with the stored ones, in a single sort
+  def merge(self):
+    if len(self.pending)==0: return
+    allBins = np.concatenate([np.repeat(self.bins, self.counts)] + [p[0] for p in self.pending])
+    allHits = np.concatenate([self.hits] + [p[1] for p in self.pending])
+    self.pending = []
+    order = np.argsort(allBins, kind='stable')
+    [self.bins, self.counts] = np.unique(allBins[order], return_counts=True)
+    self.hits = allHits[order]
+    self.start = np.zeros(len(self.bins)+1, dtype=np.int64)
+    np.cumsum(self.counts, out=self.start[1:])
+
+  def votes(self, bins):
+    self.merge()
+    bins = np.asarray(bins, dtype=np.int64)
+    if len(self.bins)==0: return np.zeros(bins.shape, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(self.bins, bins), len(self.bins)-1)
+    return np.where(self.bins[pos]==bins, self.counts[pos], 0)
+
+  def hitsOf(self, b):
+    self.merge()
+    k = np.searchsorted(self.bins, b)
+    if k==len(self.bins) or self.bins[k]!=b: return self.hits[0:0]
+    return self.hits[self.start[k]:self.start[k+1]]
+
+  # same as findPeaks, comparing only the bins above threshold with their neighbours
+  def peaks(self, threshold, size=1, maxPeaks=None):
+    self.merge()
+    nr, nt = self.shape[-2:]
+    candidates = self.bins[self.counts >= threshold]
+    votes = self.votes(candidates)
+    ievents, irs, ithetas = candidates//(nr*nt), (candidates//nt)%nr, candidates%nt
+    peak = np.ones(len(candidates), dtype=bool)
+    for dr in range(-size, size+1):
+      for dt in range(-size, size+1):
+        if dr==0 and dt==0: continue
+        r, t = irs+dr, ithetas+dt
+        inside = (r >= 0) & (r < nr) & (t >= 0) & (t < nt)
+        neighbour = np.where(inside, self.votes(np.where(inside, (ievents*nr+r)*nt+t, 0)), -1)
+        if (dr, dt) < (0, 0): peak &= votes > neighbour
+        else: peak &= votes >= neighbour
+    peaks = [irs[peak], ithetas[peak]]
+    if len(self.shape) > 2: peaks = [ievents[peak]] + peaks
+    return sortPeaks(peaks, votes[peak].astype(float), maxPeaks)
+
+  def array(self):
+    self.merge()
+    acc = np.zeros(int(np.prod(self.shape)))
+    acc[self.bins] = self.counts
+    return acc.reshape(self.shape)
+
+  def memory(self):
+    self.merge()
+    return self.bins.nbytes + self.counts.nbytes + self.hits.nbytes + self.start.nbytes
+
+# Accumulator of the given shape for nVotes votes
+# backend: "dense", "sparse" or "auto": sparse if the grid has more than twice as many bins as votes
+# (a dense bin costs about as much as a stored vote)
+def makeAccumulator(shape, nVotes, backend="auto"):
+  if backend == "auto": backend = "sparse" if np.prod(shape) > 2*nVotes else "dense"
+  if backend == "dense": return DenseAccumulator(shape)
+  if backend == "sparse": return SparseAccumulator(shape)
+  raise ValueError("unknown accumulator backend "+str(backend))
+
+# Coarse-to-fine (adaptive) Hough transform
+# =================
+# A hit (x, y) votes for a cell [r0, r1) x [theta0, theta1) if its curve r = x*cos(theta) + y*sin(theta)
+# crosses the cell, i.e. if the range of r over [theta0, theta1) overlaps [r0, r1). So a cell has at least the votes
+# of any of its sub-cells, and the cells below threshold can be dropped with all their sub-cells.
+# The votes are first counted on a coarse nR x nTheta grid. The cells above threshold are split into factor x factor
+# sub-cells, which are voted for only by the hits of their parent cell, and so on for nLevels levels.
+# The memory and the time grow with the number of cells above threshold, not with the size of the finest grid.
+
+# range [rlo, rhi] of r = x*cos(theta) + y*sin(theta) for theta in [theta0, theta1] (arrays of the same shape)
+def curveRange(x, y, theta0, theta1):
+  a = x*np.cos(theta0) + y*np.sin(theta0)
+  b = x*np.cos(theta1) + y*np.sin(theta1)
+  rlo, rhi = np.minimum(a, b), np.maximum(a, b)
+  # r = rho*cos(theta-phi) is extremal at theta = phi (+rho) and theta = phi+pi (-rho)
+  rho, phi = np.hypot(x, y), np.arctan2(y, x)
+  width = theta1 - theta0
+  rhi = np.where(np.mod(phi - theta0, 2*np.pi) <= width, rho, rhi)
+  rlo = np.where(np.mod(phi + np.pi - theta0, 2*np.pi) <= width, -rho, rlo)
+  return [rlo, rhi]
+
+# Adaptive Hough transform of the hits (xHits, yHits)
+# rRange, thetaRange: range of the Hough space, nR, nTheta: size of the coarse grid,
+# nLevels: number of refinements, factor: number of sub-cells of a cell along each axis
+# returns [rs, thetas, votes, hits]: the centers and the votes of the cells of the finest level with at least threshold votes,
+# by decreasing votes, and the list of the hit numbers voting for each of them.
+# The cell size is (rRange[1]-rRange[0])/(nR*factor**nLevels) x (thetaRange[1]-thetaRange[0])/(nTheta*factor**nLevels).
+def houghAdaptive(xHits, yHits, threshold, rRange, thetaRange=(-np.pi/2, np.pi/2), nR=16, nTheta=18, nLevels=4, factor=2):
+
+  x = np.asarray(xHits, dtype=float)
+  y = np.asarray(yHits, dtype=float)
+  dr = (rRange[1]-rRange[0])/nR
+  dt = (thetaRange[1]-thetaRange[0])/nTheta
+
+  # coarse grid: the r bins crossed by each hit in each theta column
+  t0 = thetaRange[0] + dt*np.arange(nTheta)
+  [rlo, rhi] = curveRange(x[:,np.newaxis], y[:,np.newaxis], t0, t0+dt)
+  first = np.clip(np.floor((rlo-rRange[0])/dr), 0, nR).astype(np.int64)
+  last = np.clip(np.floor((rhi-rRange[0])/dr)+1, 0, nR).astype(np.int64)
+  ihit = np.repeat(np.arange(len(x)), nTheta)
+  itheta = np.tile(np.arange(nTheta), len(x))
+  n = (last-first).ravel()
+  pairHit = np.repeat(ihit, n)
+  pairR = np.repeat(first.ravel(), n) + np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)
+  pairTheta = np.repeat(itheta, n)
+
+  # cells: lower r and theta index on the grid of the current level, and the (cell, hit) pairs
+  for level in range(nLevels+1):
+    cellOfPair = pairR*(nTheta*factor**level) + pairTheta
+    [cells, pairCell, votes] = np.unique(cellOfPair, return_inverse=True, return_counts=True)
+    keep = votes >= threshold
+    pairs = keep[pairCell]
+    pairHit, pairCell = pairHit[pairs], np.flatnonzero(keep).searchsorted(pairCell[pairs])
+    cells, votes = cells[keep], votes[keep]
+    nThetaLevel = nTheta*factor**level
+    cellR, cellTheta = cells//nThetaLevel, cells%nThetaLevel
+    if level == nLevels or len(cells) == 0: break
+
+    # split the cells above threshold: each (cell, hit) pair is tested on the factor x factor sub-cells
+    dr, dt = dr/factor, dt/factor
+    sub = np.arange(factor)
+    subR = (factor*cellR[pairCell])[:,np.newaxis,np.newaxis] + sub[np.newaxis,:,np.newaxis]
+    subTheta = (factor*cellTheta[pairCell])[:,np.newaxis,np.newaxis] + sub[np.newaxis,np.newaxis,:]
+    theta0 = thetaRange[0] + dt*subTheta
+    [rlo, rhi] = curveRange(x[pairHit][:,np.newaxis,np.newaxis], y[pairHit][:,np.newaxis,np.newaxis], theta0, theta0+dt)
+    r0 = rRange[0] + dr*subR
+    cross = (rlo < r0+dr) & (rhi >= r0)
+    [ipair, isubR, isubTheta] = np.nonzero(cross)
+    pairHit = pairHit[ipair]
+    pairR = subR[ipair, isubR, 0]
+    pairTheta = subTheta[ipair, 0, isubTheta]
+
+  order = np.argsort(-votes, kind='stable')
+  start = np.zeros(len(cells)+1, dtype=np.int64)
+  np.cumsum(np.bincount(pairCell, minlength=len(cells)), out=start[1:])
+  hitsByCell = pairHit[np.argsort(pairCell, kind='stable')]
+  hits = [np.sort(hitsByCell[start[k]:start[k+1]]) for k in order]
+  rs = rRange[0] + dr*(cellR[order]+0.5)
+  thetas = thetaRange[0] + dt*(cellTheta[order]+0.5)
+  return [rs, thetas, votes[order].astype(float), hits]
@@ -0,0 +1,116 @@
+## \file
+## \ingroup tutorial_kalmanFilter
+## Kalman Filter benchmark
+##
+## \macro_output
+## \macro_code
+
+import sys
+import csv
+import itertools
+import multiprocessing
+import resource
+import kalman_testbeam as kt
+
+# Throughput and physics performance of the test-beam tracking (kalman_testbeam.py)
+# =================
+# The simulation and the reconstruction are run over a grid of numberOfPlanes, noiseOccupancy, hitEfficiency
+# and numberOfEvents, for one or several tracking engines (settings of the tracker). Each point records:
+# * the events per second (wall time of the run) and the peak memory (resident set size of the process),
+# * the efficiency (tracks without noise hits over generated tracks) and the fake rate
+#   (tracks with noise hits, or hits of several particles, over reconstructed tracks),
+# * the agreement with the reference engine (the first engine of the point): the fraction of its tracks
+#   found with exactly the same hits.
+# Each point runs in a fresh process, with the same simulation seed for all engines, so the engines reconstruct
+# the same events and the memory and the cached constants of one point do not leak into the next.
+#
+#     import kalman_benchmark as kb
+#     rows = kb.benchmark(numberOfPlanes=[2, 3], noiseOccupancy=[1e-5, 1e-4])
+#     kb.printTable(rows)
+
+# tracking engines: name and settings; reco4 + globalChi2 (4 planes only) is the reference;
+# ckfFullGrid searches the same windows as ckfFull on the grid hit index instead of the sorted index
+engines = [("reco4", dict(useCKF=False)),
+           ("ckf", dict(useCKF=True)),
+           ("ckfFull", dict(useCKF=True, fullKalmanFilter=True)),
+           ("ckfFullGrid", dict(useCKF=True, fullKalmanFilter=True, hitIndex="grid"))]
+
+# settings of all points (no event display, no debug printout)
+baseSettings = dict(displayMode="off", lastDebugEvent=-1)
+
+columns = ["engine", "numberOfPlanes", "noiseOccupancy", "hitEfficiency", "numberOfEvents",
+           "eventsPerSecond", "wallTime", "peakMemoryMB", "efficiency", "fakeRate", "agreement"]
+
+# peak resident set size of this process (MB)
+def peakMemory():
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kB on Linux, bytes on macOS
+  return maxrss/(1024.*1024.) if sys.platform == "darwin" else maxrss/1024.
+
+# Simulate and reconstruct one point (in the process running it)
+# returns [row, events, hits]: the results of the point, and the event number and hits of each track
+def runPoint(cfg, seed):
+  sink = kt.run(cfg, outfile=None, seed=seed)
+  generated = sink.numberOfEvents*cfg.particlesPerEvent
+  summary = sink.summary()
+  row = {"numberOfPlanes": cfg.numberOfPlanes, "noiseOccupancy": cfg.noiseOccupancy, "hitEfficiency": cfg.hitEfficiency,
+         "numberOfEvents": sink.numberOfEvents, "eventsPerSecond": summary["eventsPerSecond"], "wallTime": summary["wallTime"],
+         "peakMemoryMB": peakMemory(),
+         "efficiency": sink.numberOfGoodReconstructedTracks/generated if generated>0 else 0.,
+         "fakeRate": 1.-sink.numberOfGoodReconstructedTracks/sink.numberOfReconstructedTracks if sink.numberOfReconstructedTracks>0 else 0.}
+  tracks = sink.trackTable()
+  return [row, tracks["event"].copy(), tracks["hits"].copy()]
+
+# fraction of the reference tracks (event numbers and hits) found with the same hits
+def agreement(reference, other):
+  refTracks = set((int(event), tuple(hits)) for event, hits in zip(*reference))
+  if len(refTracks)==0: return 1.
+  otherTracks = set((int(event), tuple(hits)) for event, hits in zip(*other))
+  return len(refTracks & otherTracks)/len(refTracks)
+
+# Run the grid of points, each value list giving one axis of the grid
+# engines: list of [name, settings], settings: the settings common to all points, seed: simulation seed
+# returns the list of the result rows (dictionaries with the columns)
+def benchmark(numberOfPlanes=[2, 3], noiseOccupancy=[0.00001, 0.0001], hitEfficiency=[0.97, 0.995],
+              numberOfEvents=[1000], engines=engines, settings={}, seed=12345):
+
+  rows = []
+  # one fresh process per point, run one after the other so that the timings do not interfere
+  with multiprocessing.get_context("fork").Pool(1, maxtasksperchild=1) as pool:
+    for point in itertools.product(numberOfPlanes, noiseOccupancy, hitEfficiency, numberOfEvents):
+      cfg = kt.TestbeamConfig(**dict(baseSettings, **settings))
+      cfg = cfg.replace(numberOfPlanes=point[0], noiseOccupancy=point[1], hitEfficiency=point[2], numberOfEvents=point[3])
+      reference = None
+      for [name, engineSettings] in engines:
+        # reco4 only reconstructs 4 planes
+        if engineSettings.get("useCKF", cfg.useCKF) is False and cfg.numberOfPlanes != 2: continue
+        [row, events, hits] = pool.apply(runPoint, (cfg.replace(**engineSettings), seed))
+        if reference is None: reference = [events, hits]
+        row["engine"] = name
+        row["agreement"] = agreement(reference, [events, hits])
+        rows.append(dict((column, row[column]) for column in columns))
+  return rows
+
+# Table of result rows (dictionaries with the same keys, also used by kalman_scan.py), one column per key
+def printTable(rows):
+  if len(rows)==0: return
+  names = list(rows[0])
+  print(" ".join("%15s" % name for name in names))
+  for row in rows:
+    print(" ".join("%15s" % (("%.4g" % row[name]) if isinstance(row[name], float) else row[name]) for name in names))
+
+def writeTable(rows, fileName):
+  if len(rows)==0: return
+  with open(fileName, "w", newline="") as f:
+    writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+    writer.writeheader()
+    for row in rows: writer.writerow(row)
+
+def main():
+  rows = benchmark()
+  printTable(rows)
+  writeTable(rows, "kf_benchmark.csv")
+  return rows
+
+if __name__ == "__main__":
+  rows = main()
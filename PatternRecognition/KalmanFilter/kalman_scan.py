@@ -0,0 +1,103 @@
+## \file
+## \ingroup tutorial_kalmanFilter
+## Kalman Filter parameter scan
+##
+## \macro_output
+## \macro_code
+
+import itertools
+import multiprocessing
+import kalman_testbeam as kt
+from kalman_benchmark import baseSettings, printTable, writeTable
+
+# Parameter scan of the test-beam tracking (kalman_testbeam.py)
+# =================
+# The scan runs the reconstruction for all the points of a grid of settings, e.g. to tune the chi2 cuts:
+#
+#     import kalman_scan as ks
+#     rows = ks.scan({"Cut1": [25., 50., 100.], "Cut3": [5., 7.5, 10.], "noiseOccupancy": [0.00001, 0.0001]},
+#                    settings=dict(numberOfEvents=2000))
+#     ks.printTable(rows)
+#
+# The events are simulated once per geometry, i.e. per set of values of the simulation settings in the grid
+# (noiseOccupancy above), in bulk, batchSize events at a time (Simulator.simulateEvents). The points which only differ
+# by reconstruction settings (Cut1 and Cut3 above) replay the same hits of each batch (StoredEvents), in parallel
+# in forked worker processes sharing the hits, and their counts are summed over the batches.
+# The resolution and multScattAngle settings are used by the simulation and by the reconstruction (error model):
+# to tune the values assumed by the reconstruction on the same simulated events, list them in recoOnly.
+# Each point records the efficiency (tracks without noise hits over generated tracks) and the purity
+# (tracks without noise hits over reconstructed tracks).
+
+# settings used by the simulation
+simulationSettings = ["numberOfEvents", "particlesPerEvent", "batchSeed", "numberOfPlanes", "spectrometerLength",
+                      "distBetweenPlanes", "pixelSize", "resolution", "tailAmplitude", "tailWidth", "multScattAngle",
+                      "thetaxz", "beamSpotSize", "noiseOccupancy", "hitEfficiency", "nparameters", "integralBdL",
+                      "magLength", "beamMomentum", "hitPrecision"]
+
+# the simulated hits of the current batch of events of the current geometry, inherited by the forked workers
+scanStore = None
+
+# counts of each point, summed over the batches
+countNames = ["numberOfEvents", "numberOfGoodReconstructedTracks", "numberOfReconstructedTracks", "wallTime"]
+
+# Reconstruct the events of scanStore with the settings cfg (in a worker process)
+# returns the counts of the point
+def runPoint(cfg):
+  sink = kt.ResultSink(cfg, outfile=None)
+  kt.processEvents(cfg, kt.StoredEvents(scanStore), kt.Tracker(cfg, sink), sink, 0, scanStore.nEvents)
+  counts = dict((name, getattr(sink, name)) for name in countNames[:-1])
+  counts["wallTime"] = sink.summary()["wallTime"]
+  return counts
+
+# the results of a point from its counts
+def pointResults(cfg, counts):
+  generated = counts["numberOfEvents"]*cfg.particlesPerEvent
+  good, reconstructed = counts["numberOfGoodReconstructedTracks"], counts["numberOfReconstructedTracks"]
+  return {"efficiency": good/generated if generated>0 else 0.,
+          "purity": good/reconstructed if reconstructed>0 else 0.,
+          "numberOfReconstructedTracks": reconstructed,
+          "eventsPerSecond": counts["numberOfEvents"]/counts["wallTime"] if counts["wallTime"]>0. else 0.}
+
+# Run all the points of the grid (setting name: list of values)
+# settings: the settings common to all points, recoOnly: simulation settings scanned for the reconstruction only,
+# nWorkers: number of worker processes (None: one per CPU), seed: simulation seed
+# returns the list of the result rows: the values of the grid settings, then the results
+def scan(grid, settings={}, recoOnly=[], nWorkers=None, seed=12345):
+
+  global scanStore
+  base = kt.TestbeamConfig(**dict(baseSettings, **settings))
+  names = list(grid)
+  points = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+  # the points of each geometry
+  geometries = {}
+  for k, point in enumerate(points):
+    geometry = tuple((name, point[name]) for name in names if name in simulationSettings and name not in recoOnly)
+    geometries.setdefault(geometry, []).append(k)
+
+  rows = len(points)*[None]
+  for geometry, ks in geometries.items():
+    cfg = base.replace(**dict(geometry))
+    simulator = kt.Simulator(cfg, seed)
+    configs = [base.replace(**points[k]) for k in ks]
+    totals = [dict((name, 0) for name in countNames) for k in ks]
+    # same batches of events as Simulator.events
+    for first in range(0, cfg.numberOfEvents, cfg.batchSize):
+      scanStore = simulator.simulateEvents(min(cfg.batchSize, cfg.numberOfEvents-first))
+      with multiprocessing.get_context("fork").Pool(nWorkers) as pool:
+        results = pool.map(runPoint, configs, chunksize=1)
+      for total, counts in zip(totals, results):
+        for name in countNames: total[name] += counts[name]
+    for k, pointCfg, total in zip(ks, configs, totals): rows[k] = dict(points[k], **pointResults(pointCfg, total))
+  scanStore = None
+  return rows
+
+def main():
+  rows = scan({"noiseOccupancy": [0.00001, 0.0001], "Cut1": [25., 100.], "Cut2": [25., 100.], "Cut3": [5., 7.5, 10.]},
+              settings=dict(numberOfEvents=2000))
+  printTable(rows)
+  writeTable(rows, "kf_scan.csv")
+  return rows
+
+if __name__ == "__main__":
+  rows = main()
@@ -10,6 +10,12 @@
 ## \author Lailin XU
 
 import os
+import copy
+import json
+import time
+import heapq
+import zipfile
+import multiprocessing
 from math import sqrt, fabs, tan, atan
 import ROOT as R
 import numpy as np
@@ -21,11 +27,11 @@ from numpy.linalg import inv
 # Useful references:
 # * [Track Reconstruction,  Peter Hansen Oct 2018 Tracking Lectures](https://indico.nbi.ku.dk/event/1090/sessions/2365/attachments/2696/3926/trackalgs2018.pdf)
 # * [Straight line track reconstruction for the ATLAS IBL testbeam with the EUDET telescope](https://cds.cern.ch/record/1708349)
-# 
+#
 # Demonstrate track fit method for a simple example of horizontal tracks
 # passing 4 or 6 pixel tracking planes along x, each measuring coordinates (y,z).
 # A spectrometer magnet is inserted the middle of the telescope.
-# Everything is in a Helium bag  
+# Everything is in a Helium bag
 
 # y is up
 # x=0, y=0, z=0 at the first plane.
@@ -46,218 +52,574 @@ from numpy.linalg import inv
 # ** Detector efficiency (not 100%, i.e., a true hit might not be seen by the detector)
 # ** Detector noise (apart from the true signal hits, random noise hits are added in each detector plane)
 # * Track finding with the Kalman Filter
-# ** Use hits from the first two planes as a track seed. All combinatorial track seeds are considered, including both true signal hits and noise hits.
+# ** Use hits from the first two planes as a track seed. All combinatorial track seeds compatible with the beam direction are considered, including both true signal hits and noise hits.
 # * Track fitting with a simple chi2 minimization
+#
+# The code can also be used as a library: importing it runs nothing.
+# A TestbeamConfig holds the settings and the geometry, a Simulator generates the events,
+# a Tracker reconstructs them and a ResultSink collects the counters, the histograms and the event displays:
+#
+#     import kalman_testbeam as kt
+#     cfg = kt.TestbeamConfig(numberOfEvents=1000, noiseOccupancy=0.0001)
+#     sink = kt.run(cfg, outfile=None)
+#     print(sink.numberOfGoodReconstructedTracks)
+#     sink.writeSummary("kf_summary.json")   # time per stage, cut flow and events per second
+#
+# The Kalman Filter constants and the global fit operators are cached per geometry,
+# so a parameter scan run in one process computes them only once.
 
 # Global settings and variables
 # =================
-## RUN CONFIGURATION
+class TestbeamConfig:
+
+  def __init__(self, **settings):
+    # all settings can be given as keyword arguments, e.g. TestbeamConfig(numberOfPlanes=3, noiseOccupancy=0.0001)
+
+    ## RUN CONFIGURATION
+    # =================
+    self.numberOfEvents=1        #number of events to be simulated
+    self.particlesPerEvent= 1    # number of beam particles crossing the telescope in one readout time window
+    self.batchSimulation=False   # simulate events in bulk with numpy (simulateEvents) instead of one by one
+    self.batchSize=   100000     # number of events simulated per batch
+    self.batchSeed=   12345      # seed of the numpy random generator used in batch mode
+    self.nWorkers=    1          # number of processes sharing the events (event-parallel processing)
+    self.displayMode= "first"    # which events to draw (hits and track candidates):
+                                 # "off", "first" (the first displayFirstN events), "random" (a fraction displayFraction of the events),
+                                 # "condition" (the events matching displayCondition)
+    self.displayFirstN=   10
+    self.displayFraction= 0.01
+    self.displayCondition= "rejected"  # "rejected" (best track rejected by Cut3), "noise" (a selected track with noise hits
+                                       # or hits of several particles),
+                                       # or a function f(evtIndex, rejected, noisy) returning True for the events to draw
+    self.displaySeed= 4321       # seed for the random sampling of the displayed events
+    self.numberOfPlanes=   2        #number of tracking planes on each side of magnet
+    self.Cut1=          100.        # cut on chisquared for first 3 hits
+    self.Cut2=          100.        # cut on chisquared for next hits
+    self.Cut3=          None        # cut on total chisquared (None: (4.*numberOfPlanes-5.)*2.5)
+    self.searchWindowSigma= None    # half width of the hit search window in units of the predicted residual error
+                                    # (None: sqrt(Cut1) or sqrt(Cut2), i.e. exactly the hits passing the chi2 cuts)
+    self.hitIndex=      "sorted"    # index of the hits for the window searches: "sorted" (binary search in the hits sorted by z)
+                                    # or "grid" (uniform 2D grid in y and z, for high occupancy)
+    self.gridCellSize=  None        # cell size of the "grid" hit index (cm) (None: about two hits per cell)
+    self.seedBatchSize= 256         # number of seeds extended together by the CKF (None: all the seeds of the event)
+    self.seedWindowSigma= 5.        # half width of the slope window of the seeds (hit pairs in planes 0 and 1) in units of
+                                    # the expected slope spread (None: all pairs)
+    self.seedProfileZ= False        # also take the seed hits of plane 0 in the beam profile in z (False: in y only)
+    self.maxSeedsPerHit= None       # max number of seeds of each hit in plane 0, the hits of plane 1 closest to the beam
+                                    # direction (None: no limit)
+    self.maxHitsPerBranch= None     # max number of hits of each plane tried on each track candidate, the closest to the
+                                    # predicted position in units of the search window (None: all the hits of the window)
+    self.useCKF=        True        # combinatorial Kalman filter for any number of planes (False: reco4, 4 planes only)
+    self.fullKalmanFilter= False    # combinatorial Kalman filter on the full state (z, z', y, y', 1/p) through the magnet,
+                                    # cutting on the chi2 of the z and y hits (False: z only)
+    self.momentumSpread= 0.2        # relative momentum spread accepted by the full Kalman filter at the first hit after the magnet
+    self.maxBranches=   None        # max number of track candidates kept per seed after each plane (None: no limit,
+                                    # so that with 4 planes the CKF selects the same tracks as reco4)
+    self.maxHoles=      0           # max number of planes without a hit on a track (the seed planes 0 and 1 always need a hit)
+    self.holeChi2=      9.          # chi2 penalty for each hole
+    self.maxTracksPerEvent= 1       # max number of tracks reconstructed per event (set it above particlesPerEvent
+                                    # for several particles per readout window)
+    self.globalFitTopK= None        # max number of candidates per event, ranked by their Kalman Filter chi2, given the global fit
+                                    # (None: no limit; with maxTracksPerEvent=1 only the candidates which can be selected are fitted)
+    self.beamMomentum=    0.05    # GeV
+
+    ## SPECTROMETER DESCRIPTION
+    # =================
+    self.spectrometerLength=30.   #(cm)
+    self.distBetweenPlanes= None  # (cm) (None: spectrometerLength/(2.*numberOfPlanes-1.))
+    self.pixelSize=  0.002       # (cm)
+    self.resolution=  float(0.0006)     #measurement resolution (cm)
+    self.tailAmplitude=   0.1     #probability of badly measured hit
+    self.tailWidth=   0.0018      #resolution of badly measured hit (cm)
+
+    # The multiple scattering times momentum per plane is estimated as follows
+    # Rl 50mu Si = 5.3e-4, Rl 50cm He Rl 8.8e-5
+    # multScattAngle=0.0175*sqrt(Rl)*(1+0.125*log(10Rl)/log(10))/sqrt(2)
+
+    self.multScattAngle= 0.0002  # effective theta0*E(GeV) (mult scatt) per plane
+    self.thetaxz=        0.0     # incident track angle in the xz plane
+    self.beamSpotSize=   0.0     # rms of the track impact (y and z) at the first plane (cm)
+
+    # There is an adjustable threshold with which we can get the noise occupancy
+    # as low is 10^-7, at a cost in the hit efficiency
+
+    self.noiseOccupancy=  0.000005  # noise probability in readout time window
+    self.hitEfficiency =  0.97    # probability for a track to make a hit
+                                            #  assume: noise=0.000001 eff=0.93
+                                            #                0.00001  eff=0.97
+                                            #                0.0001   eff=0.98
+                                            #                0.001    eff=0.995
+
+    self.nparameters=         5    # IMPORTANT: set equal to 5 if the field is on to check momentum.
+
+    self.integralBdL=     0.5    # Tesla*cm
+    self.magLength=       10.    # cm
+
+    ## RECONSTRUCTION DATA
+    # =================
+    self.hitPrecision=np.float64        # Floating point type of the stored hit coordinates (np.float32 halves the memory)
+    self.trackOutput= "tree"            # per-track output: "tree" (TTree "tracks" in the output file),
+                                        # "npz" (file <output file>_tracks.npz, see readTracks) or None
+    self.trackChunkSize= 10000          # number of tracks buffered before they are written (and histogrammed)
+    self.summaryFile= None              # JSON file receiving the run summary (time per stage, cut flow, throughput),
+                                        # see ResultSink.summary (None: not written)
+
+    self.debug=False                       #debug flag, switched on by the event loop for the events below
+    self.firstDebugEvent=0
+    self.lastDebugEvent=20
+
+    for name, value in settings.items(): self.set(name, value)
+
+  def set(self, name, value):
+    if name.startswith("_") or not hasattr(self, name): raise AttributeError("unknown setting "+name)
+    setattr(self, name, value)
+
+  # a copy of this configuration with some settings changed, e.g. for a parameter scan
+  def replace(self, **settings):
+    cfg = copy.copy(self)
+    for name, value in settings.items(): cfg.set(name, value)
+    return cfg
+
+  # derived quantities, unless set explicitly
+  @property
+  def Cut3(self):
+    if self._Cut3 is None: return (4.*self.numberOfPlanes-5.)*2.5
+    return self._Cut3
+
+  @Cut3.setter
+  def Cut3(self, value):
+    self._Cut3 = value
+
+  @property
+  def distBetweenPlanes(self):
+    if self._distBetweenPlanes is None: return self.spectrometerLength/(2.*self.numberOfPlanes-1.)
+    return self._distBetweenPlanes
+
+  @distBetweenPlanes.setter
+  def distBetweenPlanes(self, value):
+    self._distBetweenPlanes = value
+
+  # geometry
+  @property
+  def xHits(self):
+    # Distances (x) from first plane
+    return [self.distBetweenPlanes*i for i in range(2*self.numberOfPlanes)]
+
+  @property
+  def ySize(self):
+    # Half height of chip
+    return [2. if i>self.numberOfPlanes-1 else 1. for i in range(2*self.numberOfPlanes)]
+
+  @property
+  def zSize(self):
+    # Half width of chip
+    return (2*self.numberOfPlanes)*[1.]
+
+## High occupancy stress test
+#
+# The noise occupancy can be raised to 1e-3 - 1e-2, i.e. up to about 10000 noise hits per event
+# in the 500x500 pixel area around the beam. At the default beam momentum (0.05 GeV) the multiple scattering
+# windows cover most of this area, so the cost is the number of seeds and of (branch, hit) candidates,
+# not the hit search. The stress test settings bound them:
+# * the seed hits of plane 0 are taken in the beam profile in y and in z (seedProfileZ),
+#   and each keeps its 20 partners in plane 1 closest to the beam direction (maxSeedsPerHit),
+# * the chi2 cuts, hence the search windows, are 5 sigma (Cut1, Cut2), and each track candidate tries only
+#   its 5 closest hits in each plane (maxHitsPerBranch) and keeps its 5 best branches (maxBranches),
+# * the events are simulated in bulk, the hits are searched in y and z windows (full Kalman filter)
+#   on the grid hit index (hitIndex="grid"), and no events are drawn or printed.
+# The processing time is then about 5 ms per event at 1e-3 and 20-30 ms per event at 1e-2:
+#
+#     cfg = kt.stressTestConfig(0.01, numberOfEvents=100)
+#     sink = kt.run(cfg, outfile=None)
+#
+# The stress test measures the throughput. It does not give a useful efficiency at the default momentum:
+# the noise hits closer to the prediction than the scattered track hits take the place of the track hits,
+# and hardly any track is found without noise hits above an occupancy of 1e-4 (30% at 1e-4).
+# At beamMomentum=1. the efficiency is about 80% at 1e-3 and 45% at 1e-2.
+# Once the candidates are bounded, the grid index is about as fast as the sorted index (hitIndex="sorted");
+# kalman_benchmark.py compares the two.
+def stressTestConfig(noiseOccupancy=0.001, **settings):
+  cfg = TestbeamConfig(noiseOccupancy=noiseOccupancy, batchSimulation=True, fullKalmanFilter=True, hitIndex="grid",
+                       seedProfileZ=True, maxSeedsPerHit=20, Cut1=25., Cut2=25., maxHitsPerBranch=5, maxBranches=5,
+                       displayMode="off", lastDebugEvent=-1)
+  for name, value in settings.items(): cfg.set(name, value)
+  return cfg
+
+# Hit storage
 # =================
+#
+# The hits of many events are stored in a few contiguous arrays (compressed sparse row layout):
+# the coordinates y and z, the MC truth flag noise, the MC truth particle number (-1 for noise hits)
+# and the flag used (hit already assigned to a track).
+# The hits are ordered by plane, then by event: the hits of event k in plane j are the entries
+# offsets[j*nEvents+k] to offsets[j*nEvents+k+1]-1 of these arrays.
+class HitStore:
+
+  def __init__(self, y, z, noise, offsets, nEvents, hitPrecision=np.float64, particle=None):
+    self.y = np.ascontiguousarray(y, dtype=hitPrecision)
+    self.z = np.ascontiguousarray(z, dtype=hitPrecision)
+    self.noise = np.ascontiguousarray(noise, dtype=bool)
+    # without particle numbers, all signal hits of an event belong to the same particle
+    if particle is None: particle = np.where(self.noise, -1, 0)
+    self.particle = np.ascontiguousarray(particle, dtype=np.int32)
+    self.used = np.zeros(len(self.y), dtype=bool)
+    self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    self.nEvents = nEvents
+    self.nplane = (len(self.offsets)-1)//nEvents
+    # MC truth track impact (y, z) at the first plane of each particle of each event
+    self.start = np.zeros((nEvents, 1, 2))
+
+  # Build the store from per-plane arrays, where the hits of event k in plane j
+  # are yPlanes[j][offsetPlanes[j][k]:offsetPlanes[j][k+1]] (same for z, the noise flag and the particle number)
+  @classmethod
+  def fromPlanes(cls, yPlanes, zPlanes, noisePlanes, offsetPlanes, hitPrecision=np.float64, particlePlanes=None):
+    nEvents = len(offsetPlanes[0])-1
+    start = np.cumsum([0]+[len(yPlane) for yPlane in yPlanes])
+    offsets = np.concatenate([offsetPlanes[j][:-1]+start[j] for j in range(len(yPlanes))] + [start[-1:]])
+    particle = None if particlePlanes is None else np.concatenate(particlePlanes)
+    return cls(np.concatenate(yPlanes), np.concatenate(zPlanes), np.concatenate(noisePlanes), offsets, nEvents, hitPrecision, particle)
+
+  # first and last+1 hit of event ievt in plane j
+  def hitRange(self, ievt, j):
+    k = j*self.nEvents+ievt
+    return self.offsets[k], self.offsets[k+1]
+
+  # number of hits per plane and event, shape (nplane, nEvents)
+  def nHits(self):
+    return np.diff(self.offsets).reshape(self.nplane, self.nEvents)
+
+  def event(self, ievt):
+    return EventHits(self, ievt)
+
+# The hits of one event: y[j], z[j], noise[j], particle[j] and used[j] are views (not copies)
+# on the hits in plane j in the HitStore, so flagging a hit as used updates the store
+class EventHits:
+
+  def __init__(self, store, ievt):
+    self.y, self.z, self.noise, self.particle, self.used = [], [], [], [], []
+    for j in range(store.nplane):
+      first, last = store.hitRange(ievt, j)
+      self.y.append(store.y[first:last])
+      self.z.append(store.z[first:last])
+      self.noise.append(store.noise[first:last])
+      self.particle.append(store.particle[first:last])
+      self.used.append(store.used[first:last])
+    self.start = store.start[ievt]
+
+  def nHits(self, j):
+    return len(self.y[j])
+
+  # MC truth particle of a track with hit number ihits[j] in plane j (-1 for a hole),
+  # -1 if the track has a noise hit or hits from several particles
+  def trackParticle(self, ihits):
+    particles = set(int(self.particle[j][ihits[j]]) for j in range(len(ihits)) if ihits[j]>=0)
+    if len(particles)!=1: return -1
+    return particles.pop()
 
-rdm = R.TRandom3()
-numberOfEvents=1        #number of events to be simulated 
-numberOfPlanes=   2        #number of tracking planes on each side of magnet
-Cut1=          100.        # cut on chisquared for first 3 hits
-Cut2=          100.        # cut on chisquared for next hits
-Cut3= (4.*numberOfPlanes-5.)*2.5 # cut on total chisquared
-beamMomentum=    0.05    # GeV
-
-## SPECTROMETER DESCRIPTION
+# Event simulation
 # =================
-spectrometerLength=30.   #(cm)
-distBetweenPlanes= spectrometerLength/(2.*numberOfPlanes-1.)
-pixelSize=  0.002       # (cm)
-resolution=  float(0.0006)     #measurement resolution (cm)
-tailAmplitude=   0.1     #probability of badly measured hit
-tailWidth=   0.0018      #resolution of badly measured hit (cm)
-
-# The multiple scattering times momentum per plane is estimated as follows
-# Rl 50mu Si = 5.3e-4, Rl 50cm He Rl 8.8e-5
-# multScattAngle=0.0175*sqrt(Rl)*(1+0.125*log(10Rl)/log(10))/sqrt(2)
-
-multScattAngle= 0.0002  # effective theta0*E(GeV) (mult scatt) per plane
-thetaxz=        0.0     # incident track angle in the xz plane
-
-# There is an adjustable threshold with which we can get the noise occupancy
-# as low is 10^-7, at a cost in the hit efficiency
-
-noiseOccupancy=  0.000005  # noise probability in readout time window
-hitEfficiency =  0.97    # probability for a track to make a hit
-                                        #  assume: noise=0.000001 eff=0.93
-                                        #                0.00001  eff=0.97
-                                        #                0.0001   eff=0.98
-                                        #                0.001    eff=0.995
+# The simulator owns its random number generators: a TRandom3 for the event by event simulation
+# and a numpy generator for the batch mode.
+# seed: None for the default streams, or an int or a numpy SeedSequence for independent,
+# reproducible streams (e.g. one per worker process)
+class Simulator:
+
+  def __init__(self, cfg, seed=None):
+    self.cfg = cfg
+    self.rdm = R.TRandom3()
+    if seed is None:
+      self.rng = np.random.default_rng(cfg.batchSeed)
+    else:
+      if not isinstance(seed, np.random.SeedSequence): seed = np.random.SeedSequence(seed)
+      [rootSeq, numpySeq] = seed.spawn(2)
+      self.rng = np.random.default_rng(numpySeq)
+      self.rdm.SetSeed(int(rootSeq.generate_state(1)[0]) or 1)
+
+    ## Generate hits in detector planes
+    #
+    # hits of the simulated event, per plane
+    nplane = 2*cfg.numberOfPlanes
+    self.ySim=nplane*[[]]
+    self.zSim=nplane*[[]]
+    self.noiseSim=nplane*[[]]
+    self.particleSim=nplane*[[]]
+    self.startSim=[]
+
+  # propagate from one plane to the next in a field free region (a simple straight line)
+  # particle: number of the beam particle in the event; the noise hits are added with the first particle
+  def propagateStraight(self, firstplane, nextY, nextZ, nextdYdX, nextdZdX, particle=0):
+
+    cfg, rdm = self.cfg, self.rdm
+    distBetweenPlanes, beamMomentum, multScattAngle = cfg.distBetweenPlanes, cfg.beamMomentum, cfg.multScattAngle
+    resolution, tailAmplitude, tailWidth = cfg.resolution, cfg.tailAmplitude, cfg.tailWidth
+    ySize, zSize = cfg.ySize, cfg.zSize
+
+    for j in range(firstplane, firstplane+cfg.numberOfPlanes):
+      if(cfg.debug): print(" propagating track. Now at plane ", j)
+      nh=0
+      y,z,r=0.,0.,0.
+
+      # track impact in first plane
+      if j==firstplane:
+        y=nextY
+        z=nextZ
+      else:
+      # track impact in first plane
+        nextY+=distBetweenPlanes*nextdYdX
+        nextZ+=distBetweenPlanes*nextdZdX
+        y=nextY
+        z=nextZ
+
+      # add multiple scattering
+      r=rdm.Gaus()/beamMomentum
+      nextdYdX+=(r*multScattAngle)           # update angle due to MS
+      r=rdm.Gaus()/beamMomentum
+      nextdZdX+=(r*multScattAngle)           # update angle due to MS
+      if(cfg.debug): print(" track y z at plane ", j, " ", y, " ", z, " angles " , nextdYdX, " ", nextdZdX)
+
+      # To take into account the detector efficiency
+      r=rdm.Uniform()
+
+      # If this gives a hit
+      if (r<cfg.hitEfficiency and fabs(nextY)<ySize[j] and fabs(nextZ)<zSize[j]):
+        # then smear y impact by resolution
+        r1=rdm.Gaus()
+        y+=r1*resolution
+
+        # sometimes give extra smear
+        r1=rdm.Uniform()
+        if(r1<tailAmplitude):
+          # extra smear (resolution tail)
+          r2=rdm.Gaus()
+          y+=r2*tailWidth
+
+        # then smear z impact by resolution
+        r3=rdm.Gaus()
+        z+=r3*resolution
+        # do we need extra smear?
+        r3=rdm.Uniform()
+        if(r3<tailAmplitude):
+          # extra smear (resolution tail)
+          r2=rdm.Gaus()
+          z+=r2*tailWidth
+
+        # update vector of y coords in plane j
+        self.ySim[j].append(y)
+        # update vector of z coords in plane j
+        self.zSim[j].append(z)
+
+        if(cfg.debug): print(" hit ", nh, " at plane ", j, " y " , y , " z " , z , " expect y z ", nextY , " " , nextZ)
+
+        # update noise flag
+        self.noiseSim[j].append(0)
+        self.particleSim[j].append(particle)
+        nh+=1
 
-nparameters=         5    # IMPORTANT: set equal to 5 if the field is on to check momentum.
+      # add noise to 500x500 pixel area ( around real hit ), once per event
+      if(particle>0): continue
+      noise=rdm.Poisson(250000*cfg.noiseOccupancy)
+      if(noise>0):
+        for k in range(noise):
+          r=rdm.Uniform()                  # placement of noise hit
+          ynoise= y+(r-0.5)*(500.*cfg.pixelSize)
+          r=rdm.Uniform()
+          znoise= z+(r-0.5)*(500.*cfg.pixelSize)
+
+          self.ySim[j].append(ynoise)           # update vector of y coords
+          self.zSim[j].append(znoise)           # update vector of z coords
+          self.noiseSim[j].append(1)            # update truth flag
+          self.particleSim[j].append(-1)
+          nh+=1
+
+    return [nextY, nextZ, nextdYdX, nextdZdX]
+
+  ## Simulate the whole track
+  #
+  # (straight tracks hiting plans before the magnet, then through the magnent, then straight tracks through the plans after the magnet)
+  # one track for each of the particlesPerEvent beam particles, all starting on the beam axis;
+  # returns the hits as a HitStore with one event
+  def propagateTrack(self):
+
+    cfg = self.cfg
+    numberOfPlanes = cfg.numberOfPlanes
+    for j in range(2*numberOfPlanes):
+      self.ySim[j]=[]
+      self.zSim[j]=[]
+      self.noiseSim[j]=[]
+      self.particleSim[j]=[]
+    self.startSim=[]
+
+    for particle in range(cfg.particlesPerEvent): self.propagateParticle(particle)
+
+    store = HitStore.fromPlanes([np.array(self.ySim[j]) for j in range(2*numberOfPlanes)],
+                                [np.array(self.zSim[j]) for j in range(2*numberOfPlanes)],
+                                [np.array(self.noiseSim[j], dtype=bool) for j in range(2*numberOfPlanes)],
+                                [np.array([0, len(self.ySim[j])]) for j in range(2*numberOfPlanes)],
+                                cfg.hitPrecision,
+                                [np.array(self.particleSim[j], dtype=np.int32) for j in range(2*numberOfPlanes)])
+    store.start = np.array(self.startSim).reshape(1, cfg.particlesPerEvent, 2)
+    return store
+
+  def propagateParticle(self, particle):
+
+    cfg = self.cfg
+    numberOfPlanes, distBetweenPlanes = cfg.numberOfPlanes, cfg.distBetweenPlanes
+
+    # start at plane 0
+    nextY=0.
+    nextdYdX=0.
+    nextZ=0.
+    nextdZdX=cfg.thetaxz
+    if(cfg.beamSpotSize>0.):
+      nextY=self.rdm.Gaus()*cfg.beamSpotSize
+      nextZ=self.rdm.Gaus()*cfg.beamSpotSize
+    self.startSim.append([nextY, nextZ])
+
+    # propagate track through the planes before the magnet
+    [nextY, nextZ, nextdYdX, nextdZdX] = self.propagateStraight(0,nextY,nextZ,nextdYdX,nextdZdX,particle)
+
+    #Trace through magnet (to a good approximation),
+    dtheta=0.003*cfg.integralBdL/cfg.beamMomentum
+    #from plane 1 to the magnet center
+    nextY+=(nextdYdX*distBetweenPlanes/2.)
+    ang=atan(nextdYdX)+dtheta
+    #and on to the next plane
+    nextY+=(tan(ang)*distBetweenPlanes/2.)
+
+    # update angle
+    nextdYdX=tan(ang)
+    nextZ+=(distBetweenPlanes*nextdZdX)
+
+    # propagate track through the planes after the magnet
+    [nextY, nextZ, nextdYdX, nextdZdX] = self.propagateStraight(numberOfPlanes,nextY,nextZ,nextdYdX,nextdZdX,particle)
+
+  ## Simulate many events at once (batch mode)
+  #
+  # Same detector model as propagateTrack(), but all random numbers are drawn in bulk with numpy
+  # for the nEvents*particlesPerEvent tracks at a time, plane by plane.
+  # Returns the hits as a HitStore; in each plane the signal hits of an event (if any) come first,
+  # in particle order, followed by the noise hits.
+  def simulateEvents(self, nEvents):
+
+    cfg, rng = self.cfg, self.rng
+    numberOfPlanes, distBetweenPlanes, beamMomentum = cfg.numberOfPlanes, cfg.distBetweenPlanes, cfg.beamMomentum
+    resolution, tailAmplitude, tailWidth = cfg.resolution, cfg.tailAmplitude, cfg.tailWidth
+    ySize, zSize = cfg.ySize, cfg.zSize
+    nplane = 2*numberOfPlanes
+    # track number t is particle t%nParticles of event t//nParticles
+    nParticles = cfg.particlesPerEvent
+    nTracks = nEvents*nParticles
+
+    # track state at the current plane, one entry per track
+    nextY = np.zeros(nTracks)
+    nextZ = np.zeros(nTracks)
+    nextdYdX = np.zeros(nTracks)
+    nextdZdX = np.full(nTracks, cfg.thetaxz)
+    if cfg.beamSpotSize > 0.:
+      nextY = rng.standard_normal(nTracks)*cfg.beamSpotSize
+      nextZ = rng.standard_normal(nTracks)*cfg.beamSpotSize
+    start = np.stack([nextY, nextZ], axis=1).reshape(nEvents, nParticles, 2)
+
+    # kick from the magnet
+    dtheta = 0.003*cfg.integralBdL/beamMomentum
+    # average number of noise hits in the 500x500 pixel area
+    meanNoise = 250000*cfg.noiseOccupancy
+
+    yStore, zStore, noiseStore, particleStore, offsets = [], [], [], [], []
+    for j in range(nplane):
+      if j == numberOfPlanes:
+        # trace through the magnet, from the last plane before it to the first plane after it
+        nextY += nextdYdX*distBetweenPlanes/2.
+        ang = np.arctan(nextdYdX)+dtheta
+        nextY += np.tan(ang)*distBetweenPlanes/2.
+        nextdYdX = np.tan(ang)
+        nextZ += distBetweenPlanes*nextdZdX
+      elif j > 0:
+        nextY += distBetweenPlanes*nextdYdX
+        nextZ += distBetweenPlanes*nextdZdX
+
+      # track impact in this plane
+      y = nextY.copy()
+      z = nextZ.copy()
+
+      # add multiple scattering
+      nextdYdX += rng.standard_normal(nTracks)/beamMomentum*cfg.multScattAngle
+      nextdZdX += rng.standard_normal(nTracks)/beamMomentum*cfg.multScattAngle
+
+      # detector efficiency and acceptance
+      hit = (rng.random(nTracks) < cfg.hitEfficiency) & (np.abs(y) < ySize[j]) & (np.abs(z) < zSize[j])
+
+      # smear by the resolution, sometimes with an extra smear (resolution tail)
+      ySmear = y + rng.standard_normal(nTracks)*resolution
+      ySmear += (rng.random(nTracks) < tailAmplitude)*rng.standard_normal(nTracks)*tailWidth
+      zSmear = z + rng.standard_normal(nTracks)*resolution
+      zSmear += (rng.random(nTracks) < tailAmplitude)*rng.standard_normal(nTracks)*tailWidth
+
+      # noise hits are placed around the (measured) impact point of the first particle of the event
+      yCenter = np.where(hit, ySmear, y)[::nParticles]
+      zCenter = np.where(hit, zSmear, z)[::nParticles]
+      nNoise = rng.poisson(meanNoise, nEvents)
+
+      # fill the hit arrays of this plane: first the signal hits, then the noise hits of each event
+      hitEvent = hit.reshape(nEvents, nParticles)
+      nSignal = hitEvent.sum(axis=1)
+      nHits = nSignal + nNoise
+      offset = np.zeros(nEvents+1, dtype=np.int64)
+      np.cumsum(nHits, out=offset[1:])
+      yPlane = np.empty(offset[-1])
+      zPlane = np.empty(offset[-1])
+      noisePlane = np.ones(offset[-1], dtype=bool)
+      particlePlane = np.full(offset[-1], -1, dtype=np.int32)
+
+      # position of each signal hit within its event
+      rank = (np.cumsum(hitEvent, axis=1) - 1).ravel()
+      itrk = np.flatnonzero(hit)
+      isig = offset[:-1][itrk//nParticles] + rank[itrk]
+      yPlane[isig] = ySmear[hit]
+      zPlane[isig] = zSmear[hit]
+      noisePlane[isig] = False
+      particlePlane[isig] = itrk%nParticles
+
+      nNoiseTotal = nNoise.sum()
+      ievt = np.repeat(np.arange(nEvents), nNoise)
+      # position of each noise hit within its event
+      ipos = np.arange(nNoiseTotal) - np.repeat(np.cumsum(nNoise)-nNoise, nNoise)
+      inoise = offset[:-1][ievt] + nSignal[ievt] + ipos
+      yPlane[inoise] = yCenter[ievt] + (rng.random(nNoiseTotal)-0.5)*(500.*cfg.pixelSize)
+      zPlane[inoise] = zCenter[ievt] + (rng.random(nNoiseTotal)-0.5)*(500.*cfg.pixelSize)
+
+      yStore.append(yPlane)
+      zStore.append(zPlane)
+      noiseStore.append(noisePlane)
+      particleStore.append(particlePlane)
+      offsets.append(offset)
+
+    store = HitStore.fromPlanes(yStore, zStore, noiseStore, offsets, cfg.hitPrecision, particleStore)
+    store.start = start
+    return store
+
+  # Generator of the hits (EventHits) of nEvents simulated events, one event at a time.
+  # In batch mode the events are simulated batchSize at a time.
+  def events(self, nEvents):
+    if self.cfg.batchSimulation:
+      for first in range(0, nEvents, self.cfg.batchSize):
+        store = self.simulateEvents(min(self.cfg.batchSize, nEvents-first))
+        for k in range(store.nEvents): yield store.event(k)
+    else:
+      for k in range(nEvents): yield self.propagateTrack().event(0)
 
-integralBdL=     0.5    # Tesla*cm
-magLength=       10.    # cm
+# Replay of the events of a HitStore, in place of a Simulator in processEvents:
+# events simulated once (e.g. with simulateEvents) are reconstructed with different settings.
+# The hits are flagged as unused first, so each reconstruction starts from the same hits.
+class StoredEvents:
 
-xHits=(2*numberOfPlanes)*[0.]    # Distances (x) from first plane
-ySize=(2*numberOfPlanes)*[0.]         # Half height of chip
-zSize=(2*numberOfPlanes)*[0.]         # Half width of chip
+  def __init__(self, store):
+    self.store = store
 
-## RECONSTRUCTION DATA
-# =================
-yHits=(2*numberOfPlanes)*[[]]  # Measurement coordinates (y) of hits
-zHits=(2*numberOfPlanes)*[[]]  # Measurement coordinates (z) of hits
-tracks=15*[[]]                 # Info about each reconstructed track
-#tracks[0] vector of z-intercept with plane 0
-#tracks[1] vector of dz/dx at plane 0
-#tracks[2] vector of y-intercept with plane 0
-#tracks[3] vector of dy/dx at plane 0
-#tracks[4] vector of 1/p
-#tracks[5]-tracks[9] same, but truth
-#tracks[10]-tracks[14] errors on the parameters
-#Allthough there is room for 15 tracks,
-#for now these vectors have only one element. Only one track allowed.
-
-isNoise=(2*numberOfPlanes)*[0.] # MC truth flag for each hit
-
-debug=False                       #debug flag
-firstDebugEvent=0
-lastDebugEvent=20
-
-# counts
-numberOfReconstructedTracks=0
-numberOfGoodReconstructedTracks=0
-nTotalHits=                 0
-nNoiseHitsOnTrack=          0
-numberOfInefficientTracks=0
-numberOfRejectedTracks=0
-numberOfGoodRejectedTracks=0
-
-# Book histograms
-fout2 = R.TFile("kf_result.root", "RECREATE")
-h1 = R.TH1F("h1","y0 residuals",100,-.005,.005)
-h2 = R.TH1F("h2","z0 residuals",100,-.005,.005)
-h3 = R.TH1F("h3","ty residuals",100,-.025,.025)
-h4 = R.TH1F("h4","tz residuals",100,-.025,.025)
-h5 = R.TH1F("h5","1/p residuals",100,-1./beamMomentum,1./beamMomentum)
-h6 = R.TH1F("h6","y0 pull",100,-10.,10.)
-h7 = R.TH1F("h7","z0 pull",100,-10.,10.)
-h8 = R.TH1F("h8"," ty pull ",100,-10.,10.)
-h9 = R.TH1F("h9"," tz pull ",100,-10.,10.)
-h10 = R.TH1F("h10"," 1/p pull ",100,-10.,10.)
-h11 = R.TH1F("h11"," z chisquared at plane 2 ",80,0.,24.)
-h12 = R.TH1F("h12"," z chisquared at plane 3 ",80,0.,24.)
-h13 = R.TH1F("h13"," total chisquared ",80,0.,24.)
-h14 = R.TH1F("h14"," total chisquared ",80,0.,24.)
-h15 = R.TH1F("h15"," z chisquared at plane 4",80,0.,24.)
-h16 = R.TH1F("h16"," z chisquared at plane 5",80,0.,24.)
-
-# Event simulation
-# =================
-## Generate hits in detector planes
-#
-# propagate from one plane to the next in a field free region (a simple straight line)
-def propagateStraight(firstplane, nextY, nextZ, nextdYdX, nextdZdX):
-  
-  for j in range(firstplane, firstplane+numberOfPlanes):
-    if(debug): print(" propagating track. Now at plane ", j)
-    nh=0
-    y,z,r=0.,0.,0.
-
-    # track impact in first plane
-    if j==firstplane:  
-      y=nextY
-      z=nextZ
-    else:
-    # track impact in first plane
-      nextY+=distBetweenPlanes*nextdYdX
-      nextZ+=distBetweenPlanes*nextdZdX
-      y=nextY
-      z=nextZ
-    
-    # add multiple scattering      
-    r=rdm.Gaus()/beamMomentum
-    nextdYdX+=(r*multScattAngle)           # update angle due to MS
-    r=rdm.Gaus()/beamMomentum
-    nextdZdX+=(r*multScattAngle)           # update angle due to MS
-    if(debug): print(" track y z at plane ", j, " ", y, " ", z, " angles " , nextdYdX, " ", nextdZdX)
-    
-    # To take into account the detector efficiency
-    r=rdm.Uniform()
- 
-    # If this gives a hit
-    if (r<hitEfficiency and fabs(nextY)<ySize[j] and fabs(nextZ)<zSize[j]): 
-      # then smear y impact by resolution
-      r1=rdm.Gaus()
-      y+=r1*resolution                     
-
-      # sometimes give extra smear
-      r1=rdm.Uniform()                     
-      if(r1<tailAmplitude):
-        # extra smear (resolution tail)
-        r2=rdm.Gaus()
-        y+=r2*tailWidth                        
-
-      # then smear z impact by resolution
-      r3=rdm.Gaus()
-      z+=r3*resolution
-      # do we need extra smear?
-      r3=rdm.Uniform()                      
-      if(r3<tailAmplitude):
-        # extra smear (resolution tail)
-        r2=rdm.Gaus()
-        z+=r2*tailWidth                       
-
-      # update vector of y coords in plane j
-      yHits[j].append(y)
-      # update vector of z coords in plane j
-      zHits[j].append(z)
-
-      if(debug): print(" hit ", nh, " at plane ", j, " y " , y , " z " , z , " expect y z ", nextY , " " , nextZ)
-
-      # update noise flag
-      isNoise[j].append(0) 
-      nh+=1
-
-    # add noise to 500x500 pixel area ( around real hit )
-    noise=rdm.Poisson(250000*noiseOccupancy)
-    if(noise>0):
-      for k in range(noise):
-        r=rdm.Uniform()                  # placement of noise hit
-        ynoise= y+(r-0.5)*(500.*pixelSize)
-        r=rdm.Uniform()
-        znoise= z+(r-0.5)*(500.*pixelSize)
-
-        yHits[j].append(ynoise)          # update vector of y coords
-        zHits[j].append(znoise)          # update vector of z coords
-        isNoise[j].append(1)             # update truth flag
-        nh+=1
+  def events(self, nEvents):
+    self.store.used[:] = False
+    for k in range(nEvents): yield self.store.event(k)
 
-  return [nextY, nextZ, nextdYdX, nextdZdX]
- 
-## Simulate the whole track 
-#
-# (straight tracks hiting plans before the magnet, then through the magnent, then straight tracks through the plans after the magnet)
-def propagateTrack():
-
-  # start at plane 0
-  nextY=0.
-  nextdYdX=0.
-  nextZ=0.
-  nextdZdX=thetaxz
-
-  # propagate track through the planes before the magnet
-  [nextY, nextZ, nextdYdX, nextdZdX] = propagateStraight(0,nextY,nextZ,nextdYdX,nextdZdX)
-
-  #Trace through magnet (to a good approximation),
-  dtheta=0.003*integralBdL/beamMomentum
-  #from plane 1 to the magnet center
-  nextY+=(nextdYdX*distBetweenPlanes/2.)             
-  ang=atan(nextdYdX)+dtheta
-  #and on to the next plane
-  nextY+=(tan(ang)*distBetweenPlanes/2.)             
-
-  # update angle
-  nextdYdX=tan(ang)                                  
-  nextZ+=(distBetweenPlanes*nextdZdX)
-
-  # propagate track through the planes after the magnet
-  [nextY, nextZ, nextdYdX, nextdZdX] = propagateStraight(numberOfPlanes,nextY,nextZ,nextdYdX,nextdZdX)
-  
 # Kalman Filter
 # =================
 
@@ -356,303 +718,628 @@ def propagateTrack():
 # W_{k|k-1} = C_{k|k-1}^{-1}
 # $$
 
-def kalmanFilter(p1, ihit, z, C):
-  # Propagates a track candidate from detector plane p1-1 to detector plane p1
-  # as a straight line in x-z (the non-bending plane)
-  # updates the track parameters and their error matrix in x-z
-  # returns the chisquared at detector plane p1 for hit number ihit in this plane
-
-  import ROOT as R
- 
-  s2=resolution*resolution
-  #use here a fixed momentum estimate
-  pinv = 1./beamMomentum 
-  #average multiple scattering angle
-  t0=multScattAngle*pinv 
-  #propagator F to next plane
-  Fz = np.zeros(shape=(2,2))
-  FTz = np.zeros(shape=(2,2))
-  Fz[0][0]=1
-  Fz[0][1]=distBetweenPlanes
-  Fz[1][0]=0
-  Fz[1][1]=0
-
-  #the transpose of F
-  FTz=np.transpose(Fz)
-
-  #multiple scattering contribution to covariance of extrapolation
-  Qz = np.zeros(shape=(2,2))
-
-  Qz[0][0]=t0*t0*distBetweenPlanes*distBetweenPlanes
-  Qz[0][1]=t0*t0*distBetweenPlanes
-  Qz[1][0]=t0*t0*distBetweenPlanes
-  Qz[1][1]=t0*t0
+
+# The propagator, the multiple scattering and the measurement weight only depend on the geometry,
+# so they are computed once and cached (for all configurations with the same geometry)
+kalmanCache = {}
+
+def kalmanConstants(cfg):
+  key = (cfg.resolution, cfg.beamMomentum, cfg.multScattAngle, cfg.distBetweenPlanes)
+  if key not in kalmanCache:
+    [resolution, beamMomentum, multScattAngle, distBetweenPlanes] = key
+    s2=resolution*resolution
+    #use here a fixed momentum estimate
+    pinv = 1./beamMomentum
+    #average multiple scattering angle
+    t0=multScattAngle*pinv
+    #propagator F to next plane
+    Fz = np.array([[1., distBetweenPlanes],
+                   [0., 1.]])
+    #multiple scattering contribution to covariance of extrapolation
+    Qz = t0*t0*np.array([[distBetweenPlanes*distBetweenPlanes, distBetweenPlanes],
+                         [distBetweenPlanes, 1.]])
+    # weight of the measurement
+    Minv = np.array([[1./s2, 0.],
+                     [0., 0.]])
+    kalmanCache[key] = [s2, Fz, Qz, Minv]
+  return kalmanCache[key]
+
+# Inverse of a stack of 2x2 matrices, shape (N,2,2)
+def inv2x2(A):
+  det = A[:,0,0]*A[:,1,1] - A[:,0,1]*A[:,1,0]
+  Ainv = np.empty_like(A)
+  Ainv[:,0,0] = A[:,1,1]/det
+  Ainv[:,0,1] = -A[:,0,1]/det
+  Ainv[:,1,0] = -A[:,1,0]/det
+  Ainv[:,1,1] = A[:,0,0]/det
+  return Ainv
+
+def kalmanPredictBatch(cfg, z, C):
+  # Prediction step only, for N track candidates at once:
+  # z (N,2) the track states and C (N,2,2) their covariances in the current plane.
+  # returns [zpred (N,2), Cpz (N,2,2)] at the next plane
+
+  [s2, Fz, Qz, Minv] = kalmanConstants(cfg)
 
   #covariance of extrapolation
   #Cpz = Fz*C*FTz+Qz
-  Cpz = np.dot(np.dot(Fz, C), FTz)+Qz
+  Cpz = np.matmul(np.matmul(Fz, C), Fz.T) + Qz
 
   #predicted state at next plane
-  zpred = np.zeros(shape=(2,1))
   #zpred = Fz*z
-  zpred = np.dot(Fz, z)
-
-  #covariance matrix of updated state 
-  # covariance of the prediction
-  Cinv = np.zeros(shape=(2,2))
-  # covariance of the measurement
-  Minv = np.zeros(shape=(2,2))
-  Minv[0][0]=1./s2
-  #add weights
-  Cinv = inv(Cpz) + Minv 
-  C=inv(Cinv)
+  zpred = np.matmul(z, Fz.T)
+  return [zpred, Cpz]
 
-  #updated track state, use the weighted average of the measurement and the prediction.
-  # Note that An equivalent way is to use the Kalman gain matrix K
-  znew = np.zeros(shape=(2,1))
-  #new z weighted by 1/s2
-  znew[0][0] = zHits[p1][ihit]/s2
-  znew[1][0]=0.
-  #add predicted z - remember Cpz is inverted
-  #z=C*(Cpz*zpred + znew)   
-  z=np.dot(C, (np.dot(Cpz, zpred) + znew))   
-
-  #the residual and the chisquared (the returned float)
-  r =(zHits[p1][ihit]-zpred[0][0])
-  #covariance matrix of the residual
-  R = s2 + Cpz[0][0]
-  chi2=r*r/R
-  return [chi2, zpred, z, C]
+def kalmanFilterBatch(cfg, zmeas, z, C):
+  # Propagates N track candidates at once from one detector plane to the next
+  # as a straight line in x-z (the non-bending plane), and updates their track parameters and error matrix in x-z:
+  # zmeas (N,) are the measured z coordinates in the next plane,
+  # z (N,2) the track states and C (N,2,2) their covariances in the current plane.
+  # returns [chi2 (N,), zpred (N,2), z (N,2), C (N,2,2)]
 
-## Global Chi2 (the whole track)
+  [zpred, Cpz] = kalmanPredictBatch(cfg, z, C)
+  [chi2, znew, Cnew] = kalmanUpdateBatch(cfg, zmeas, zpred, Cpz)
+  return [chi2, zpred, znew, Cnew]
 
-def globalChi2(ihits, x, C):
-  #global chi2-fit to x-y hits in 2*numberOfPlanes pixel planes 
-  #nparameters=4 indicates that the field is off
-
-  pinv=1./beamMomentum
-  # d(momentum)/d(tan(delta_theta))
-  dpdt=0.003*integralBdL 
-  # MS angle using an estimated 1/p
-  t0=multScattAngle*pinv 
-  t2=t0*t0
-  s2=resolution*resolution
-  d2=distBetweenPlanes*distBetweenPlanes
-  # number of pixel planes
-  nplane=2*numberOfPlanes 
-  # 2 times that (z and y measurements)
-  ndim=4*numberOfPlanes   
-  #
-  # The column vector of the measurements
-  # - first the nplane z measurements, then the nplane y measurements 
-  m = np.zeros(shape=(ndim,1))
-  for i in range(nplane):
-    m[i][0] = zHits[i][ihits[i]]
-    m[i+nplane][0] = yHits[i][ihits[i]]
+def kalmanUpdateBatch(cfg, zmeas, zpred, Cpz):
+  # Update step only, for N track candidates at once:
+  # zmeas (N,) are the measured z coordinates, zpred (N,2) and Cpz (N,2,2) the predicted states and covariances in this plane.
+  # returns [chi2 (N,), z (N,2), C (N,2,2)]
 
-  #
-  # The Covariance matrix of the measurements, including MS induced correlations
-  V = np.zeros(shape=(ndim,ndim))
+  [s2, Fz, Qz, Minv] = kalmanConstants(cfg)
 
-  V[0][0] = s2
-  V[nplane][nplane] = s2
+  #covariance matrix of updated state, adding the weights of the prediction and the measurement
+  Wpz = inv2x2(Cpz)
+  Cnew = inv2x2(Wpz + Minv)
 
-  for i in range(1, nplane):
-    for j in range(i, nplane):
-       V[i][j] = V[i-1][j-1] + i*j*t2*d2
-       V[i+nplane][j+nplane] = V[i][j]
+  #updated track state, use the weighted average of the measurement and the prediction.
+  #z=C*(Wpz*zpred + znew), with the new z weighted by 1/s2
+  zw = np.matmul(Wpz, zpred[:,:,np.newaxis])[:,:,0]
+  zw[:,0] += zmeas/s2
+  znew = np.matmul(Cnew, zw[:,:,np.newaxis])[:,:,0]
 
-       if(j>i):
-         V[j][i] = V[i][j]
-         V[j+nplane][i+nplane] = V[j][i]
+  #the residual and the chisquared
+  r = zmeas-zpred[:,0]
+  #covariance matrix of the residual
+  Rz = s2 + Cpz[:,0,0]
+  chi2 = r*r/Rz
+  return [chi2, znew, Cnew]
 
-  #
-  # The track state vector is defined as
-  # x = (z0, z', y0, y', 1/p) with
-  # track impact z0, y0 and slopes z'=dz/dx and y'=dy/dx all given at plane 0
-  #
-  # H projects the track state vector on the measurement base
-  H = np.zeros(shape=(ndim,nparameters))
-
-  for i in range(nplane):
-    j=i+nplane
-    H[i][0]=1
-    H[j][2]=1
-    H[i][1]=i*distBetweenPlanes
-    H[j][3]=i*distBetweenPlanes
-
-    if(i>numberOfPlanes-1 and nparameters>4): H[j][4]=dpdt*distBetweenPlanes*(0.5+i-numberOfPlanes)
-  
-  HT=np.transpose(H)
-  #
-  # Now do the linear chi2 fit
-  # chi2 = (m - H*x)^T V^-1 (m - H*x)
-  # In linear case, the solution is x_fit = (H^T V^-1 H)^-1 H^T V^-1 m
-  # see p54 of the [slides by Peter Hansen](https://indico.nbi.ku.dk/event/1090/sessions/2365/attachments/2696/3926/trackalgs2018.pdf)
-  #
-  #Ctmp=HT*inv(V)*H
-  Ctmp=np.dot(np.dot(HT, inv(V)), H)
-  C=inv(Ctmp)
-  # V is now inverse
-  # C is now the covariance matrix of the fitted track state
-
-  # x is the fitted track state vector
-  #x = C*HT*V*m
-  x = np.dot(np.dot(C, HT), np.dot(V, m))
-
-  # R is the residual vector
-  #R=m-H*x
-  R=m-np.dot(H, x)
-  RT=np.transpose(R)
- 
-  #Chi2=RT*V*R
-  Chi2=np.dot(np.dot(RT, V), R)
-  if(debug): print("  chi2 ", Chi2[0][0])
-  # Return chi2 for ndim-nparameters d.o.f.
-  return [Chi2[0][0], x, C]
+#### Smoothing:
+#
+# The filtered state at plane $k$ only uses the hits up to plane $k$. The Rauch-Tung-Striebel smoother
+# runs backwards from the last plane, where the filtered state already uses all hits:
+# $$
+# A_k = C_{k|k} F_z^T C_{k+1|k}^{-1} \\
+# \tilde{x}_{k|n} = \tilde{x}_{k|k} + A_k (\tilde{x}_{k+1|n} - \tilde{x}_{k+1|k}) \\
+# C_{k|n} = C_{k|k} + A_k (C_{k+1|n} - C_{k+1|k}) A_k^T
+# $$
+# The total chi2 of the filter is the chi2 of the smoothed track in x-z, so the candidates can be ranked
+# by the filter chi2 before the global fit.
+
+def kalmanSmoothBatch(cfg, zF, CF, zP, CP):
+  # Rauch-Tung-Striebel smoother for N track candidates over n planes:
+  # zF (N,n,2), CF (N,n,2,2) the filtered states and covariances in each plane,
+  # zP, CP the predicted ones (from the previous plane, not used for the first plane).
+  # returns [zS (N,n,2), CS (N,n,2,2)] the smoothed states and covariances
+
+  [s2, Fz, Qz, Minv] = kalmanConstants(cfg)
+  zS = zF.copy()
+  CS = CF.copy()
+  for k in range(zF.shape[1]-2, -1, -1):
+    #smoother gain A = CF*FTz*CP^-1
+    A = np.matmul(np.matmul(CF[:,k], Fz.T), inv2x2(CP[:,k+1]))
+    zS[:,k] = zF[:,k] + np.matmul(A, (zS[:,k+1]-zP[:,k+1])[:,:,np.newaxis])[:,:,0]
+    CS[:,k] = CF[:,k] + np.matmul(np.matmul(A, CS[:,k+1]-CP[:,k+1]), np.transpose(A, (0,2,1)))
+  return [zS, CS]
+
+#### Full track state (through the magnet):
+#
+# The full Kalman Filter uses the state $x = (z, dz/dx, y, dy/dx, 1/p)$ and measures $(z, y)$ in each plane.
+# The propagation is the straight line $F_z$ in x-z and in x-y, except from the last plane before the magnet
+# to the first plane after it, where the magnet (in the middle) kicks the slope by $\Delta(dy/dx) = 0.003 \int B dl / p$:
+# $$
+# y \to y + d\,dy/dx + \frac{d}{2}\,0.003 \int B dl \cdot 1/p, \qquad dy/dx \to dy/dx + 0.003 \int B dl \cdot 1/p
+# $$
+# which is the linearized track model of propagateTrack and of the global chi2 fit. Multiple scattering adds $Q_z$ in x-z and in x-y.
+#
+# $1/p$ is unknown until the first y measurement after the magnet. Until then the state is kept as $x + B\,(1/p)$,
+# with the response $B$ of the state to $1/p$, and the first y hit after the magnet fixes $1/p$ (like the two seed hits fix z and dz/dx).
+# So the total chi2 of the filter is the global chi2 of the track, and the compatibility of the measured $1/p$
+# with the beam momentum (within momentumSpread) is used to cut the hits after the magnet.
+
+def fullKalmanConstants(cfg):
+  key = ("full", cfg.resolution, cfg.beamMomentum, cfg.multScattAngle, cfg.distBetweenPlanes, cfg.integralBdL, cfg.nparameters)
+  if key not in kalmanCache:
+    [s2, Fz, Qz, Minv] = kalmanConstants(cfg)
+    d = cfg.distBetweenPlanes
+    # straight line propagator and multiple scattering, in x-z and x-y
+    F = np.identity(5)
+    F[0:2,0:2] = Fz
+    F[2:4,2:4] = Fz
+    Q = np.zeros(shape=(5,5))
+    Q[0:2,0:2] = Qz
+    Q[2:4,2:4] = Qz
+    # through the magnet (no momentum measurement if nparameters=4)
+    Fmag = F.copy()
+    if cfg.nparameters>4:
+      dpdt = 0.003*cfg.integralBdL
+      Fmag[2][4] = d/2.*dpdt
+      Fmag[3][4] = dpdt
+    # projection on the measurements (z, y) and their covariance
+    H = np.zeros(shape=(2,5))
+    H[0][0] = 1.
+    H[1][2] = 1.
+    V = s2*np.identity(2)
+    kalmanCache[key] = [F, Fmag, Q, H, V]
+  return kalmanCache[key]
+
+# seed of the full Kalman Filter at plane 1 from the hits (y0, z0) in plane 0 and (y1, z1) in plane 1
+# returns [x (N,5), C (N,5,5), B (N,5)]; 1/p is unknown (B is the response of the state to 1/p)
+def fullKalmanSeed(cfg, y0, z0, y1, z1):
+  s2 = cfg.resolution*cfg.resolution
+  d = cfg.distBetweenPlanes
+  n = len(z1)
+  x = np.zeros(shape=(n,5))
+  x[:,0] = z1
+  x[:,1] = (z1-z0)/d
+  x[:,2] = y1
+  x[:,3] = (y1-y0)/d
+  C = np.zeros(shape=(n,5,5))
+  C[:,0:2,0:2] = np.array([[s2, s2/d], [s2/d, 2*s2/d/d]])
+  C[:,2:4,2:4] = C[:,0:2,0:2]
+  B = np.zeros(shape=(n,5))
+  if cfg.nparameters>4: B[:,4] = 1.
+  return [x, C, B]
+
+def fullKalmanPredictBatch(cfg, magnet, x, C, B):
+  # Prediction step for N track candidates with the full state x (N,5), its covariance C (N,5,5)
+  # and response B (N,5) to the unknown 1/p, from one plane to the next; magnet: the magnet is between the two planes
+  # returns [xpred, Cpred, Bpred] at the next plane
+  [F, Fmag, Q, H, V] = fullKalmanConstants(cfg)
+  if magnet: F = Fmag
+  return [np.matmul(x, F.T), np.matmul(np.matmul(F, C), F.T) + Q, np.matmul(B, F.T)]
+
+def fullKalmanUpdate(x, C, cols, s2, m):
+  # Kalman update of the states x (N,n), covariances C (N,n,n) with the measurements m (N,k) of the components cols of x,
+  # each with the variance s2
+  # returns [chi2 (N,), x, C]
+  CHT = C[:,:,cols]
+  R = CHT[:,cols,:] + s2*np.identity(len(cols))
+  Rinv = inv2x2(R) if len(cols)==2 else 1./R
+  r = m - x[:,cols]
+  #gain K = C*HT*R^-1
+  K = np.matmul(CHT, Rinv)
+  xnew = x + np.matmul(K, r[:,:,np.newaxis])[:,:,0]
+  Cnew = C - np.matmul(K, np.transpose(CHT, (0,2,1)))
+  chi2 = np.einsum('ni,nij,nj->n', r, Rinv, r)
+  return [chi2, xnew, Cnew]
+
+def fullKalmanUpdateBatch(cfg, zmeas, ymeas, xpred, Cpred, Bpred):
+  # Update step only, for the full state: zmeas, ymeas (N,) are the measured coordinates,
+  # xpred (N,5), Cpred (N,5,5), Bpred (N,5) the predicted states, covariances and responses to the unknown 1/p in this plane
+  # returns [chi2 (N,), chi2p (N,), x, C, B], chi2p is the chi2 of the measured 1/p
+  # with respect to the beam momentum (for the candidates measuring 1/p in this plane, 0 for the others)
+
+  [F, Fmag, Q, H, V] = fullKalmanConstants(cfg)
+  s2 = V[1][1]
+  chi2 = np.zeros(len(xpred))
+  chi2p = np.zeros(len(xpred))
+  xnew = np.empty_like(xpred)
+  Cnew = np.empty_like(Cpred)
+  Bnew = Bpred.copy()
+
+  # the first y hit after the magnet measures 1/p: y = ypred + b*(1/p)
+  seed = Bpred[:,2] != 0.
+  other = np.logical_not(seed)
+  [chi2[other], xnew[other], Cnew[other]] = fullKalmanUpdate(xpred[other], Cpred[other], [0,2], s2,
+                                                             np.stack([zmeas[other], ymeas[other]], axis=1))
+  if seed.any():
+    xs, Cs, Bs = xpred[seed], Cpred[seed], Bpred[seed]
+    K = Bs/Bs[:,2:3]
+    xs = xs + K*(ymeas[seed]-xs[:,2])[:,np.newaxis]
+    IKH = np.identity(5) - K[:,:,np.newaxis]*H[1]
+    Cs = np.matmul(np.matmul(IKH, Cs), np.transpose(IKH, (0,2,1))) + s2*K[:,:,np.newaxis]*K[:,np.newaxis,:]
+    # then the z measurement
+    [chi2s, xs, Cs] = fullKalmanUpdate(xs, Cs, [0], s2, zmeas[seed][:,np.newaxis])
+    chi2[seed], xnew[seed], Cnew[seed], Bnew[seed] = chi2s, xs, Cs, 0.
+    pinv0 = 1./cfg.beamMomentum
+    dpinv = xs[:,4] - pinv0
+    chi2p[seed] = dpinv*dpinv/(Cs[:,4,4] + (cfg.momentumSpread*pinv0)**2)
+  return [chi2, chi2p, xnew, Cnew, Bnew]
 
+## Global Chi2 (the whole track)
+#
+# The measurement covariance V, the projection H and hence the fitted covariance C=(H^T V^-1 H)^-1
+# only depend on the geometry, not on the hits.
+# They are computed once per geometry, together with the gain matrix G = C H^T V^-1,
+# so that the fit of a track reduces to x = G m.
+
+class GlobalFitOperator:
+
+  def __init__(self, cfg, mask=None):
+    #global chi2-fit to x-y hits in 2*numberOfPlanes pixel planes
+    #nparameters=4 indicates that the field is off
+    #mask: optional list of flags, one per plane, False for the planes without a hit on the track
+
+    numberOfPlanes, distBetweenPlanes, nparameters = cfg.numberOfPlanes, cfg.distBetweenPlanes, cfg.nparameters
+    pinv=1./cfg.beamMomentum
+    # d(momentum)/d(tan(delta_theta))
+    dpdt=0.003*cfg.integralBdL
+    # MS angle using an estimated 1/p
+    t0=cfg.multScattAngle*pinv
+    t2=t0*t0
+    s2=cfg.resolution*cfg.resolution
+    d2=distBetweenPlanes*distBetweenPlanes
+    # number of pixel planes
+    nplane=2*numberOfPlanes
+    # 2 times that (z and y measurements)
+    ndim=4*numberOfPlanes
+    self.nplane=nplane
+    self.nparameters=nparameters
+
+    #
+    # The Covariance matrix of the measurements, including MS induced correlations
+    # - first the nplane z measurements, then the nplane y measurements
+    V = np.zeros(shape=(ndim,ndim))
+
+    V[0][0] = s2
+    V[nplane][nplane] = s2
+
+    for i in range(1, nplane):
+      for j in range(i, nplane):
+         V[i][j] = V[i-1][j-1] + i*j*t2*d2
+         V[i+nplane][j+nplane] = V[i][j]
+
+         if(j>i):
+           V[j][i] = V[i][j]
+           V[j+nplane][i+nplane] = V[j][i]
+
+    #
+    # The track state vector is defined as
+    # x = (z0, z', y0, y', 1/p) with
+    # track impact z0, y0 and slopes z'=dz/dx and y'=dy/dx all given at plane 0
+    #
+    # H projects the track state vector on the measurement base
+    H = np.zeros(shape=(ndim,nparameters))
+
+    for i in range(nplane):
+      j=i+nplane
+      H[i][0]=1
+      H[j][2]=1
+      H[i][1]=i*distBetweenPlanes
+      H[j][3]=i*distBetweenPlanes
+
+      if(i>numberOfPlanes-1 and nparameters>4): H[j][4]=dpdt*distBetweenPlanes*(0.5+i-numberOfPlanes)
+
+    #
+    # Now do the linear chi2 fit
+    # chi2 = (m - H*x)^T V^-1 (m - H*x)
+    # In linear case, the solution is x_fit = (H^T V^-1 H)^-1 H^T V^-1 m
+    # see p54 of the [slides by Peter Hansen](https://indico.nbi.ku.dk/event/1090/sessions/2365/attachments/2696/3926/trackalgs2018.pdf)
+    #
+    # drop the measurements of the planes without hit
+    if mask is not None:
+      rows = [i for i in range(nplane) if mask[i]]
+      rows = rows + [i+nplane for i in rows]
+      V = V[np.ix_(rows,rows)]
+      H = H[rows]
+    self.ndim = len(H)
+
+    self.H = H
+    self.Vinv = inv(V)
+    # C is the covariance matrix of the fitted track state
+    self.C = inv(np.dot(np.dot(H.T, self.Vinv), H))
+    # the gain matrix, x = G*m
+    self.G = np.dot(np.dot(self.C, H.T), self.Vinv)
+
+  def fit(self, m):
+    # fit one measurement vector m (ndim,)
+    # returns [chi2, x, C] with x of shape (nparameters,1)
+    [chi2, x, C] = self.fitBatch(np.reshape(m, (1,self.ndim)))
+    return [chi2[0], x[0].reshape(self.nparameters,1), C]
+
+  def fitBatch(self, M):
+    # fit a stack of measurement vectors M (n,ndim)
+    # returns [chi2 (n,), x (n,nparameters), C]; C is the same for all of them
+    x = np.dot(M, self.G.T)
+    # R is the residual vector, R=m-H*x
+    R = M - np.dot(x, self.H.T)
+    # Chi2=RT*V^-1*R
+    chi2 = np.einsum('ij,jk,ik->i', R, self.Vinv, R)
+    return [chi2, x, self.C]
+
+# one fit operator per geometry (and per pattern of planes without hit)
+globalFitCache = {}
+
+def getGlobalFitOperator(cfg, mask=None):
+  key = (cfg.numberOfPlanes, cfg.distBetweenPlanes, cfg.multScattAngle, cfg.beamMomentum, cfg.resolution, cfg.integralBdL, cfg.nparameters)
+  if mask is not None and all(mask): mask = None
+  if mask is not None: mask = tuple(bool(used) for used in mask)
+  if (key, mask) not in globalFitCache: globalFitCache[(key, mask)] = GlobalFitOperator(cfg, mask)
+  return globalFitCache[(key, mask)]
+
+## Hit search windows
+#
+# The hits of each plane are indexed by sorted z (and y) coordinate, so that the hits compatible with a
+# predicted position are found by binary search instead of looping over all hits of the plane.
+# Hits already used by a track are left out of the index (see Tracker.buildHitIndex).
+
+# hit numbers (in increasing order) of the hits with a coordinate within [center-halfWidth, center+halfWidth]
+def hitsInWindow(index, center, halfWidth):
+  [coord, order] = index
+  first = np.searchsorted(coord, center-halfWidth, side='left')
+  last = np.searchsorted(coord, center+halfWidth, side='right')
+  return np.sort(order[first:last])
+
+# all positions in the ranges [first, last) of shape (n,)
+# returns [irange, ipos]: the range number and the position, by range
+def expandRanges(first, last):
+  n = last-first
+  irange = np.repeat(np.arange(len(first)), n)
+  ipos = np.repeat(first, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)
+  return [irange, ipos]
+
+# the same as hitsInWindow for n windows at once, with centers and halfWidths of shape (n,)
+# returns [iw, ihit]: the window number and the hit number of all (window, hit) pairs, by window
+def hitsInWindows(index, centers, halfWidths):
+  [coord, order] = index
+  first = np.searchsorted(coord, centers-halfWidths, side='left')
+  last = np.searchsorted(coord, centers+halfWidths, side='right')
+  [iw, ipos] = expandRanges(first, last)
+  return [iw, order[ipos]]
+
+# the n entries closest to the center of each window, from the (window, hit) pairs of a window search
+# iw: the window numbers, by window, dist: the distance of the hits to the center (>= 0)
+# returns the positions of these entries, in increasing order
+def closestInWindows(iw, dist, n):
+  if len(iw)==0: return np.zeros(0, dtype=np.int64)
+  # one sort on the window number plus the distance scaled to [0, 1)
+  ranked = np.argsort(iw + dist/(dist.max()*(1.+1e-9) + 1e-300), kind='stable')
+  rank = np.arange(len(ranked)) - np.searchsorted(iw[ranked], iw[ranked], side='left')
+  return np.sort(ranked[rank < n])
+
+## Grid hit index (high occupancy)
+#
+# With thousands of hits per plane, a window in z is a strip across the whole plane in y, with many hits in it.
+# HitGrid bins the hits of a plane on a uniform grid of square cells in (y, z), with the hits stored cell by cell,
+# row by row in y. A window in y and z then visits only the grid rows it overlaps, and in each of them
+# the contiguous hits of the cells it overlaps, so a search costs about the number of hits in the window.
+class HitGrid:
+
+  def __init__(self, y, z, hitNumbers, cellSize=None):
+    # y, z: coordinates of the hits, hitNumbers: their hit numbers in the plane
+    # cellSize: size of the cells, None: about two hits per cell
+    n = len(hitNumbers)
+    [self.ymin, ymax] = [y.min(), y.max()] if n>0 else [0., 0.]
+    [self.zmin, zmax] = [z.min(), z.max()] if n>0 else [0., 0.]
+    if cellSize is None:
+      cellSize = sqrt(2.*(ymax-self.ymin)*(zmax-self.zmin)/max(n,1))
+      # not more rows or columns than hits
+      cellSize = max(cellSize, (ymax-self.ymin)/(n+1), (zmax-self.zmin)/(n+1))
+      if cellSize==0.: cellSize = 1.
+    self.cellSize = cellSize
+    self.ny = int((ymax-self.ymin)/cellSize)+1
+    self.nz = int((zmax-self.zmin)/cellSize)+1
+
+    cell = ((y-self.ymin)/cellSize).astype(int)*self.nz + ((z-self.zmin)/cellSize).astype(int)
+    order = np.argsort(cell, kind='stable')
+    self.y = y[order]
+    self.z = z[order]
+    self.hitNumbers = hitNumbers[order]
+    # the hits of cell k are at positions cellStart[k] to cellStart[k+1]-1
+    self.cellStart = np.searchsorted(cell[order], np.arange(self.ny*self.nz+1))
+
+  # grid rows (or columns) from lower to upper coordinate, clipped to the grid
+  def cellRange(self, lower, upper, origin, ncell):
+    first = np.clip(np.floor((lower-origin)/self.cellSize), 0, ncell-1).astype(int)
+    last = np.clip(np.floor((upper-origin)/self.cellSize), 0, ncell-1).astype(int)
+    return [first, last]
+
+  # hits within n windows |y-yc|<=hy, |z-zc|<=hz, all arguments of shape (n,)
+  # returns [iw, ihit]: the window number and the hit number of all (window, hit) pairs, by window
+  def queryWindows(self, yc, zc, hy, hz):
+    [iy0, iy1] = self.cellRange(yc-hy, yc+hy, self.ymin, self.ny)
+    [iz0, iz1] = self.cellRange(zc-hz, zc+hz, self.zmin, self.nz)
+    # one hit range per (window, row)
+    [iw, irow] = expandRanges(iy0, iy1+1)
+    [irange, ipos] = expandRanges(self.cellStart[irow*self.nz + iz0[iw]], self.cellStart[irow*self.nz + iz1[iw] + 1])
+    iw = iw[irange]
+    ok = (np.abs(self.y[ipos]-yc[iw]) <= hy[iw]) & (np.abs(self.z[ipos]-zc[iw]) <= hz[iw])
+    return [iw[ok], self.hitNumbers[ipos[ok]]]
 
 # Reconstruct one track in 4 planes
 # =================
-
-## Plotting
 #
-# Draw hits in the x-z plane
-ch = R.TCanvas("chits","Hits",50,50,800,600)
-ch.GetFrame().SetFillColor(0)
-ch.GetFrame().SetBorderSize(20)
-
-gr_xz_sig = None
-gr_xz_noise = None
-list_gr_trks=[]
-
-def drawHits(evtIndex):
-  
-  global gr_xz_sig, gr_xz_noise
-  nhitsAll, nhitsSig, nhitsNoise=0, 0, 0
-  for j in range(2*numberOfPlanes):
-    nHits=len(yHits[j])
-    nhitsAll += nHits
-    for k in range(nHits):
-      if(isNoise[j][k]): nhitsNoise+=1
-
-  nhitsSig = nhitsAll - nhitsNoise
-  # Signal hits
-  gr_xz_sig = R.TGraph(nhitsSig)
-  gr_xz_sig.SetMarkerStyle(20)
-  # Noise hits
-  gr_xz_noise = R.TGraph(nhitsNoise)
-  gr_xz_noise.SetMarkerStyle(24)
-
-  # Loop all hits
-  isig, inoise=0, 0
-  for j in range(2*numberOfPlanes):
-    nHits=len(yHits[j])
-    for k in range(nHits):
-      if(isNoise[j][k]):
-        gr_xz_noise.SetPoint(inoise, xHits[j], zHits[j][k])
-        inoise+=1
-      else:  
-        gr_xz_sig.SetPoint(isig, xHits[j], zHits[j][k])
-        isig+=1
-
-  ch.cd()
-  htmp=ch.DrawFrame(-5, -1, 45, 1.2)
-  htmp.GetXaxis().SetTitle("X [cm]")
-  htmp.GetYaxis().SetTitle("Z [cm]")
-  gr_xz_sig.Draw("P") 
-  gr_xz_noise.Draw("Psame") 
-
-  leg = R.TLegend(0.6, 0.7, 0.9, 0.9)
-  leg.SetFillColor(R.kWhite)
-  leg.SetBorderSize(0)
-  leg.SetTextSize(0.040)
-  leg.AddEntry(gr_xz_sig, "Signal hits", "p")
-  leg.AddEntry(gr_xz_noise, "Noise hits", "p")
-  leg.Draw()
-
-  ch.Draw()
-
-  fout2.cd()
-  ch.SaveAs("event_"+str(i)+".png")
-  ch.Write("event_"+str(i))
- 
-# Draw hits of the track candidate found by the Kalman Filter
-def showKFposterior(evtIndex, zHitsKF, zHitsKFpred, totchi2_KF, totchi2_KFfit, itrk):
-
-  nhits = 2*numberOfPlanes
-  gr_kf = R.TGraph(nhits)
-  gr_kf_pred = R.TGraph(nhits)
-  ic = R.kMagenta + itrk
-  gr_kf.SetMarkerColor(ic)
-  gr_kf.SetLineColor(ic)
-  gr_kf.SetMarkerStyle(29)
-  gr_kf_pred.SetMarkerColor(ic)
-  gr_kf_pred.SetLineColor(ic)
-  gr_kf_pred.SetMarkerStyle(34)
-
-  # Loop all hits
-  ih=0
-  for j in range(2*numberOfPlanes):
-    gr_kf.SetPoint(ih, xHits[j], zHitsKF[j])
-    gr_kf_pred.SetPoint(ih, xHits[j], zHitsKFpred[j])
-    ih+=1
-
-  ch.cd()
-  gr_kf.Draw("Pcsame") 
-  gr_kf_pred.Draw("Pcsame") 
-
-  leg = R.TLegend(0.6, 0.7, 0.9, 0.9)
-  leg.SetFillColor(R.kWhite)
-  leg.SetBorderSize(0)
-  leg.SetTextSize(0.040)
-  leg.AddEntry(gr_xz_sig, "Signal hits", "p")
-  leg.AddEntry(gr_xz_noise, "Noise hits", "p")
-  leg.AddEntry(gr_kf_pred, "Predicted hits (Kalman)", "pl")
-  leg.AddEntry(gr_kf, "Updated hits (Kalman)", "pl")
-  leg.Draw()
-
-  tl=R.TPaveText(0.6, 0.6, 0.9, 0.7, "NDC")
-  tl.SetFillColor(R.kWhite)
-  tl.SetBorderSize(0)
-  tl.SetTextSize(0.04)
-  tl.AddText("#chi^{{2}} (Kalman)= {:.3e}".format(totchi2_KF))
-  tl.AddText("#chi^{{2}} (fit)= {:.3e}".format(totchi2_KFfit))
-  tl.Draw()
-
-  ch.Draw()
-
-  fout2.cd()
-  ch.SaveAs("event_"+str(i)+"_trk_"+str(itrk)+".png")
-  ch.Write("event_"+str(i)+"_trk_"+str(itrk))
-
-## Reconstruction (track finding with the Kalman Filter, then Track Fitting)
-
-def reco4(ibest, xbest, Cbest):
-
-  chi2min=10000000.
-  itrk = 0 # counter
-  # First loop over the hits in the first plane
-  # =======================================================================
-  for i0 in range(len(yHits[0])):
- 
-    # skip hit in first plane if it is outside the beam profile
-    if(fabs(yHits[0][i0])>4.*pixelSize): continue
-    allsignal= not isNoise[0][i0]
-
-    # loop over the hits in the second plane
-    # =====================================================================
-    for i1 in range(len(yHits[1])):
-
-      s2=resolution*resolution
-      allsignal= allsignal and (not isNoise[1][i1])
+# The Tracker finds the tracks of an event (the best one, or up to maxTracksPerEvent tracks), with reco4 (4 planes)
+# or the combinatorial Kalman Filter (recoCKF, any number of planes). It only records the track candidates for the event display;
+# the chi2 monitoring histograms are filled in the (optional) ResultSink.
+class Tracker:
+
+  def __init__(self, cfg, sink=None):
+    if not cfg.useCKF and cfg.numberOfPlanes != 2: raise ValueError("reco4 needs numberOfPlanes=2, use useCKF=True")
+    if cfg.hitIndex not in ["sorted", "grid"]: raise ValueError("unknown hitIndex "+str(cfg.hitIndex))
+    self.cfg = cfg
+    self.sink = sink
+    self.hits = None              # Hits of the current event (EventHits), with y and z measurement coordinates of each hit
+    self.zIndex=(2*cfg.numberOfPlanes)*[None]  # [sorted z, hit numbers in that order] per plane
+    self.yIndex=None                           # [sorted y, hit numbers in that order] of plane 0 (seeding)
+    self.grid=(2*cfg.numberOfPlanes)*[None]    # HitGrid per plane (hitIndex "grid")
+    self.displayCandidates = [] # [ihits, zHitsKF, zHitsKFpred, totchi2_KF, totchi2_KFfit] for each candidate of the current event
+
+  # finds the tracks among the hits (EventHits) of an event
+  # returns [tracks, chi2min]: tracks is the list of the reconstructed tracks [chi2, ihits, x, C], by increasing chi2,
+  # where ihits[j] is the hit number in plane j (-1 for a hole); chi2min is the lowest chi2 of all candidates
+  def reconstruct(self, hits):
+    self.hits = hits
+    del self.displayCandidates[:]
+
+    t = time.perf_counter()
+    self.buildHitIndex()
+    [i0, i1] = self.seeds()
+    t = self.addTime("seed", t)
+
+    #Consider all possible combinations of hits to find the best combinations in xz
+    if(self.cfg.useCKF):
+      candidates=self.recoCKF(i0, i1)
+    else:
+      candidates=self.reco4(i0, i1)
+    t = self.addTime("filter", t)
+
+    fitted=self.fitCandidates(candidates)
+    chi2min = min([chi2 for [chi2, ihits, x, C] in fitted], default=10000000.)
+    tracks = self.resolveTracks(fitted)
+    self.addTime("globalFit", t)
+    self.count("numberOfCut3Candidates", len(candidates))
+    self.count("numberOfCut3Passed", len(tracks))
+    return [tracks, chi2min]
+
+  # add n to the counter name of the sink
+  def count(self, name, n):
+    if self.sink is not None: setattr(self.sink, name, getattr(self.sink, name) + int(n))
+
+  # add the time since t0 to the stage of the sink
+  # returns the current time
+  def addTime(self, stage, t0):
+    if self.sink is None: return time.perf_counter()
+    return self.sink.addTime(stage, t0)
+
+  # count the candidates entering the chi2 cut of plane p (all combinations of the nbranch branches with the free hits
+  # of the plane, the search window applies the cut) and those passing it
+  def countCut(self, p, nbranch, npassed):
+    name = "numberOfCut1" if p==2 else "numberOfCut2"
+    self.count(name+"Candidates", nbranch*len(self.zIndex[p][1]))
+    self.count(name+"Passed", npassed)
+
+  # The column vector of the measurements
+  # - first the z measurements, then the y measurements of the planes with a hit (ihits[i]>=0)
+  def measurementVector(self, ihits):
+    planes = [i for i in range(2*self.cfg.numberOfPlanes) if ihits[i]>=0]
+    m = np.zeros(2*len(planes))
+    for k, i in enumerate(planes):
+      m[k] = self.hits.z[i][ihits[i]]
+      m[k+len(planes)] = self.hits.y[i][ihits[i]]
+    return m
+
+  # The measurement vectors of n candidates with hits in the same planes (mask), shape (n, ndim)
+  def measurementMatrix(self, ihits, mask):
+    planes = [i for i in range(2*self.cfg.numberOfPlanes) if mask[i]]
+    M = np.zeros(shape=(len(ihits), 2*len(planes)))
+    for k, i in enumerate(planes):
+      M[:,k] = self.hits.z[i][ihits[:,i]]
+      M[:,k+len(planes)] = self.hits.y[i][ihits[:,i]]
+    return M
+
+  def globalChi2(self, ihits, x, C):
+    #global chi2-fit to x-y hits in 2*numberOfPlanes pixel planes
+    #ihits[i] is the hit number in plane i, -1 if the track has no hit in this plane
+    mask = [ihit>=0 for ihit in ihits]
+    self.count("numberOfGlobalChi2Calls", 1)
+    [Chi2, x, C] = getGlobalFitOperator(self.cfg, mask).fit(self.measurementVector(ihits))
+    if(self.cfg.debug): print("  chi2 ", Chi2)
+    # Return chi2 for ndim-nparameters d.o.f.
+    return [Chi2, x, C]
+
+  def buildHitIndex(self):
+    hits = self.hits
+    for j in range(2*self.cfg.numberOfPlanes):
+      free = np.flatnonzero(np.logical_not(hits.used[j]))
+      order = free[np.argsort(hits.z[j][free], kind='stable')]
+      self.zIndex[j] = [hits.z[j][order], order]
+      if j==0:
+        order = free[np.argsort(hits.y[j][free], kind='stable')]
+        self.yIndex = [hits.y[j][order], order]
+      if self.cfg.hitIndex == "grid": self.grid[j] = HitGrid(hits.y[j][free], hits.z[j][free], free, self.cfg.gridCellSize)
+
+  # hits of plane p in n windows |y-yc|<=hy, |z-zc|<=hz, all arguments of shape (n,)
+  # returns [iw, ihit]: the window number and the hit number of all (window, hit) pairs, by window
+  def windowHits(self, p, yc, zc, hy, hz):
+    if self.cfg.hitIndex == "grid": return self.grid[p].queryWindows(yc, zc, hy, hz)
+    [iw, ihit] = hitsInWindows(self.zIndex[p], zc, hz)
+    ok = np.abs(self.hits.y[p][ihit] - yc[iw]) <= hy[iw]
+    return [iw[ok], ihit[ok]]
+
+  # half width of the z search window around the predicted position, in units of the residual error
+  def windowSigma(self, cut):
+    if self.cfg.searchWindowSigma is None: return sqrt(cut)
+    return self.cfg.searchWindowSigma
+
+  # hits in plane p1 around the predicted position of a track candidate with state z (2,) and covariance C (2,2)
+  def kalmanWindow(self, p1, z, C, cut):
+    [zpred, Cpz] = kalmanPredictBatch(self.cfg, np.reshape(z, (1,2)), np.reshape(C, (1,2,2)))
+    s2 = self.cfg.resolution*self.cfg.resolution
+    return hitsInWindow(self.zIndex[p1], zpred[0][0], self.windowSigma(cut)*sqrt(s2 + Cpz[0][0][0]))
+
+  # fill the chi2 monitoring histogram of plane p
+  def fillChi2(self, p, chi2s):
+    if self.sink is None: return
+    hchi2 = self.sink.chi2Histogram(p)
+    if hchi2 is not None and len(chi2s)>0:
+      hchi2.FillN(len(chi2s), np.ascontiguousarray(chi2s, dtype=float), np.ones(len(chi2s)))
+
+  ## Seeding
+  #
+  # The seeds are the pairs of hits in the first two planes compatible with the beam direction.
+  # The hits of plane 0 are taken in the beam profile (in y, and in z with seedProfileZ). Their partners in plane 1 are found by a range query
+  # in the hit index of plane 1 around the beam direction thetaxz, in z and in y.
+  # The slope window is seedWindowSigma times the expected spread of the seed slope: the multiple scattering
+  # in plane 0 (multScattAngle/beamMomentum) and the resolution of the two hits (including the resolution tail).
+  # With maxSeedsPerHit, each hit of plane 0 keeps only its partners closest to the beam direction.
+  # returns [i0, i1], the hit numbers of the seeds in planes 0 and 1, ordered by hit number in plane 0, then in plane 1
+  def seeds(self):
+
+    cfg, hits = self.cfg, self.hits
+    d = cfg.distBetweenPlanes
+    profile = 4.*(cfg.pixelSize+cfg.beamSpotSize)
+    first0 = hitsInWindow(self.yIndex, 0., profile)
+    if cfg.seedProfileZ: first0 = first0[np.abs(hits.z[0][first0]) <= profile]
+    free1 = np.sort(self.zIndex[1][1])
+    if cfg.seedWindowSigma is None:
+      i0 = np.repeat(first0, len(free1))
+      i1 = np.tile(free1, len(first0))
+    else:
+      t0 = cfg.multScattAngle/cfg.beamMomentum
+      s2 = cfg.resolution*cfg.resolution + cfg.tailWidth*cfg.tailWidth
+      halfWidth = cfg.seedWindowSigma*sqrt(t0*t0 + 2.*s2/(d*d))*d
+      halfWidths = np.full(len(first0), halfWidth)
+      [iw, i1] = self.windowHits(1, hits.y[0][first0], hits.z[0][first0] + d*cfg.thetaxz, halfWidths, halfWidths)
+      if cfg.maxSeedsPerHit is not None:
+        # the partners closest to the beam direction
+        dist = (hits.y[1][i1]-hits.y[0][first0[iw]])**2 + (hits.z[1][i1]-hits.z[0][first0[iw]]-d*cfg.thetaxz)**2
+        keep = closestInWindows(iw, dist, cfg.maxSeedsPerHit)
+        iw, i1 = iw[keep], i1[keep]
+      i0 = first0[iw]
+      # by hit number in plane 1 for each hit in plane 0
+      ordering = np.lexsort((i1, i0))
+      i0, i1 = i0[ordering], i1[ordering]
+
+    if self.sink is not None:
+      self.sink.numberOfSeeds += len(i0)
+      self.sink.numberOfRejectedSeeds += len(first0)*len(free1) - len(i0)
+    return [i0, i1]
+
+  ## Reconstruction (track finding with the Kalman Filter, then Track Fitting)
+
+  # seeds: the hit numbers i0, i1 of the seeds in planes 0 and 1 (see seeds)
+  # returns the track candidates [ihits, totchi2_KF, zHitsKF, zHitsKFpred, nholes]
+  def reco4(self, seeds0, seeds1):
+
+    cfg, hits = self.cfg, self.hits
+    distBetweenPlanes = cfg.distBetweenPlanes
+    candidates = [] # track candidates found by the Kalman Filter
+    # loop over the seeds (pairs of hits in the first two planes)
+    # =======================================================================
+    for [i0, i1] in zip(seeds0, seeds1):
+      i0, i1 = int(i0), int(i1)
+
+      s2=cfg.resolution*cfg.resolution
+      allsignal= (not hits.noise[0][i0]) and (not hits.noise[1][i1])
       # Use hits in the first two planes as the track seed
       #consider the xz plane - a non-bending plane
       #track state at plane 1
       z = np.zeros(shape=(2,1))
-      zpred = np.zeros(shape=(2,1))
-      z[0][0] = zHits[1][i1]
-      z[1][0] = (zHits[1][i1]-zHits[0][i0])/distBetweenPlanes
+      z[0][0] = hits.z[1][i1]
+      z[1][0] = (hits.z[1][i1]-hits.z[0][i0])/distBetweenPlanes
       #its covariance
       Cz = np.zeros(shape=(2,2))
       Cz[0][0] = s2
@@ -660,398 +1347,1116 @@ def reco4(ibest, xbest, Cbest):
       Cz[1][0] = Cz[0][1]
       Cz[1][1] = 2*s2/distBetweenPlanes/distBetweenPlanes
 
-      # total chi2 of the track found by the Kalman Filter
-      totchi2_KF = 0
-  
-      # loop over hits in the third plane
+      # Kalman Filter to extend the track to the 3rd plane,
+      # for all hits in the search window of this plane at once
       #===========================================================
-      for i2 in range(len(yHits[2])):
+      hits2 = self.kalmanWindow(2, z[:,0], Cz, cfg.Cut1)
+      n2 = len(hits2)
+      [chi2_2, zpred2, z2, Cz2] = kalmanFilterBatch(cfg, hits.z[2][hits2], np.tile(z[:,0], (n2,1)), np.tile(Cz, (n2,1,1)))
+      self.count("numberOfKalmanFilterCalls", n2)
+      self.countCut(2, 1, np.count_nonzero(chi2_2 <= cfg.Cut1))
 
-        # Kalman Filter to extend the track to the 3rd plane
-        [chi2, zpred, z, Cz] = kalmanFilter(2,i2,z,Cz)
+      signal2 = np.logical_not(hits.noise[2][hits2])
+      if(allsignal): self.fillChi2(2, chi2_2[signal2])
 
-        allsignal=allsignal and (not isNoise[2][i2])
-        if(allsignal): h11.Fill(chi2)
+      # loop over the hits in the third plane passing the cut
+      for k2 in np.flatnonzero(chi2_2 <= cfg.Cut1):
+        i2 = int(hits2[k2])
 
-        if(chi2 > Cut1): continue
-        z2 = z
-        z2pred = zpred
-        totchi2_KF += chi2
-   
-        #loop over hits in the fourth plane
+        # Kalman Filter to extend the track to the 4th plane,
+        # for all hits in the search window of this plane at once
         #====================================================================================
-        for i3 in range(len(yHits[3])):
+        hits3 = self.kalmanWindow(3, z2[k2], Cz2[k2], cfg.Cut2)
+        n3 = len(hits3)
+        [chi2_3, zpred3, z3, Cz3] = kalmanFilterBatch(cfg, hits.z[3][hits3], np.tile(z2[k2], (n3,1)), np.tile(Cz2[k2], (n3,1,1)))
+        self.count("numberOfKalmanFilterCalls", n3)
+        self.countCut(3, 1, np.count_nonzero(chi2_3 <= cfg.Cut2))
 
-          # Kalman Filter to extend the track to the 4th plane
-          [chi2, zpred, z, Cz] = kalmanFilter(3,i3,z,Cz)
+        if(allsignal and signal2[k2]): self.fillChi2(3, chi2_3[np.logical_not(hits.noise[3][hits3])])
 
-          allsignal=allsignal and (not isNoise[3][i3])
-          if(allsignal): h12.Fill(chi2)
+        #loop over hits in the fourth plane passing the cut
+        for k3 in np.flatnonzero(chi2_3 <= cfg.Cut2):
+          i3 = int(hits3[k3])
 
-          if(chi2 >Cut2): continue
-          z3 = z
-          z3pred = zpred
-          totchi2_KF += chi2
+          # total chi2 of the track found by the Kalman Filter
+          totchi2_KF = chi2_2[k2] + chi2_3[k3]
 
-          # now we have a track candidate, move to the track fitting part
-
-          # make a global chi2 fit and store only the best track
-          # ===============================================================================
-          x = np.zeros(shape=(5,1))
-          C = np.zeros(shape=(5,5))
-          x[4][0] = 1./beamMomentum #use here a fixed momentum estimate
+          # now we have a track candidate, keep it for the track fitting part
           ihits=[i0,i1,i2,i3]
-          [chi2, x, C] = globalChi2(ihits,x,C)
-
-          if(chi2<chi2min):
-            ibest[0]=i0
-            ibest[1]=i1
-            ibest[2]=i2
-            ibest[3]=i3
-            xbest=x
-            Cbest=C
-            chi2min=chi2
-
-          # visualize
-          zHitsKF=[zHits[0][i1], zHits[1][i2], z2[0][0], z3[0][0]]
-          zHitsKFpred=[zHits[0][i1], zHits[1][i2], z2pred[0][0], z3pred[0][0]]
-          print('zHitsKF:', zHitsKF)
-          showKFposterior(i, zHitsKF, zHitsKFpred, totchi2_KF, chi2, itrk)
-          itrk += 1
-
-  return [chi2min, xbest, Cbest]
-
-# Store tracks
-# =================
-def storeTrack(ibest, xbest, Cbest):
-  #
-  #fitted z intercept at plane 0
-  tracks[0].append(xbest[0])  
-  if(debug): print(" z0 ", tracks[0][0])
-  #fitted z slope at plane 0
-  tracks[1].append(xbest[1]) 
-  if(debug): print(" dz/dx " , tracks[1][0] )
-  #y intercept at plane 0
-  tracks[2].append(yHits[0][ibest[0]]) 
-  if(debug): print(" y0 " , tracks[2][0] )
-  tracks[3].append( (yHits[1][ibest[1]]-yHits[0][ibest[0]])/distBetweenPlanes )
-  if(debug): print(" dy/dx " , tracks[3][0] )
-  #charge/momentum
-  tracks[4].append(xbest[4])   
-  if(debug): print(" 1/p " , tracks[4][0] )
-  #truth
-  tracks[5].append(0.)
-  tracks[6].append(thetaxz)
-  tracks[7].append(0.)
-  tracks[8].append(0.)
-  tracks[9].append(1/beamMomentum)
-  #errors
-  tracks[10].append(sqrt( Cbest[0] ))
-  if(debug): print(" Dz0 " , tracks[10][0] )
-  tracks[11].append(sqrt( Cbest[5+1] ))
-  if(debug): print(" Ddz/dx " , tracks[11][0] )
-  tracks[12].append(sqrt( Cbest[2*5+2]))
-  if(debug): print(" Dy0 " , tracks[12][0] )
-  tracks[13].append(sqrt(Cbest[3*5+3]))
-  if(debug): print(" Ddy/dx " , tracks[13][0] )
-  tracks[14].append(sqrt( Cbest[4*5+4] ))
-  if(debug): print(" D1/p " , tracks[14][0] )
-
-  h1.Fill( tracks[2][0]-tracks[7][0] )
-  h2.Fill( tracks[0][0]-tracks[5][0] )
-  h3.Fill( tracks[3][0]-tracks[8][0] )
-  h4.Fill( tracks[1][0]-tracks[6][0] )
-  h5.Fill( tracks[4][0]-tracks[9][0] )
-  h6.Fill( (tracks[2][0]-tracks[7][0])/tracks[12][0] )
-  h7.Fill( (tracks[0][0]-tracks[5][0])/tracks[10][0] )
-  h8.Fill( (tracks[3][0]-tracks[8][0])/tracks[13][0] )
-  h9.Fill( (tracks[1][0]-tracks[6][0])/tracks[11][0] )
-  h10.Fill( (tracks[4][0]-tracks[9][0])/tracks[14][0] )
-
-# Main Program
-# =================
-# geometry
-for i in range(2*numberOfPlanes):
-  xHits[i]=distBetweenPlanes*i
-  ySize[i]=1.
-  if(i>numberOfPlanes-1): ySize[i]=2.
-  zSize[i]=1.
-
-#-----------------------------------------------------------------------
-# Loop over numberOfEvents
-#
+          zHitsKF=[hits.z[0][i0], hits.z[1][i1], z2[k2][0], z3[k3][0]]
+          zHitsKFpred=[hits.z[0][i0], hits.z[1][i1], zpred2[k2][0], zpred3[k3][0]]
+          candidates.append([ihits, totchi2_KF, zHitsKF, zHitsKFpred, 0])
 
-for i in range(numberOfEvents):
+    return candidates
 
-  if(i > firstDebugEvent-1 ): debug=True
-  if(i > lastDebugEvent ): debug=False
-
-  # New event
-  if (debug): print(" new event " )
-
-  # reset input and output data buffers
-  for j in range(15): tracks[j]=[]
-  for j in range(2*numberOfPlanes):
-    yHits[j]=[]
-    zHits[j]=[]
-    isNoise[j]=[]
-  
-  #========================================================================================
-  # Simulate the event
-  propagateTrack()
-
-  #========================================================================================
-  # Reconstruct the event
-  #
-  # ---------------------------------------------------------------------------------------
-  # Pattern recognition and fit
-  #========================================================================================
+  ## Combinatorial Kalman Filter (any number of planes)
   #
-  reject=False
-  # first count number of hits in each plane
-  nRealHits=0
-  for j in range(2*numberOfPlanes):
-    nHits=len(yHits[j])
-    for k in range(nHits):
-      if(not isNoise[j][k]):
-        nRealHits+=1
-        break
-    nTotalHits+=nHits
-    #all the planes must fire
-    if(nHits<1): reject=True           
-    if (debug): print(" plane " , j , " nHits " , nHits , " nRealHits " , nRealHits )
-
-  if(reject):
-    numberOfInefficientTracks+=1
-    continue
-
-  # visualize the hits
-  drawHits(i)
-
-  if(debug): print(" start reconstruction" )
-
-  # number of accepted track candidates.
-  ntracks=0           
-  xbest=np.zeros(shape=(5,1))
-  Cbest=np.zeros(shape=(5,5))
-  ibest=(2*numberOfPlanes)*[0.]
-
-  #Consider all possible combinations of hits to find best combination in xz
-  #Only one track is reconstructed and it must have hits in all planes
-  chi2min=100000000.
-  if(numberOfPlanes>2):
-    #chi2min=reco6(ibest,xbest,Cbest)
-    continue
-  else:
-    [chi2min, xbest, Cbest]=reco4(ibest,xbest,Cbest)
-
-  #fout2.cd()
-  #ch.Write("event_"+str(i))
-
-  # Reject event if best track not good enough
-  if(chi2min>Cut3):
-    numberOfRejectedTracks+=1
-    if(nRealHits>2*numberOfPlanes-1): numberOfGoodRejectedTracks+=1
-    if(debug): print(" best track rejected chi2= " , chi2min )
-    continue
-  
-  h13.Fill(chi2min)
-
-  # Repeat the fit for the selected track (using the measured momentum now)
-  [chi2, dummp_x, dummy_C]= globalChi2(ibest,xbest,Cbest)
-  h14.Fill(chi2)
-
-  allsignal= True
-  for j in range(2*numberOfPlanes): allsignal=allsignal and (not isNoise[j][ibest[j]])
-
-  if(debug):
-    if(allsignal):
-      print(" Noiseless track selected   chi2 " , chi2 )
+  # Each seed (a pair of hits in the first two planes) is extended plane by plane.
+  # At each plane, all candidates (branches) of the seed are combined with the hits in their search window,
+  # optionally with a hole (no hit in this plane), and only the maxBranches best branches
+  # by cumulative chi2 are kept for the next plane. The surviving candidates are fitted with the global chi2 fit.
+  # With fullKalmanFilter, the branches carry the full state (z, z', y, y', 1/p) and the y hits are cut on as well.
+  # The branches of seedBatchSize seeds are extended together, plane by plane, which gives the same candidates
+  # as extending the seeds one at a time.
+
+  # i0, i1: the hit numbers of the seeds (pairs of hits in the first two planes) in planes 0 and 1 (see seeds)
+  # returns the track candidates [ihits, totchi2_KF, zHitsKF, zHitsKFpred, nholes]
+  def recoCKF(self, i0, i1):
+
+    cfg = self.cfg
+    numberOfPlanes, nparameters = cfg.numberOfPlanes, cfg.nparameters
+    candidates = [] # track candidates found by the Kalman Filter
+    batchSize = max(1, cfg.seedBatchSize or len(i0))
+    for first in range(0, len(i0), batchSize):
+      candidates += self.extendSeeds(i0[first:first+batchSize], i1[first:first+batchSize])
+
+    # the momentum is measured only if there is a hit after the magnet
+    if nparameters>4:
+      candidates = [cand for cand in candidates if max(cand[0][numberOfPlanes:])>=0]
+    return candidates
+
+  # extends the seeds (hits i0 in plane 0, i1 in plane 1) through the other planes
+  # returns their track candidates [ihits, totchi2_KF, zHitsKF, zHitsKFpred, nholes], by seed
+  def extendSeeds(self, i0, i1):
+
+    cfg, hits = self.cfg, self.hits
+    numberOfPlanes = cfg.numberOfPlanes
+    maxBranches, maxHoles, holeChi2 = cfg.maxBranches, cfg.maxHoles, cfg.holeChi2
+    nplane = 2*numberOfPlanes
+    s2 = cfg.resolution*cfg.resolution
+    d = cfg.distBetweenPlanes
+    full = cfg.fullKalmanFilter
+    nseed = len(i0)
+
+    # the branches of all seeds: seed number, hit numbers (-1 for a hole), state at the last plane ([z, Cz] the state
+    # and covariance, or [x, C, B] for the full state, see fullKalmanSeed), cumulative chi2 (with hole penalties),
+    # number of holes, MC truth flag, and the updated and predicted z for the display
+    iseed = np.arange(nseed)
+    ihits = np.stack([i0, i1], axis=1)
+    if full:
+      state = fullKalmanSeed(cfg, hits.y[0][i0], hits.z[0][i0], hits.y[1][i1], hits.z[1][i1])
     else:
-      print(" Noisy track selected   chi2 " , chi2 )
-
-  #Store the track
-  p = 5*[0.]
-  ep = (5*5)*[0.]
-  for ipar in range(5):
-    p[ipar]=xbest[ipar][0]
-    for jpar in range(5): ep[ipar*5+jpar]=Cbest[ipar][jpar]
-
-  storeTrack(ibest,p,ep)
-
-  ntracks+=1
-  numberOfReconstructedTracks+=1          
-
-  if(allsignal): numberOfGoodReconstructedTracks+=1
-  for j in range(2*numberOfPlanes):
-    if(isNoise[j][ibest[j]]): nNoiseHitsOnTrack+=1
-    #flag the hits as used (change the coordinate to out of the detector range)
-    yHits[j][ibest[j]]=ySize[j]+1.
-
+      z = np.stack([hits.z[1][i1], (hits.z[1][i1]-hits.z[0][i0])/d], axis=1)
+      Cz = np.tile(np.array([[s2, s2/d], [s2/d, 2*s2/d/d]]), (nseed,1,1))
+      state = [z, Cz]
+    chi2sum = np.zeros(nseed)
+    nholes = np.zeros(nseed, dtype=int)
+    signal = np.logical_not(hits.noise[0][i0] | hits.noise[1][i1])
+    zKF = np.stack([hits.z[0][i0], hits.z[1][i1]], axis=1).astype(float)
+    zKFpred = zKF.copy()
+
+    for p in range(2, nplane):
+      if len(ihits)==0: break
+      cut = cfg.Cut1 if p==2 else cfg.Cut2
+      magnet = p==numberOfPlanes
+      if full:
+        pred = fullKalmanPredictBatch(cfg, magnet, *state)
+      else:
+        pred = kalmanPredictBatch(cfg, *state)
+      # the predicted z and its error are the first components in both cases
+      [zpred, Cpz] = pred[0:2]
+
+      # the hits in the search window of each branch, found all at once
+      halfWidth = self.windowSigma(cut)*np.sqrt(s2 + Cpz[:,0,0])
+      if full:
+        # the window is also in y: around the predicted y,
+        # or around the y predicted for the beam momentum at the first y hit after the magnet
+        # (with the default window, these are the hits which can pass the chi2 cut)
+        [xpred, Cpred, Bpred] = pred
+        pinv0 = 1./cfg.beamMomentum
+        ypred = xpred[:,2] + Bpred[:,2]*pinv0
+        yerr = np.sqrt(s2 + Cpred[:,2,2] + (Bpred[:,2]*cfg.momentumSpread*pinv0)**2)
+        [ib, ih] = self.windowHits(p, ypred, zpred[:,0], self.windowSigma(cut)*yerr, halfWidth)
+      else:
+        [ib, ih] = hitsInWindows(self.zIndex[p], zpred[:,0], halfWidth)
+      if cfg.maxHitsPerBranch is not None:
+        # the hits closest to the prediction of each branch, before the Kalman Filter update
+        dist = ((hits.z[p][ih]-zpred[ib,0])/halfWidth[ib])**2
+        if full: dist += ((hits.y[p][ih]-ypred[ib])/yerr[ib])**2/self.windowSigma(cut)**2
+        keep = closestInWindows(ib, dist, cfg.maxHitsPerBranch)
+        ib, ih = ib[keep], ih[keep]
+
+      # update all (branch, hit) pairs with the Kalman Filter in one go
+      zp = zpred[ib]
+      if full:
+        [chi2, chi2p, xu, Cu, Bu] = fullKalmanUpdateBatch(cfg, hits.z[p][ih], hits.y[p][ih], *[a[ib] for a in pred])
+        updated = [xu, Cu, Bu]
+        chi2cut = chi2 + chi2p
+      else:
+        [chi2, zu, Cu] = kalmanUpdateBatch(cfg, hits.z[p][ih], *[a[ib] for a in pred])
+        updated = [zu, Cu]
+        chi2cut = chi2
+      hsig = signal[ib] & np.logical_not(hits.noise[p][ih])
+      self.fillChi2(p, chi2[hsig])
+
+      ok = chi2cut <= cut
+      self.count("numberOfKalmanFilterCalls", len(ib))
+      self.countCut(p, len(ihits), np.count_nonzero(ok))
+      ib, ih = ib[ok], ih[ok]
+      newIseed = [iseed[ib]]
+      newIhits = [np.hstack([ihits[ib], ih[:,np.newaxis]])]
+      newState = [[a[ok] for a in updated]]
+      newChi2sum = [chi2sum[ib] + chi2[ok]]
+      newNholes = [nholes[ib]]
+      newSignal = [hsig[ok]]
+      newZKF = [np.hstack([zKF[ib], updated[0][ok][:,0:1]])]
+      newZKFpred = [np.hstack([zKFpred[ib], zp[ok][:,0:1]])]
+
+      # branches continuing without a hit in this plane
+      hole = nholes < maxHoles
+      if hole.any():
+        newIseed.append(iseed[hole])
+        newIhits.append(np.hstack([ihits[hole], np.full((hole.sum(),1), -1)]))
+        newState.append([a[hole] for a in pred])
+        newChi2sum.append(chi2sum[hole] + holeChi2)
+        newNholes.append(nholes[hole]+1)
+        newSignal.append(signal[hole])
+        newZKF.append(np.hstack([zKF[hole], zpred[hole][:,0:1]]))
+        newZKFpred.append(np.hstack([zKFpred[hole], zpred[hole][:,0:1]]))
+
+      # the branches of each seed together, in the same order as if the seed was extended alone
+      iseed = np.concatenate(newIseed)
+      bySeed = np.argsort(iseed, kind='stable')
+      iseed = iseed[bySeed]
+      ihits = np.vstack(newIhits)[bySeed]
+      state = [np.concatenate(a)[bySeed] for a in zip(*newState)]
+      chi2sum = np.concatenate(newChi2sum)[bySeed]
+      nholes = np.concatenate(newNholes)[bySeed]
+      signal = np.concatenate(newSignal)[bySeed]
+      zKF = np.vstack(newZKF)[bySeed]
+      zKFpred = np.vstack(newZKFpred)[bySeed]
+
+      # keep only the best branches of each seed
+      ranked = np.lexsort((chi2sum, iseed))
+      rank = np.arange(len(ranked)) - np.searchsorted(iseed[ranked], iseed[ranked], side='left')
+      if maxBranches is not None and (rank >= maxBranches).any():
+        keep = np.sort(ranked[rank < maxBranches])
+        iseed, ihits, state, chi2sum = iseed[keep], ihits[keep], [a[keep] for a in state], chi2sum[keep]
+        nholes, signal, zKF, zKFpred = nholes[keep], signal[keep], zKF[keep], zKFpred[keep]
+
+    return [[ihits[k].tolist(), chi2sum[k], zKF[k].tolist(), zKFpred[k].tolist(), nholes[k]] for k in range(len(ihits))]
+
+  # global chi2 fit of candidates [ihits, totchi2_KF, zHitsKF, zHitsKFpred, nholes],
+  # at once for the candidates with the same planes
+  # returns [chi2s, xs, Cs], the chi2 including the hole penalties
+  def globalFitBatch(self, candidates):
+
+    cfg = self.cfg
+    chi2s = np.zeros(len(candidates))
+    xs = np.zeros(shape=(len(candidates), cfg.nparameters))
+    Cs = len(candidates)*[None]
+    patterns = {}
+    self.count("numberOfGlobalChi2Calls", len(candidates))
+    for k, cand in enumerate(candidates):
+      patterns.setdefault(tuple(ihit>=0 for ihit in cand[0]), []).append(k)
+    for mask, ks in patterns.items():
+      M = self.measurementMatrix(np.array([candidates[k][0] for k in ks]), mask)
+      [chi2, x, C] = getGlobalFitOperator(cfg, mask).fitBatch(M)
+      chi2s[ks] = chi2 + cfg.holeChi2*np.array([candidates[k][4] for k in ks])
+      xs[ks] = x
+      for k in ks: Cs[k] = C
+    return [chi2s, xs, Cs]
+
+  # rank the candidates by their Kalman Filter chi2 and make a global chi2 fit of those which can be selected
+  # returns the fitted candidates [chi2, ihits, x, C], the chi2 including the hole penalties
+  def fitCandidates(self, candidates):
+
+    cfg = self.cfg
+    # The filter chi2 is the x-z part of the global chi2 (same measurements and multiple scattering model),
+    # so the total filter chi2 (which includes the hole penalties) is a lower bound of the global chi2 of the candidate
+    bound = np.array([cand[1] for cand in candidates])
+    order = np.argsort(bound, kind='stable')
+    if cfg.globalFitTopK is not None: order = order[:cfg.globalFitTopK]
+    if cfg.maxTracksPerEvent==1 and len(order)>1:
+      # only one track per event: the candidates with a bound above Cut3, or above the global chi2
+      # of the candidate with the best filter chi2, cannot be selected
+      [chi2best, x, C] = self.globalFitBatch([candidates[order[0]]])
+      limit = min(chi2best[0], cfg.Cut3)*(1.+1e-9)
+      order = np.concatenate([order[:1], order[1:][bound[order[1:]] <= limit]])
+    # keep the original order of the candidates, for the same choice between candidates of equal chi2
+    candidates = [candidates[k] for k in np.sort(order)]
+    [chi2s, xs, Cs] = self.globalFitBatch(candidates)
+
+    # keep the candidates for the event display
+    for itrk, [ihits, totchi2_KF, zHitsKF, zHitsKFpred, nh] in enumerate(candidates):
+      if(cfg.debug): print('zHitsKF:', zHitsKF)
+      self.displayCandidates.append([ihits, zHitsKF, zHitsKFpred, totchi2_KF, chi2s[itrk]])
+
+    return [[chi2s[k], list(candidates[k][0]), xs[k].reshape(cfg.nparameters,1), Cs[k]] for k in range(len(candidates))]
+
+  # Kalman Filter and RTS smoother in x-z for candidates of the current event, all at once
+  # ihits: list of the hit numbers of each candidate (-1 for a hole)
+  # returns [zSmoothed (N,nplane), z0 (N,2), C0 (N,2,2)]: the smoothed z in each plane,
+  # and the smoothed state (z, dz/dx) at plane 0 with its covariance
+  def smoothCandidates(self, ihits):
+
+    cfg, hits = self.cfg, self.hits
+    nplane = 2*cfg.numberOfPlanes
+    s2 = cfg.resolution*cfg.resolution
+    d = cfg.distBetweenPlanes
+    ihits = np.reshape(np.array(ihits, dtype=int), (-1,nplane))
+    n = len(ihits)
+    # filtered and predicted states and covariances in planes 1 to nplane-1
+    zF = np.zeros(shape=(n,nplane-1,2))
+    CF = np.zeros(shape=(n,nplane-1,2,2))
+    zP = np.zeros(shape=(n,nplane-1,2))
+    CP = np.zeros(shape=(n,nplane-1,2,2))
+
+    # the seed state at plane 1
+    z1 = hits.z[1][ihits[:,1]]
+    zF[:,0,0] = z1
+    zF[:,0,1] = (z1-hits.z[0][ihits[:,0]])/d
+    CF[:,0] = np.array([[s2, s2/d], [s2/d, 2*s2/d/d]])
+
+    for p in range(2, nplane):
+      hole = ihits[:,p]<0
+      zmeas = np.zeros(n)
+      if hits.nHits(p)>0: zmeas[~hole] = hits.z[p][ihits[~hole,p]]
+      [zpred, Cpz] = kalmanPredictBatch(cfg, zF[:,p-2], CF[:,p-2])
+      [chi2, znew, Cnew] = kalmanUpdateBatch(cfg, zmeas, zpred, Cpz)
+      zP[:,p-1], CP[:,p-1] = zpred, Cpz
+      # no update in a plane without hit
+      zF[:,p-1] = np.where(hole[:,np.newaxis], zpred, znew)
+      CF[:,p-1] = np.where(hole[:,np.newaxis,np.newaxis], Cpz, Cnew)
+
+    [zS, CS] = kalmanSmoothBatch(cfg, zF, CF, zP, CP)
+
+    # plane 0: straight line back from plane 1 (the scattering in plane 0 only changes the fitted slope)
+    Fback = np.array([[1., -d], [0., 1.]])
+    z0 = np.matmul(zS[:,0], Fback.T)
+    C0 = np.matmul(np.matmul(Fback, CS[:,0]), Fback.T)
+    zSmoothed = np.hstack([z0[:,0:1], zS[:,:,0]])
+    return [zSmoothed, z0, C0]
+
+  ## Several tracks per event: hit ownership
+  #
+  # The candidates of all seeds are found and fitted once. The tracks are then extracted in order of increasing chi2,
+  # with a table of the hits owned by the tracks already accepted:
+  # * a candidate without owned hits is accepted and its hits become owned by it,
+  # * a candidate sharing hits with an accepted track (which has a lower chi2) loses these hits: it is refitted
+  #   without them and put back in the queue, provided it keeps its seed hits and at most maxHoles holes.
+  # The extraction stops when the best remaining candidate fails Cut3, or after maxTracksPerEvent tracks.
+  # The combinatorics is not restarted for each track, so the time grows about linearly with the number of tracks.
+  def resolveTracks(self, fitted):
+
+    cfg, hits = self.cfg, self.hits
+    numberOfPlanes = cfg.numberOfPlanes
+    # hit-ownership table: number of the track owning each hit, -1 if free
+    owner = [np.full(hits.nHits(j), -1) for j in range(2*numberOfPlanes)]
+    queue = [(chi2, k, ihits, x, C) for k, [chi2, ihits, x, C] in enumerate(fitted)]
+    heapq.heapify(queue)
+    tracks = []
+    while len(queue)>0 and len(tracks)<cfg.maxTracksPerEvent:
+      (chi2, k, ihits, x, C) = heapq.heappop(queue)
+      if(chi2>cfg.Cut3): break
+      shared = [j for j in range(2*numberOfPlanes) if ihits[j]>=0 and owner[j][ihits[j]]>=0]
+      if len(shared)==0:
+        for j in range(2*numberOfPlanes):
+          if(ihits[j]>=0): owner[j][ihits[j]] = len(tracks)
+        tracks.append([chi2, ihits, x, C])
+        continue
+
+      # the shared hits stay with the accepted track
+      ihits = list(ihits)
+      for j in shared: ihits[j] = -1
+      nholes = ihits.count(-1)
+      if(ihits[0]<0 or ihits[1]<0 or nholes>cfg.maxHoles): continue
+      if(cfg.nparameters>4 and max(ihits[numberOfPlanes:])<0): continue
+      [chi2, x, C] = self.globalChi2(ihits, x, C)
+      heapq.heappush(queue, (chi2 + cfg.holeChi2*nholes, k, ihits, x, C))
+
+    return tracks
+
+# Results
+# =================
 #
-print(" Generated Tracks " , numberOfEvents )
-print(" Reconstructed Tracks " , numberOfReconstructedTracks )
-print(" Reconstructed Tracks without noise hits " , numberOfGoodReconstructedTracks )
-print(" Tracks lost due to missing hit " , numberOfInefficientTracks )
-print(" Tracks lost to quality cuts " , numberOfRejectedTracks )
-print(" Tracks with no noise hits lost to quality cuts " , numberOfGoodRejectedTracks )
-print(" Total hits " , nTotalHits )
-print(" Used noise hits  " , nNoiseHitsOnTrack )
-print(" Hits per track is always " , 2*numberOfPlanes )
-
+## Columnar track output
 #
-# Plot the results (fit parameter - truth),
-#      the pulls ( (fit parameter - truth)/ parameter error )
-#      and the chisquared (hit-fit)^2/hit error^2.
-
-R.gStyle.SetOptFit(1011)
-R.gStyle.SetErrorX(0)
-
-
-"""
-c1 = R.TCanvas("c1"," intercept ",50,50,800,600)
-c1.GetFrame().SetFillColor(0)
-c1.GetFrame().SetBorderSize(20)
-h1.SetMarkerColor(1)
-h1.SetMarkerStyle(20)
-h1.GetXaxis().SetTitle(" y0 residual (cm)")
-h1.Draw("AP")
-h1.Fit("gaus")
-h1.Draw("same")
-
-c2 = R.TCanvas("c2"," intercept ",70,70,800,600)
-c2.GetFrame().SetFillColor(0)
-c2.GetFrame().SetBorderSize(20)
-h2.GetXaxis().SetTitle(" z0 residual (cm)")
-h2.Draw("AP")
-h2.Fit("gaus")
-h2.Draw("same")
-
-c3 = R.TCanvas("c3"," y slope ",80,80,800,600)
-c3.GetFrame().SetFillColor(0)
-c3.GetFrame().SetBorderSize(20)
-h3.GetXaxis().SetTitle(" ty residual")
-h3.Draw("AP")
-h3.Fit("gaus")
-h3.Draw("same")
-
-c4 = R.TCanvas("c4"," z slope ",90,90,800,600)
-c4.GetFrame().SetFillColor(0)
-c4.GetFrame().SetBorderSize(20)
-h4.GetXaxis().SetTitle(" tz residual")
-h4.Draw("AP")
-h4.Fit("gaus")
-h4.Draw("same")
-"""
-
-c5 = R.TCanvas("c5","1/p",100,100,800,600)
-c5.GetFrame().SetFillColor(0)
-c5.GetFrame().SetBorderSize(20)
-h5.GetXaxis().SetTitle("fitted 1/p residual GeV-1")
-h5.Draw()
-h5.Fit("gaus")
-h5.Draw("same")
-
-
-c6 = R.TCanvas("c6","y0 pull",120,120,800,600)
-c6.GetFrame().SetFillColor(0)
-c6.GetFrame().SetBorderSize(20)
-h6.GetXaxis().SetTitle("y0 pull")
-h6.Draw()
-h6.Fit("gaus")
-h6.Draw("same")
-"""
-c7 = R.TCanvas("c7","z0 pull",130,130,800,600)
-c7.GetFrame().SetFillColor(0)
-c7.GetFrame().SetBorderSize(20)
-h7.GetXaxis().SetTitle("z0 pull")
-h7.Draw()
-h7.Fit("gaus")
-h7.Draw("same")
+# The reconstructed tracks are stored one row per track in a numpy structured array with the columns:
+# * the fitted track parameters at plane 0: z0, tz (dz/dx), y0, ty (dy/dx) and pinv (1/p),
+# * the same with suffix True for the truth, and with suffix Err for their errors,
+# * chi2 (global chi2 of the selected candidate) and chi2Refit (refit of the selected track),
+# * event (event number), nNoiseHits (noise hits on the track), particle (MC truth particle number,
+#   -1 for a track with noise hits or hits of several particles) and hits (hit number in each plane, -1 for a hole)
+trackParameters = ["z0", "tz", "y0", "ty", "pinv"]
+
+def trackColumns(numberOfPlanes):
+  columns = [(par+suffix, np.float64) for suffix in ["", "True", "Err"] for par in trackParameters]
+  columns += [("chi2", np.float64), ("chi2Refit", np.float64), ("event", np.int64), ("nNoiseHits", np.int32),
+              ("particle", np.int32), ("hits", np.int32, (2*numberOfPlanes,))]
+  return np.dtype(columns)
+
+# leaf list of each column, for the TTree branches
+def trackLeaf(dtype, name):
+  [base, shape] = [dtype[name].base, dtype[name].shape]
+  leafType = {np.dtype(np.float64): "D", np.dtype(np.int64): "L", np.dtype(np.int32): "I"}[base]
+  return name + "".join("["+str(n)+"]" for n in shape) + "/" + leafType
+
+# C++ loop filling a TTree from a buffer of rows (structured array): each row of rowSize bytes is copied
+# to the row the branches point to, then the tree is filled
+fillRowsCode = """
+#include <cstring>
+void kfFillRows(TTree* tree, const unsigned char* rows, unsigned char* row, Long64_t n, Long64_t rowSize) {
+  for (Long64_t i = 0; i < n; ++i) {
+    std::memcpy(row, rows + i*rowSize, rowSize);
+    tree->Fill();
+  }
+}
 """
-c8 = R.TCanvas("c8","y slope pull",140,140,800,600)
-c8.GetFrame().SetFillColor(0)
-c8.GetFrame().SetBorderSize(20)
-h8.GetXaxis().SetTitle("y slope pull")
-h8.Draw()
-h8.Fit("gaus")
-h8.Draw("same")
-
-"""
-c9 = R.TCanvas("c9","z slope pull ",140,140,800,600)
-c9.GetFrame().SetFillColor(0)
-c9.GetFrame().SetBorderSize(20)
-h9.GetXaxis().SetTitle("z slope pull")
-h9.Draw()
-h9.Fit("gaus")
-h9.Draw("same")
-"""
-
-c10 = R.TCanvas("c10"," 1/p pull",140,140,800,600)
-c10.GetFrame().SetFillColor(0)
-c10.GetFrame().SetBorderSize(20)
-h10.GetXaxis().SetTitle(" 1/p pull")
-h10.Draw()
-h10.Fit("gaus")
-h10.Draw("same")
 
+# The tracks of a .npz track file (trackOutput="npz"), as one structured array.
+# The file holds the columns of each flushed chunk k as the arrays "chunk<k>/<column>".
+def readTracks(fileName):
+  with np.load(fileName) as f:
+    chunks = []
+    while "chunk"+str(len(chunks))+"/event" in f.files:
+      prefix = "chunk"+str(len(chunks))+"/"
+      columns = [name[len(prefix):] for name in f.files if name.startswith(prefix)]
+      chunk = np.zeros(len(f[prefix+"event"]), dtype=np.dtype([(name, f[prefix+name].dtype, f[prefix+name].shape[1:]) for name in columns]))
+      for name in columns: chunk[name] = f[prefix+name]
+      chunks.append(chunk)
+  if len(chunks)==0: return None
+  return np.concatenate(chunks)
+
+# The ResultSink books the histograms, sums the counters, stores the tracks and draws the selected events.
+# outfile: the ROOT file receiving the event displays, the histograms and the tracks (None: nothing is written,
+# the tracks are kept in memory, see trackTable).
+# The file is only opened when something is written to it.
+# The tracks are buffered trackChunkSize at a time; when the buffer is flushed, the residual, pull and chi2
+# histograms are filled from the whole buffer at once and the tracks are written.
+class ResultSink:
+
+  # counters summed over all events
+  counterNames = ["numberOfReconstructedTracks", "numberOfGoodReconstructedTracks", "nTotalHits", "nNoiseHitsOnTrack",
+                  "numberOfInefficientTracks", "numberOfRejectedTracks", "numberOfGoodRejectedTracks",
+                  "numberOfSeeds", "numberOfRejectedSeeds",
+                  "numberOfCut1Candidates", "numberOfCut1Passed", "numberOfCut2Candidates", "numberOfCut2Passed",
+                  "numberOfCut3Candidates", "numberOfCut3Passed", "numberOfKalmanFilterCalls", "numberOfGlobalChi2Calls"]
+  # stages of the event processing timed by the sink
+  stageNames = ["simulate", "seed", "filter", "globalFit", "store", "draw"]
+
+  def __init__(self, cfg, outfile="kf_result.root"):
+    self.cfg = cfg
+    self.outfile = outfile
+    self.fout = None
+    self.ch = None
+    self.numberOfEvents = 0
+
+    # counts
+    self.numberOfReconstructedTracks=0
+    self.numberOfGoodReconstructedTracks=0
+    self.nTotalHits=                 0
+    self.nNoiseHitsOnTrack=          0
+    self.numberOfInefficientTracks=0
+    self.numberOfRejectedTracks=0
+    self.numberOfGoodRejectedTracks=0
+    self.numberOfSeeds=0             # hit pairs in planes 0 and 1 used as seeds
+    self.numberOfRejectedSeeds=0     # hit pairs of the beam profile rejected by the seed slope window
+
+    # instrumentation: candidates entering and passing the cuts, Kalman filter updates and global fits (the filter and
+    # the fit run on many candidates at once, each candidate counts as one call), wall time per stage and of the run
+    self.numberOfCut1Candidates=0    # branch-hit combinations in plane 2
+    self.numberOfCut1Passed=0
+    self.numberOfCut2Candidates=0    # branch-hit combinations in the next planes
+    self.numberOfCut2Passed=0
+    self.numberOfCut3Candidates=0    # candidates of the Kalman filter
+    self.numberOfCut3Passed=0        # tracks selected
+    self.numberOfKalmanFilterCalls=0
+    self.numberOfGlobalChi2Calls=0
+    self.stageTime = dict((stage, 0.) for stage in self.stageNames)  # (s)
+    self.wallTime = 0.               # (s), set by run
+
+    # Book histograms
+    beamMomentum = cfg.beamMomentum
+    self.h1 = R.TH1F("h1","y0 residuals",100,-.005,.005)
+    self.h2 = R.TH1F("h2","z0 residuals",100,-.005,.005)
+    self.h3 = R.TH1F("h3","ty residuals",100,-.025,.025)
+    self.h4 = R.TH1F("h4","tz residuals",100,-.025,.025)
+    self.h5 = R.TH1F("h5","1/p residuals",100,-1./beamMomentum,1./beamMomentum)
+    self.h6 = R.TH1F("h6","y0 pull",100,-10.,10.)
+    self.h7 = R.TH1F("h7","z0 pull",100,-10.,10.)
+    self.h8 = R.TH1F("h8"," ty pull ",100,-10.,10.)
+    self.h9 = R.TH1F("h9"," tz pull ",100,-10.,10.)
+    self.h10 = R.TH1F("h10"," 1/p pull ",100,-10.,10.)
+    self.h11 = R.TH1F("h11"," z chisquared at plane 2 ",80,0.,24.)
+    self.h12 = R.TH1F("h12"," z chisquared at plane 3 ",80,0.,24.)
+    self.h13 = R.TH1F("h13"," total chisquared ",80,0.,24.)
+    self.h14 = R.TH1F("h14"," total chisquared ",80,0.,24.)
+    self.h15 = R.TH1F("h15"," z chisquared at plane 4",80,0.,24.)
+    self.h16 = R.TH1F("h16"," z chisquared at plane 5",80,0.,24.)
+    self.histograms = [self.h1, self.h2, self.h3, self.h4, self.h5, self.h6, self.h7, self.h8,
+                       self.h9, self.h10, self.h11, self.h12, self.h13, self.h14, self.h15, self.h16]
+    # the histograms belong to the sink, not to the current ROOT directory (several sinks can coexist)
+    for h in self.histograms: h.SetDirectory(0)
+
+    # buffer of the tracks not yet flushed, and the flushed tracks kept in memory (no output file)
+    self.trackBuffer = np.zeros(cfg.trackChunkSize, dtype=trackColumns(cfg.numberOfPlanes))
+    self.nBufferedTracks = 0
+    self.trackChunks = []
+    self.tree = None
+    self.treeRow = None
+    self.nTrackFileChunks = 0
+    self.trackFileName = None
+    if outfile is not None: self.trackFileName = os.path.splitext(outfile)[0]+"_tracks.npz"
+
+    self.displayRng = np.random.default_rng(cfg.displaySeed)
+    self.gr_xz_sig = None
+    self.gr_xz_noise = None
+
+  # the output file, opened on first use
+  def file(self):
+    if self.fout is None: self.fout = R.TFile(self.outfile, "RECREATE")
+    return self.fout
+
+  # add the time since t0 (time.perf_counter) to the stage
+  # returns the current time
+  def addTime(self, stage, t0):
+    t = time.perf_counter()
+    self.stageTime[stage] += t - t0
+    return t
+
+  # chi2 monitoring histogram of each plane
+  def chi2Histogram(self, p):
+    if p==2: return self.h11
+    if p==3: return self.h12
+    if p==4: return self.h15
+    if p==5: return self.h16
+    return None
+
+  # Store tracks
+  # =================
+  # xbest and Cbest are the fitted parameters and their covariance matrix (flattened),
+  # chi2 and chi2Refit the global chi2 of the selected candidate and of the refit
+  def storeTrack(self, hits, evtIndex, ibest, xbest, Cbest, chi2, chi2Refit):
+    cfg = self.cfg
+    debug = cfg.debug
+    track = self.trackBuffer[self.nBufferedTracks]
+    #
+    #fitted z intercept at plane 0
+    track["z0"] = xbest[0]
+    if(debug): print(" z0 ", track["z0"])
+    #fitted z slope at plane 0
+    track["tz"] = xbest[1]
+    if(debug): print(" dz/dx " , track["tz"] )
+    #y intercept at plane 0
+    track["y0"] = hits.y[0][ibest[0]]
+    if(debug): print(" y0 " , track["y0"] )
+    track["ty"] = (hits.y[1][ibest[1]]-hits.y[0][ibest[0]])/cfg.distBetweenPlanes
+    if(debug): print(" dy/dx " , track["ty"] )
+    #charge/momentum
+    track["pinv"] = xbest[4]
+    if(debug): print(" 1/p " , track["pinv"] )
+    #truth
+    particle = hits.trackParticle(ibest)
+    track["z0True"] = hits.start[particle][1] if particle>=0 else 0.
+    track["tzTrue"] = cfg.thetaxz
+    track["y0True"] = hits.start[particle][0] if particle>=0 else 0.
+    track["tyTrue"] = 0.
+    track["pinvTrue"] = 1/cfg.beamMomentum
+    #errors
+    track["z0Err"] = sqrt( Cbest[0] )
+    if(debug): print(" Dz0 " , track["z0Err"] )
+    track["tzErr"] = sqrt( Cbest[5+1] )
+    if(debug): print(" Ddz/dx " , track["tzErr"] )
+    track["y0Err"] = sqrt( Cbest[2*5+2])
+    if(debug): print(" Dy0 " , track["y0Err"] )
+    track["tyErr"] = sqrt(Cbest[3*5+3])
+    if(debug): print(" Ddy/dx " , track["tyErr"] )
+    track["pinvErr"] = sqrt( Cbest[4*5+4] )
+    if(debug): print(" D1/p " , track["pinvErr"] )
+
+    track["chi2"] = chi2
+    track["chi2Refit"] = chi2Refit
+    track["event"] = evtIndex
+    track["hits"] = ibest
+    track["nNoiseHits"] = sum(1 for j in range(len(ibest)) if ibest[j]>=0 and hits.noise[j][ibest[j]])
+    track["particle"] = particle
+
+    self.nBufferedTracks += 1
+    if self.nBufferedTracks == len(self.trackBuffer): self.flushTracks()
+
+  # fill the histograms from the buffered tracks and write them
+  def flushTracks(self):
+    if self.nBufferedTracks == 0: return
+    tracks = self.trackBuffer[:self.nBufferedTracks]
+    self.fillHistograms(tracks)
+    self.writeTracks(tracks)
+    self.nBufferedTracks = 0
+
+  # bulk filling of the residual, pull and chi2 histograms
+  def fillHistograms(self, tracks):
+    n = len(tracks)
+    weights = np.ones(n)
+    for [hres, hpull, par] in [[self.h1, self.h6, "y0"], [self.h2, self.h7, "z0"], [self.h3, self.h8, "ty"],
+                               [self.h4, self.h9, "tz"], [self.h5, self.h10, "pinv"]]:
+      residual = tracks[par] - tracks[par+"True"]
+      hres.FillN(n, residual, weights)
+      hpull.FillN(n, residual/tracks[par+"Err"], weights)
+    self.h13.FillN(n, np.ascontiguousarray(tracks["chi2"]), weights)
+    self.h14.FillN(n, np.ascontiguousarray(tracks["chi2Refit"]), weights)
+
+  # write tracks (a structured array with the columns of trackColumns) to the track output
+  def writeTracks(self, tracks):
+    if self.cfg.trackOutput is None or len(tracks)==0: return
+    if self.outfile is None:
+      self.trackChunks.append(tracks.copy())
+    elif self.cfg.trackOutput == "tree":
+      if self.tree is None:
+        self.file().cd()
+        self.treeRow = np.zeros(1, dtype=tracks.dtype)
+        self.tree = R.TTree("tracks", "reconstructed tracks")
+        for name in tracks.dtype.names:
+          self.tree.Branch(name, self.treeRow[name], trackLeaf(tracks.dtype, name))
+        if not hasattr(R, "kfFillRows"): R.gInterpreter.Declare(fillRowsCode)
+      # the whole chunk in one call, the rows are copied to treeRow and filled in C++
+      R.kfFillRows(self.tree, np.ascontiguousarray(tracks).view(np.uint8), self.treeRow.view(np.uint8),
+                   len(tracks), tracks.dtype.itemsize)
+    elif self.cfg.trackOutput == "npz":
+      # append the columns of this chunk to the zip archive (same layout as np.savez)
+      mode = "a" if self.nTrackFileChunks > 0 else "w"
+      with zipfile.ZipFile(self.trackFileName, mode, zipfile.ZIP_STORED) as zf:
+        for name in tracks.dtype.names:
+          with zf.open("chunk"+str(self.nTrackFileChunks)+"/"+name+".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, np.ascontiguousarray(tracks[name]))
+      self.nTrackFileChunks += 1
+    else:
+      raise ValueError("unknown trackOutput "+str(self.cfg.trackOutput))
 
-c11 = R.TCanvas("c11"," chi2 ",150,150,800,600)
-c11.GetFrame().SetFillColor(0)
-c11.GetFrame().SetBorderSize(20)
-h11.GetXaxis().SetTitle(" chi2(z) at plane 2")
-h11.Draw()
+  # the tracks kept in memory (no output file), as one structured array
+  def trackTable(self):
+    self.flushTracks()
+    if len(self.trackChunks)==0: return np.zeros(0, dtype=self.trackBuffer.dtype)
+    if len(self.trackChunks)>1: self.trackChunks = [np.concatenate(self.trackChunks)]
+    return self.trackChunks[0]
 
-"""
-c15 = R.TCanvas("c15"," chi2 ",155,155,800,600)
-c15.GetFrame().SetFillColor(0)
-c15.GetFrame().SetBorderSize(20)
-h15.GetXaxis().SetTitle(" chi2(z) at plane 4")
-h15.Draw()
-
-c12 = R.TCanvas("c12"," chi2 ",160,160,800,600)
-c12.GetFrame().SetFillColor(0)
-c12.GetFrame().SetBorderSize(20)
-h12.GetXaxis().SetTitle(" chi2(z) at plane 3")
-h12.Draw()
-
-c16 = R.TCanvas("c16"," chi2 ",165,165,800,600)
-c16.GetFrame().SetFillColor(0)
-c16.GetFrame().SetBorderSize(20)
-h16.GetXaxis().SetTitle(" chi2(z) at plane 5")
-h16.Draw()
-"""
-
-c13 = R.TCanvas("c13"," chi2 ",170,170,800,600)
-c13.GetFrame().SetFillColor(0)
-c13.GetFrame().SetBorderSize(20)
-h13.GetXaxis().SetTitle(" global chi2 with fixed MS error")
-h13.Draw()
+  ## Display policy
+  #
+  # Drawing is kept out of the reconstruction: the reconstruction only records the track candidates
+  # of the current event, and the event is drawn at the end if it is selected by displayMode.
+  def displaySelected(self, evtIndex, rejected, noisy):
+    cfg = self.cfg
+    if cfg.displayMode == "first": return evtIndex < cfg.displayFirstN
+    if cfg.displayMode == "random": return self.displayRng.random() < cfg.displayFraction
+    if cfg.displayMode == "condition":
+      if callable(cfg.displayCondition): return cfg.displayCondition(evtIndex, rejected, noisy)
+      if cfg.displayCondition == "rejected": return rejected
+      if cfg.displayCondition == "noise": return noisy
+    return False
+
+  # the track candidates are taken from the tracker (Tracker.displayCandidates),
+  # their smoothed hits are only computed for the events drawn
+  def showEvent(self, hits, evtIndex, rejected, noisy, tracker):
+    if not self.displaySelected(evtIndex, rejected, noisy): return
+    self.drawHits(hits, evtIndex)
+    candidates = tracker.displayCandidates
+    if len(candidates)==0: return
+    [zSmoothed, z0, C0] = tracker.smoothCandidates([cand[0] for cand in candidates])
+    for itrk, [ihits, zHitsKF, zHitsKFpred, totchi2_KF, totchi2_KFfit] in enumerate(candidates):
+      self.showKFposterior(evtIndex, zHitsKF, zHitsKFpred, zSmoothed[itrk], totchi2_KF, totchi2_KFfit, itrk)
+
+  # save the event display as png and in the output file
+  def saveCanvas(self, name):
+    self.ch.SaveAs(name+".png")
+    if self.outfile is None: return
+    self.file().cd()
+    self.ch.Write(name)
+
+  ## Plotting
+  #
+  # Draw hits in the x-z plane
+  def drawHits(self, hits, evtIndex):
+
+    if self.ch is None:
+      self.ch = R.TCanvas("chits","Hits",50,50,800,600)
+      self.ch.GetFrame().SetFillColor(0)
+      self.ch.GetFrame().SetBorderSize(20)
+    ch = self.ch
+    xHits = self.cfg.xHits
+
+    nhitsAll, nhitsSig, nhitsNoise=0, 0, 0
+    for j in range(2*self.cfg.numberOfPlanes):
+      nhitsAll += hits.nHits(j)
+      nhitsNoise += np.count_nonzero(hits.noise[j])
+
+    nhitsSig = nhitsAll - nhitsNoise
+    # Signal hits
+    self.gr_xz_sig = R.TGraph(nhitsSig)
+    self.gr_xz_sig.SetMarkerStyle(20)
+    # Noise hits
+    self.gr_xz_noise = R.TGraph(nhitsNoise)
+    self.gr_xz_noise.SetMarkerStyle(24)
+
+    # Loop all hits
+    isig, inoise=0, 0
+    for j in range(2*self.cfg.numberOfPlanes):
+      for k in range(hits.nHits(j)):
+        if(hits.noise[j][k]):
+          self.gr_xz_noise.SetPoint(inoise, xHits[j], hits.z[j][k])
+          inoise+=1
+        else:
+          self.gr_xz_sig.SetPoint(isig, xHits[j], hits.z[j][k])
+          isig+=1
+
+    ch.cd()
+    htmp=ch.DrawFrame(-5, -1, 45, 1.2)
+    htmp.GetXaxis().SetTitle("X [cm]")
+    htmp.GetYaxis().SetTitle("Z [cm]")
+    self.gr_xz_sig.Draw("P")
+    self.gr_xz_noise.Draw("Psame")
+
+    leg = R.TLegend(0.6, 0.7, 0.9, 0.9)
+    leg.SetFillColor(R.kWhite)
+    leg.SetBorderSize(0)
+    leg.SetTextSize(0.040)
+    leg.AddEntry(self.gr_xz_sig, "Signal hits", "p")
+    leg.AddEntry(self.gr_xz_noise, "Noise hits", "p")
+    leg.Draw()
+
+    ch.Draw()
+
+    self.saveCanvas("event_"+str(evtIndex))
+
+  # Draw hits of the track candidate found by the Kalman Filter
+  def showKFposterior(self, evtIndex, zHitsKF, zHitsKFpred, zHitsSmoothed, totchi2_KF, totchi2_KFfit, itrk):
+
+    ch = self.ch
+    xHits = self.cfg.xHits
+    nhits = 2*self.cfg.numberOfPlanes
+    gr_kf = R.TGraph(nhits)
+    gr_kf_pred = R.TGraph(nhits)
+    ic = R.kMagenta + itrk
+    gr_kf.SetMarkerColor(ic)
+    gr_kf.SetLineColor(ic)
+    gr_kf.SetMarkerStyle(29)
+    gr_kf_pred.SetMarkerColor(ic)
+    gr_kf_pred.SetLineColor(ic)
+    gr_kf_pred.SetMarkerStyle(34)
+    gr_kf_smooth = R.TGraph(nhits)
+    gr_kf_smooth.SetMarkerColor(ic)
+    gr_kf_smooth.SetLineColor(ic)
+    gr_kf_smooth.SetLineStyle(2)
+    gr_kf_smooth.SetMarkerStyle(33)
+
+    # Loop all hits
+    ih=0
+    for j in range(nhits):
+      gr_kf.SetPoint(ih, xHits[j], zHitsKF[j])
+      gr_kf_pred.SetPoint(ih, xHits[j], zHitsKFpred[j])
+      gr_kf_smooth.SetPoint(ih, xHits[j], zHitsSmoothed[j])
+      ih+=1
+
+    ch.cd()
+    gr_kf.Draw("Pcsame")
+    gr_kf_pred.Draw("Pcsame")
+    gr_kf_smooth.Draw("Pcsame")
+
+    leg = R.TLegend(0.6, 0.7, 0.9, 0.9)
+    leg.SetFillColor(R.kWhite)
+    leg.SetBorderSize(0)
+    leg.SetTextSize(0.040)
+    leg.AddEntry(self.gr_xz_sig, "Signal hits", "p")
+    leg.AddEntry(self.gr_xz_noise, "Noise hits", "p")
+    leg.AddEntry(gr_kf_pred, "Predicted hits (Kalman)", "pl")
+    leg.AddEntry(gr_kf, "Updated hits (Kalman)", "pl")
+    leg.AddEntry(gr_kf_smooth, "Smoothed hits (Kalman)", "pl")
+    leg.Draw()
+
+    tl=R.TPaveText(0.6, 0.6, 0.9, 0.7, "NDC")
+    tl.SetFillColor(R.kWhite)
+    tl.SetBorderSize(0)
+    tl.SetTextSize(0.04)
+    tl.AddText("#chi^{{2}} (Kalman)= {:.3e}".format(totchi2_KF))
+    tl.AddText("#chi^{{2}} (fit)= {:.3e}".format(totchi2_KFfit))
+    tl.Draw()
+
+    ch.Draw()
+
+    self.saveCanvas("event_"+str(evtIndex)+"_trk_"+str(itrk))
+
+  # the counters, (detached copies of) the histograms and the tracks kept in memory,
+  # e.g. to send them back from a worker process
+  def results(self):
+    tracks = self.trackTable()
+    counts = dict((name, getattr(self, name)) for name in self.counterNames)
+    counts["numberOfEvents"] = self.numberOfEvents
+    counts["stageTime"] = dict(self.stageTime)
+    hists = []
+    for h in self.histograms:
+      hw = h.Clone()
+      hw.SetDirectory(0)
+      hists.append(hw)
+    return [counts, hists, tracks]
+
+  # add the counters, histograms and tracks returned by results() of another sink
+  # (the histograms of the other sink already include its tracks)
+  def merge(self, counts, hists, tracks):
+    for name in self.counterNames: setattr(self, name, getattr(self, name) + counts[name])
+    self.numberOfEvents += counts["numberOfEvents"]
+    for stage in self.stageNames: self.stageTime[stage] += counts["stageTime"][stage]
+    for h, hw in zip(self.histograms, hists): h.Add(hw)
+    self.writeTracks(tracks)
+
+  def printSummary(self):
+    #
+    print(" Generated Tracks " , self.numberOfEvents*self.cfg.particlesPerEvent )
+    print(" Reconstructed Tracks " , self.numberOfReconstructedTracks )
+    print(" Reconstructed Tracks without noise hits " , self.numberOfGoodReconstructedTracks )
+    print(" Tracks lost due to missing hit " , self.numberOfInefficientTracks )
+    print(" Tracks lost to quality cuts " , self.numberOfRejectedTracks )
+    print(" Tracks with no noise hits lost to quality cuts " , self.numberOfGoodRejectedTracks )
+    print(" Total hits " , self.nTotalHits )
+    print(" Used noise hits  " , self.nNoiseHitsOnTrack )
+    print(" Hits per track is always " , 2*self.cfg.numberOfPlanes, " minus at most ", self.cfg.maxHoles, " holes" )
+    print(" Seeds " , self.numberOfSeeds , " rejected by the slope window " , self.numberOfRejectedSeeds )
+    print(" Candidates in/out  Cut1 " , self.numberOfCut1Candidates , self.numberOfCut1Passed ,
+          " Cut2 " , self.numberOfCut2Candidates , self.numberOfCut2Passed , " Cut3 " , self.numberOfCut3Candidates , self.numberOfCut3Passed )
+    print(" Kalman filter calls " , self.numberOfKalmanFilterCalls , " global chi2 calls " , self.numberOfGlobalChi2Calls )
+    print(" Time (s) " , " ".join(stage+" %.3f" % self.stageTime[stage] for stage in self.stageNames) ,
+          " events per second " , "%.1f" % self.summary()["eventsPerSecond"] )
+
+  ## Run summary
+  #
+  # The counters, the cut flow, the time per stage and the throughput as a dictionary, written as JSON by writeSummary,
+  # to compare runs (e.g. throughput regressions when the geometry or the cuts change).
+  # With several workers the stage times are summed over the workers, the throughput uses the wall time of the run
+  # (or the summed stage times, if the events were not processed by run).
+  def summary(self):
+    cfg = self.cfg
+    wallTime = self.wallTime if self.wallTime>0. else sum(self.stageTime.values())
+    cuts = {}
+    for cut, value in [("Cut1", cfg.Cut1), ("Cut2", cfg.Cut2), ("Cut3", cfg.Cut3)]:
+      cuts[cut] = {"value": value, "in": getattr(self, "numberOf"+cut+"Candidates"), "out": getattr(self, "numberOf"+cut+"Passed")}
+    return {
+      "config": dict((name, getattr(cfg, name)) for name in ["numberOfPlanes", "distBetweenPlanes", "beamMomentum", "particlesPerEvent",
+                                                           "noiseOccupancy", "hitEfficiency", "useCKF", "fullKalmanFilter",
+                                                           "hitIndex", "maxTracksPerEvent", "batchSimulation", "nWorkers"]),
+      "numberOfEvents": self.numberOfEvents,
+      "wallTime": wallTime,
+      "eventsPerSecond": self.numberOfEvents/wallTime if wallTime>0. else 0.,
+      "stageTime": dict(self.stageTime),
+      "cuts": cuts,
+      "kalmanFilterCalls": self.numberOfKalmanFilterCalls,
+      "globalChi2Calls": self.numberOfGlobalChi2Calls,
+      "counters": dict((name, getattr(self, name)) for name in self.counterNames),
+    }
+
+  def writeSummary(self, fileName):
+    with open(fileName, "w") as f: json.dump(self.summary(), f, indent=2)
+
+  def plot(self):
+    #
+    # Plot the results (fit parameter - truth),
+    #      the pulls ( (fit parameter - truth)/ parameter error )
+    #      and the chisquared (hit-fit)^2/hit error^2.
+
+    R.gStyle.SetOptFit(1011)
+    R.gStyle.SetErrorX(0)
+
+
+    """
+    c1 = R.TCanvas("c1"," intercept ",50,50,800,600)
+    c1.GetFrame().SetFillColor(0)
+    c1.GetFrame().SetBorderSize(20)
+    self.h1.SetMarkerColor(1)
+    self.h1.SetMarkerStyle(20)
+    self.h1.GetXaxis().SetTitle(" y0 residual (cm)")
+    self.h1.Draw("AP")
+    self.h1.Fit("gaus")
+    self.h1.Draw("same")
+
+    c2 = R.TCanvas("c2"," intercept ",70,70,800,600)
+    c2.GetFrame().SetFillColor(0)
+    c2.GetFrame().SetBorderSize(20)
+    self.h2.GetXaxis().SetTitle(" z0 residual (cm)")
+    self.h2.Draw("AP")
+    self.h2.Fit("gaus")
+    self.h2.Draw("same")
+
+    c3 = R.TCanvas("c3"," y slope ",80,80,800,600)
+    c3.GetFrame().SetFillColor(0)
+    c3.GetFrame().SetBorderSize(20)
+    self.h3.GetXaxis().SetTitle(" ty residual")
+    self.h3.Draw("AP")
+    self.h3.Fit("gaus")
+    self.h3.Draw("same")
+
+    c4 = R.TCanvas("c4"," z slope ",90,90,800,600)
+    c4.GetFrame().SetFillColor(0)
+    c4.GetFrame().SetBorderSize(20)
+    self.h4.GetXaxis().SetTitle(" tz residual")
+    self.h4.Draw("AP")
+    self.h4.Fit("gaus")
+    self.h4.Draw("same")
+    """
+
+    c5 = R.TCanvas("c5","1/p",100,100,800,600)
+    c5.GetFrame().SetFillColor(0)
+    c5.GetFrame().SetBorderSize(20)
+    self.h5.GetXaxis().SetTitle("fitted 1/p residual GeV-1")
+    self.h5.Draw()
+    self.h5.Fit("gaus")
+    self.h5.Draw("same")
+
+
+    c6 = R.TCanvas("c6","y0 pull",120,120,800,600)
+    c6.GetFrame().SetFillColor(0)
+    c6.GetFrame().SetBorderSize(20)
+    self.h6.GetXaxis().SetTitle("y0 pull")
+    self.h6.Draw()
+    self.h6.Fit("gaus")
+    self.h6.Draw("same")
+    """
+    c7 = R.TCanvas("c7","z0 pull",130,130,800,600)
+    c7.GetFrame().SetFillColor(0)
+    c7.GetFrame().SetBorderSize(20)
+    self.h7.GetXaxis().SetTitle("z0 pull")
+    self.h7.Draw()
+    self.h7.Fit("gaus")
+    self.h7.Draw("same")
+    """
+    c8 = R.TCanvas("c8","y slope pull",140,140,800,600)
+    c8.GetFrame().SetFillColor(0)
+    c8.GetFrame().SetBorderSize(20)
+    self.h8.GetXaxis().SetTitle("y slope pull")
+    self.h8.Draw()
+    self.h8.Fit("gaus")
+    self.h8.Draw("same")
+
+    """
+    c9 = R.TCanvas("c9","z slope pull ",140,140,800,600)
+    c9.GetFrame().SetFillColor(0)
+    c9.GetFrame().SetBorderSize(20)
+    self.h9.GetXaxis().SetTitle("z slope pull")
+    self.h9.Draw()
+    self.h9.Fit("gaus")
+    self.h9.Draw("same")
+    """
+
+    c10 = R.TCanvas("c10"," 1/p pull",140,140,800,600)
+    c10.GetFrame().SetFillColor(0)
+    c10.GetFrame().SetBorderSize(20)
+    self.h10.GetXaxis().SetTitle(" 1/p pull")
+    self.h10.Draw()
+    self.h10.Fit("gaus")
+    self.h10.Draw("same")
+
+
+    c11 = R.TCanvas("c11"," chi2 ",150,150,800,600)
+    c11.GetFrame().SetFillColor(0)
+    c11.GetFrame().SetBorderSize(20)
+    self.h11.GetXaxis().SetTitle(" chi2(z) at plane 2")
+    self.h11.Draw()
+
+    """
+    c15 = R.TCanvas("c15"," chi2 ",155,155,800,600)
+    c15.GetFrame().SetFillColor(0)
+    c15.GetFrame().SetBorderSize(20)
+    self.h15.GetXaxis().SetTitle(" chi2(z) at plane 4")
+    self.h15.Draw()
+
+    c12 = R.TCanvas("c12"," chi2 ",160,160,800,600)
+    c12.GetFrame().SetFillColor(0)
+    c12.GetFrame().SetBorderSize(20)
+    self.h12.GetXaxis().SetTitle(" chi2(z) at plane 3")
+    self.h12.Draw()
+
+    c16 = R.TCanvas("c16"," chi2 ",165,165,800,600)
+    c16.GetFrame().SetFillColor(0)
+    c16.GetFrame().SetBorderSize(20)
+    self.h16.GetXaxis().SetTitle(" chi2(z) at plane 5")
+    self.h16.Draw()
+    """
+
+    c13 = R.TCanvas("c13"," chi2 ",170,170,800,600)
+    c13.GetFrame().SetFillColor(0)
+    c13.GetFrame().SetBorderSize(20)
+    self.h13.GetXaxis().SetTitle(" global chi2 with fixed MS error")
+    self.h13.Draw()
+
+    """
+    c14 = R.TCanvas("c14"," chi2 ",180,180,800,600)
+    c14.GetFrame().SetFillColor(0)
+    c14.GetFrame().SetBorderSize(20)
+    self.h14.GetXaxis().SetTitle(" global chi2 with variable MS error")
+    self.h14.Draw()
+    """
+
+    return [c5, c6, c8, c10, c11, c13]
+
+  # write the remaining tracks and the histograms to the output file and close it
+  def write(self):
+    self.flushTracks()
+    if self.outfile is None: return
+    self.file().cd()
+    for h in self.histograms: h.Write()
+    if self.tree is not None: self.tree.Write()
+    self.fout.Close()
+    self.fout = None
 
-"""
-c14 = R.TCanvas("c14"," chi2 ",180,180,800,600)
-c14.GetFrame().SetFillColor(0)
-c14.GetFrame().SetBorderSize(20)
-h14.GetXaxis().SetTitle(" global chi2 with variable MS error")
-h14.Draw()
-"""
+# Main Program
+# =================
+#-----------------------------------------------------------------------
+# Loop over numberOfEvents
+#
 
-fout2.cd()
-h1.Write()
-h1.Write() 
-h2.Write() 
-h3.Write() 
-h4.Write() 
-h5.Write() 
-h6.Write() 
-h7.Write() 
-h8.Write() 
-h9.Write() 
-h10.Write()
-h11.Write()
-h12.Write()
-h13.Write()
-h14.Write()
-h15.Write()
-h16.Write()
-fout2.Close()
+# Simulate and reconstruct the events firstEvent, ..., firstEvent+nEvents-1
+def processEvents(cfg, simulator, tracker, sink, firstEvent, nEvents):
+
+  numberOfPlanes = cfg.numberOfPlanes
+  events = simulator.events(nEvents)
+  for i in range(firstEvent, firstEvent+nEvents):
+
+    if(i > cfg.firstDebugEvent-1 ): cfg.debug=True
+    if(i > cfg.lastDebugEvent ): cfg.debug=False
+    debug = cfg.debug
+
+    # New event
+    if (debug): print(" new event " )
+    sink.numberOfEvents+=1
+
+    #========================================================================================
+    # Simulate the event
+    t = time.perf_counter()
+    hits = next(events)
+    sink.addTime("simulate", t)
+
+    #========================================================================================
+    # Reconstruct the event
+    #
+    # ---------------------------------------------------------------------------------------
+    # Pattern recognition and fit
+    #========================================================================================
+    #
+    reject=False
+    # first count number of hits in each plane
+    nRealHits=0
+    nMissingPlanes=0
+    for j in range(2*numberOfPlanes):
+      nHits=hits.nHits(j)
+      if(not hits.noise[j].all()): nRealHits+=1
+      sink.nTotalHits+=nHits
+      #the seed planes must fire, at most maxHoles of the other planes may not
+      if(nHits<1):
+        nMissingPlanes+=1
+        if(j<2 or nMissingPlanes>cfg.maxHoles): reject=True
+      if (debug): print(" plane " , j , " nHits " , nHits , " nRealHits " , nRealHits )
+
+    if(reject):
+      sink.numberOfInefficientTracks+=1
+      continue
+
+    if(debug): print(" start reconstruction" )
+
+    [tracks, chi2min] = tracker.reconstruct(hits)
+
+    # Reject event if best track not good enough
+    if(len(tracks)==0):
+      sink.numberOfRejectedTracks+=1
+      if(nRealHits>2*numberOfPlanes-1): sink.numberOfGoodRejectedTracks+=1
+      if(debug): print(" best track rejected chi2= " , chi2min )
+      t = time.perf_counter()
+      sink.showEvent(hits, i, True, False, tracker)
+      sink.addTime("draw", t)
+      continue
+
+    noisy=False
+    for [chi2min, ibest, xbest, Cbest] in tracks:
+
+      # Repeat the fit for the selected track (using the measured momentum now)
+      t = time.perf_counter()
+      [chi2, dummp_x, dummy_C]= tracker.globalChi2(ibest,xbest,Cbest)
+      t = sink.addTime("globalFit", t)
+
+      # all hits from the same particle, no noise hit
+      allsignal= hits.trackParticle(ibest)>=0
+      noisy = noisy or not allsignal
+
+      if(debug):
+        if(allsignal):
+          print(" Noiseless track selected   chi2 " , chi2 )
+        else:
+          print(" Noisy track selected   chi2 " , chi2 )
+
+      #Store the track
+      p = 5*[0.]
+      ep = (5*5)*[0.]
+      for ipar in range(5):
+        p[ipar]=xbest[ipar][0]
+        for jpar in range(5): ep[ipar*5+jpar]=Cbest[ipar][jpar]
+
+      sink.storeTrack(hits,i,ibest,p,ep,chi2min,chi2)
+      sink.addTime("store", t)
+
+      sink.numberOfReconstructedTracks+=1
+
+      if(allsignal): sink.numberOfGoodReconstructedTracks+=1
+      for j in range(2*numberOfPlanes):
+        if(ibest[j]<0): continue
+        if(hits.noise[j][ibest[j]]): sink.nNoiseHitsOnTrack+=1
+        #flag the hits as used
+        hits.used[j][ibest[j]]=True
+
+    # visualize the hits and the track candidates
+    t = time.perf_counter()
+    sink.showEvent(hits, i, False, noisy, tracker)
+    sink.addTime("draw", t)
+
+
+## Event-parallel processing
+#
+# The events are split into nWorkers contiguous shards, each processed in its own process.
+# Each worker has its own simulator, tracker and sink (without output file or event display),
+# with independent, reproducible random number streams derived from batchSeed.
+# The counters and histograms of all workers are summed at the end.
+def runWorker(cfg, iworker, firstEvent, nEvents):
+
+  simulator = Simulator(cfg, np.random.SeedSequence(cfg.batchSeed).spawn(cfg.nWorkers)[iworker])
+  sink = ResultSink(cfg, outfile=None)
+  processEvents(cfg, simulator, Tracker(cfg, sink), sink, firstEvent, nEvents)
+  return sink.results()
+
+def runParallel(cfg, sink):
+
+  # the canvas and the output file belong to the main process
+  workerCfg = cfg.replace(displayMode="off", displayCondition=None)
+
+  # contiguous shards of events
+  shards = []
+  first = 0
+  for iworker in range(cfg.nWorkers):
+    n = cfg.numberOfEvents//cfg.nWorkers + (1 if iworker < cfg.numberOfEvents%cfg.nWorkers else 0)
+    shards.append((workerCfg, iworker, first, n))
+    first += n
+
+  with multiprocessing.get_context("fork").Pool(cfg.nWorkers) as pool:
+    results = pool.starmap(runWorker, shards)
+
+  # merge the counters and the histograms of all workers
+  for [counts, hists, tracks] in results: sink.merge(counts, hists, tracks)
+
+# Simulate and reconstruct cfg.numberOfEvents events
+# seed: random number seed of the simulation (see Simulator; with several workers, the streams derive from batchSeed)
+# returns the ResultSink with the counters and histograms
+def run(cfg, outfile="kf_result.root", seed=None):
+  start = time.perf_counter()
+  sink = ResultSink(cfg, outfile)
+  if(cfg.nWorkers > 1):
+    runParallel(cfg, sink)
+  else:
+    processEvents(cfg, Simulator(cfg, seed), Tracker(cfg, sink), sink, 0, cfg.numberOfEvents)
+  t = time.perf_counter()
+  sink.flushTracks()
+  sink.wallTime = sink.addTime("store", t) - start
+  if cfg.summaryFile is not None: sink.writeSummary(cfg.summaryFile)
+  return sink
+
+def main():
+  cfg = TestbeamConfig()
+  sink = run(cfg)
+  sink.printSummary()
+  canvases = sink.plot()
+  sink.write()
+  return [sink, canvases]
+
+if __name__ == "__main__":
+  [sink, canvases] = main()